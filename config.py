@@ -23,7 +23,62 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 trueskill.setup(mu=1500, sigma=500, beta=250, tau=5, draw_probability=0.10)
 
+# Per-connection limits on bytes buffered in the transport.
+# Above the high water mark broadcasts are held back or dropped, and clients that stay above the
+# hard limit for longer than the timeout (in seconds) are disconnected.
+WRITE_BUFFER_HIGH_WATER = int(Config.get('write_buffer_high_water', 256 * 1024))
+WRITE_BUFFER_LIMIT = int(Config.get('write_buffer_limit', 4 * 1024 * 1024))
+WRITE_BUFFER_LIMIT_TIMEOUT = int(Config.get('write_buffer_limit_timeout', 30))
+
+# Largest map or mod upload accepted, in bytes
+MAX_UPLOAD_SIZE = int(Config.get('max_upload_size', 100 * 1024 * 1024))
+
+# Seconds over which logins and logouts are collected into one player_info broadcast
+PRESENCE_INTERVAL = float(Config.get('presence_interval', 1))
+
+# Connections idle for PING_IDLE_INTERVAL seconds are pinged, and dropped if they
+# don't answer within PING_TIMEOUT seconds
+PING_IDLE_INTERVAL = float(Config.get('ping_idle_interval', 20))
+PING_TIMEOUT = float(Config.get('ping_timeout', 20))
+
+# Logins run at most LOGIN_MAX_CONCURRENCY at a time, the others queue up. The bound shrinks towards
+# LOGIN_MIN_CONCURRENCY while logins take longer than LOGIN_LATENCY_TARGET seconds.
+# Queued clients hear about their place every LOGIN_QUEUE_NOTICE_INTERVAL seconds.
+LOGIN_MIN_CONCURRENCY = int(Config.get('login_min_concurrency', 2))
+LOGIN_MAX_CONCURRENCY = int(Config.get('login_max_concurrency', 16))
+LOGIN_LATENCY_TARGET = float(Config.get('login_latency_target', 1))
+LOGIN_QUEUE_NOTICE_INTERVAL = float(Config.get('login_queue_notice_interval', 10))
+
+# Worker processes decoding the uniqueids sent with logins, 0 to decode them on the event loop
+UNIQUEID_WORKERS = int(Config.get('uniqueid_workers', 2))
+
+# GeoIP country database. Countries are cached for the GEOIP_CACHE_SIZE most recently seen
+# networks of GEOIP_CACHE_PREFIX bits.
+GEOIP_DATABASE = Config.get('geoip_database', 'GeoIP.dat')
+GEOIP_CACHE_SIZE = int(Config.get('geoip_cache_size', 4096))
+GEOIP_CACHE_PREFIX = int(Config.get('geoip_cache_prefix', 24))
+
+# Seconds the players of dropped lobby connections stay online, waiting for the client to resume
+SESSION_RESUME_GRACE = float(Config.get('session_resume_grace', 30))
+
+# Side effect writes of logins are done in batches of up to WRITE_BEHIND_BATCH_SIZE every
+# WRITE_BEHIND_INTERVAL seconds, giving up on a write after WRITE_BEHIND_MAX_ATTEMPTS failures.
+WRITE_BEHIND_INTERVAL = float(Config.get('write_behind_interval', 1))
+WRITE_BEHIND_BATCH_SIZE = int(Config.get('write_behind_batch_size', 500))
+WRITE_BEHIND_MAX_ATTEMPTS = int(Config.get('write_behind_max_attempts', 5))
+
+# Dirty games are flushed every FLUSH_MIN_INTERVAL seconds when idle, backing off towards
+# FLUSH_MAX_INTERVAL as load builds up. The load counts in full at FLUSH_LAG_BUDGET seconds of
+# event loop lag, FLUSH_CONGESTION_BUDGET of connections backed up or FLUSH_BATCH_BUDGET dirty games.
+FLUSH_MIN_INTERVAL = float(Config.get('flush_min_interval', 0.25))
+FLUSH_MAX_INTERVAL = float(Config.get('flush_max_interval', 5))
+FLUSH_LAG_BUDGET = float(Config.get('flush_lag_budget', 0.1))
+FLUSH_CONGESTION_BUDGET = float(Config.get('flush_congestion_budget', 0.1))
+FLUSH_BATCH_BUDGET = int(Config.get('flush_batch_budget', 500))
+
 RULE_LINK = Config.get('rule_url', 'http://forums.faforever.com/forums/viewtopic.php?f=2&t=581#p5710')
 WIKI_LINK = Config.get('wiki_url', 'http://wiki.faforever.com')
 
 LADDER_SEASON = Config.get('ladder_season', "ladder_season_5")
+# Seconds between reloads of the ladder season standings, which results from elsewhere end up in
+LADDER_LEADERBOARD_REFRESH_INTERVAL = float(Config.get('ladder_leaderboard_refresh_interval', 3600))
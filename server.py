@@ -1,11 +1,7 @@
 #!/usr/bin/env python3
 """
 Usage:
-    server.py [--nodb | --db TYPE]
-
-Options:
-    --nodb      Don't use a database (Use a mock.Mock). Caution: Will break things.
-    --db TYPE   Use TYPE database driver [default: QMYSQL]
+    server.py
 """
 
 import asyncio
@@ -19,7 +15,7 @@ import signal
 import socket
 
 from quamash import QEventLoop
-from PySide import QtSql, QtCore
+from PySide import QtCore
 from PySide.QtCore import QTimer
 
 from passwords import DB_SERVER, DB_PORT, DB_LOGIN, DB_PASSWORD, DB_NAME
@@ -47,7 +43,7 @@ if __name__ == '__main__':
         done = asyncio.Future()
 
         from docopt import docopt
-        args = docopt(__doc__, version='FAF Server')
+        docopt(__doc__, version='FAF Server')
 
         rootlogger = logging.getLogger("")
         logHandler = handlers.RotatingFileHandler(config.LOG_PATH + "server.log", backupCount=1024, maxBytes=16777216)
@@ -56,23 +52,6 @@ if __name__ == '__main__':
         rootlogger.addHandler(logHandler)
         rootlogger.setLevel(config.LOG_LEVEL)
 
-        if args['--nodb']:
-            from unittest import mock
-            db = mock.Mock()
-        else:
-            db = QtSql.QSqlDatabase(args['--db'])
-            db.setHostName(DB_SERVER)
-            db.setPort(DB_PORT)
-
-            db.setDatabaseName(DB_NAME)
-            db.setUserName(DB_LOGIN)
-            db.setPassword(DB_PASSWORD)
-            db.setConnectOptions("MYSQL_OPT_RECONNECT=1")
-
-        if not db.open():
-            logger.error(db.lastError().text())
-            sys.exit(1)
-
         # Make sure we can shutdown gracefully
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
@@ -95,14 +74,29 @@ if __name__ == '__main__':
         players_online = PlayerService(db_pool)
         games = GameService(players_online)
 
-        ctrl_server = loop.run_until_complete(server.run_control_server(loop, players_online, games))
+        admission = server.AdmissionController(loop)
+        geoip = server.GeoIpService()
+        ctrl_server = loop.run_until_complete(server.run_control_server(loop, players_online, games,
+                                                                        admission, geoip))
+
+        # One wheel pings idle lobby and game connections alike
+        liveness = server.LivenessWheel(loop)
+        liveness.start()
+
+        uniqueid = server.UniqueIdDecoder(loop)
+        writes = server.WriteBehindQueue(loop)
+        writes.start()
 
         lobby_server = loop.run_until_complete(
             server.run_lobby_server(('', 8001),
                                     players_online,
                                     games,
-                                    db,
-                                    loop)
+                                    loop,
+                                    liveness=liveness,
+                                    admission=admission,
+                                    uniqueid=uniqueid,
+                                    geoip=geoip,
+                                    writes=writes)
         )
         for sock in lobby_server.sockets:
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
@@ -110,10 +104,14 @@ if __name__ == '__main__':
             server.run_game_server(('', 8000),
                                    players_online,
                                    games,
-                                   loop)
+                                   loop,
+                                   liveness=liveness)
         game_server = loop.run_until_complete(game_server)
 
         loop.run_until_complete(done)
+        writes.stop()
+        loop.run_until_complete(writes.flush())
+        uniqueid.close()
         loop.close()
 
     except Exception as ex:
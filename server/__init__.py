@@ -14,16 +14,22 @@ __contact__ = 'admin@faforever.com'
 __license__ = 'GPLv3'
 __copyright__ = 'Copyright (c) 2011-2015 ' + __author__
 
-import json
 from .gameconnection import GameConnection
 from .natpacketserver import NatPacketServer
 
 import config
 from server.lobbyconnection import LobbyConnection
-from server.protocol import QDataStreamProtocol
 from server.servercontext import ServerContext
 from server.player_service import PlayerService
 from server.game_service import GameService
+from server.presence_service import PresenceService
+from server.flush_scheduler import FlushScheduler
+from server.liveness import LivenessWheel
+from server.admission import AdmissionController
+from server.uniqueid import UniqueIdDecoder
+from server.geoip_service import GeoIpService
+from server.session_service import SessionService
+from server.write_behind import WriteBehindQueue
 from server.control import init as run_control_server
 import server.db
 
@@ -40,30 +46,50 @@ __all__ = [
 def run_lobby_server(address: (str, int),
                      player_service: PlayerService,
                      games: GameService,
-                     db,
-                     loop):
+                     loop,
+                     liveness: LivenessWheel=None,
+                     admission: AdmissionController=None,
+                     uniqueid: UniqueIdDecoder=None,
+                     geoip: GeoIpService=None,
+                     sessions: SessionService=None,
+                     writes: WriteBehindQueue=None):
     """
     Run the lobby server
 
     :param address: Address to listen on
     :param player_service: Service to talk to about players
     :param games: Service to talk to about games
-    :param db: QSqlDatabase
     :param loop: Event loop to use
+    :param liveness: Wheel pinging idle connections, a new one is started if None
+    :param admission: Queue for logins, a new one is made if None
+    :param uniqueid: Decoder for the uniqueids sent with logins, a new one is made if None
+    :param geoip: Service resolving the countries of players, a new one is made if None
+    :param sessions: Service keeping dropped sessions resumable, a new one is made if None
+    :param writes: Queue for the database writes logins don't wait for, a new one is started if None
     :return ServerContext: A server object
     """
-    def encode(game):
-        # Crazy evil encoding scheme
-        return QDataStreamProtocol.pack_block(
-            QDataStreamProtocol.pack_qstring(json.dumps(game.to_dict()))
-        )
+    if liveness is None:
+        liveness = LivenessWheel(loop)
+        liveness.start()
+    if admission is None:
+        admission = AdmissionController(loop)
+    if uniqueid is None:
+        uniqueid = UniqueIdDecoder(loop)
+    if geoip is None:
+        geoip = GeoIpService()
+    if sessions is None:
+        sessions = SessionService(loop)
+    if writes is None:
+        writes = WriteBehindQueue(loop)
+        writes.start()
 
     def report_dirty_games():
         dirties = games.dirty_games
         games.clear_dirty()
+        sent = 0
 
-        # TODO: This spams squillions of messages: we should implement per-connection message
-        # aggregation at the next abstraction layer down :P
+        # Each connection's protocol queues these up and writes them out together at the end of
+        # this loop iteration, dropping any game_info still queued from before for the same game.
         for game in dirties:
             # Don't tell anyone about an ended game.
             # TODO: Probably better to do this at the time of the state transition instead?
@@ -72,51 +98,60 @@ def run_lobby_server(address: (str, int),
                 continue
 
             # So we're going to be broadcasting this to _somebody_...
-            message = encode(game)
-
-            # These games shouldn't be broadcast, but instead privately sent to those who are
-            # allowed to see them.
-            if game.visibility == VisibilityState.FRIENDS:
-                # To see this game, you must have an authenticated connection and be a friend of the host.
-                validation_func = lambda lobby_conn: game.host.friends.contains(lobby_conn.player.id)
-            else:
-                validation_func = lambda lobby_conn: not game.host.foes.contains(lobby_conn.player.id)
-
-            ctx.broadcast_raw(message, lambda lobby_conn: lobby_conn.authenticated and validation_func(lobby_conn))
-
-        loop.call_later(5, report_dirty_games)
-
-    def ping_broadcast():
-        ctx.broadcast_raw(QDataStreamProtocol.pack_block(QDataStreamProtocol.pack_qstring('PING')))
-        loop.call_later(45, ping_broadcast)
+            message, changes = games.snapshot_game_info(game)
+
+            # Only players that logged in get to see games. FRIENDS games go to the host's
+            # friends, everything else to everybody but the host's foes.
+            audience = player_service.game_audience(game.host,
+                                                    friends_only=game.visibility == VisibilityState.FRIENDS)
+            recipients, leaving = games.game_subscribers(game, audience)
+            ctx.broadcast_game_info(message, changes, recipients, games.encoded_game_info(game))
+            sent += 1
+            # Whoever gets to hear about this game again gets a full game_info first
+            for lobby_conn in leaving:
+                lobby_conn.protocol.games_known.discard(game.id)
+        return sent
 
     def initialize_connection():
         return LobbyConnection(context=ctx,
                                games=games,
                                players=player_service,
-                               db=db,
+                               presence=presence,
+                               liveness=liveness,
+                               admission=admission,
+                               uniqueid=uniqueid,
+                               geoip=geoip,
+                               sessions=sessions,
+                               writes=writes,
                                loop=loop)
-    ctx = ServerContext(initialize_connection, name="LobbyServer", loop=loop)
-    loop.call_later(5, report_dirty_games)
-    loop.call_soon(ping_broadcast)
+    ctx = ServerContext(initialize_connection, name="LobbyServer", loop=loop, liveness=liveness)
+    presence = PresenceService(ctx, loop)
+    FlushScheduler(loop, 'game_info', report_dirty_games,
+                   pending=lambda: len(games.dirty_games),
+                   congestion=ctx.congestion).start()
     return ctx.listen(*address)
 
 
 def run_game_server(address: (str, int),
                     player_service: PlayerService,
                     games: GameService,
-                    loop):
+                    loop,
+                    liveness: LivenessWheel=None):
     """
     Run the game server
 
+    :param liveness: Wheel pinging idle connections, a new one is started if None
     :return (NatPacketServer, ServerContext): A pair of server objects
     """
+    if liveness is None:
+        liveness = LivenessWheel(loop)
+        liveness.start()
     nat_packet_server = NatPacketServer(loop, config.LOBBY_UDP_PORT)
 
     def initialize_connection():
-        gc = GameConnection(loop, player_service, games)
+        gc = GameConnection(loop, player_service, games, liveness=liveness)
         nat_packet_server.subscribe(gc, ['ProcessServerNatPacket'])
         return gc
-    ctx = ServerContext(initialize_connection, name='GameServer', loop=loop)
+    ctx = ServerContext(initialize_connection, name='GameServer', loop=loop, liveness=liveness)
     server = ctx.listen(*address)
     return nat_packet_server, server
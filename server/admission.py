@@ -0,0 +1,140 @@
+import asyncio
+from collections import OrderedDict
+
+import config
+from server import stats
+from server.decorators import with_logger
+
+
+class _Admission:
+    """
+    Held while an admitted login runs, see AdmissionController.admit
+    """
+    def __init__(self, controller):
+        self._controller = controller
+        self._start = controller.loop.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._controller._release(self._controller.loop.time() - self._start)
+
+
+@with_logger
+class AdmissionController:
+    """
+    Bounds the number of logins running at once, queueing the rest in arrival order
+
+        with (yield from admission.admit(notify)):
+            ...
+
+    The bound adapts to how long logins take: it grows by one per
+    bound's worth of logins finishing within latency_target seconds, and
+    shrinks by a quarter, at most once per observed login time, while they
+    take longer. It never leaves [min_limit, max_limit].
+
+    Queued logins are told their place through notify(position) when
+    queued, then every notice_interval seconds if it changed.
+
+    Wait and login times are recorded in stats.login_queue, the current
+    state is reported by report().
+    """
+    def __init__(self, loop, min_limit=None, max_limit=None, latency_target=None, notice_interval=None):
+        self.loop = loop
+        self.min_limit = min_limit if min_limit is not None else config.LOGIN_MIN_CONCURRENCY
+        self.max_limit = max_limit if max_limit is not None else config.LOGIN_MAX_CONCURRENCY
+        self.latency_target = latency_target if latency_target is not None else config.LOGIN_LATENCY_TARGET
+        self.notice_interval = notice_interval if notice_interval is not None \
+            else config.LOGIN_QUEUE_NOTICE_INTERVAL
+        self.limit = float(self.max_limit)
+        self.active = 0
+        # Smoothed time logins take once admitted, None until one finished
+        self.latency = None
+        self._last_decrease = None
+        # Future -> [notify, position last told]
+        self._waiting = OrderedDict()
+        self._notice_handle = None
+
+    def __len__(self):
+        return len(self._waiting)
+
+    @asyncio.coroutine
+    def admit(self, notify=None):
+        """
+        Wait for a turn to log in
+
+        :param notify: function called with the position in the queue, if there is a wait
+        :return: context manager to hold for as long as the login runs
+        """
+        if not self._waiting and self.active < int(self.limit):
+            self.active += 1
+            stats.login_queue.add('wait', 0.0)
+            return _Admission(self)
+
+        waiter = asyncio.Future(loop=self.loop)
+        position = len(self._waiting) + 1
+        self._waiting[waiter] = [notify, position]
+        if notify is not None:
+            notify(position)
+        self._schedule_notices()
+        start = self.loop.time()
+        try:
+            yield from waiter
+        except asyncio.CancelledError:
+            if waiter in self._waiting:
+                del self._waiting[waiter]
+            elif not waiter.cancelled():
+                # Admitted just as the wait was given up on
+                self._release(None)
+            raise
+        stats.login_queue.add('wait', self.loop.time() - start)
+        return _Admission(self)
+
+    def _release(self, seconds):
+        self.active -= 1
+        if seconds is not None:
+            stats.login_queue.add('login', seconds)
+            self._adapt(seconds)
+        self._admit_waiting()
+
+    def _adapt(self, seconds):
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+        if self.latency > self.latency_target:
+            now = self.loop.time()
+            if self._last_decrease is None or now - self._last_decrease >= self.latency:
+                self.limit = max(float(self.min_limit), self.limit * 0.75)
+                self._last_decrease = now
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def _admit_waiting(self):
+        while self._waiting and self.active < int(self.limit):
+            waiter, _ = self._waiting.popitem(last=False)
+            if waiter.cancelled():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def _schedule_notices(self):
+        if self._notice_handle is None and self._waiting:
+            self._notice_handle = self.loop.call_later(self.notice_interval, self._send_notices)
+
+    def _send_notices(self):
+        self._notice_handle = None
+        for position, entry in enumerate(self._waiting.values(), 1):
+            notify, told = entry
+            if notify is not None and position != told:
+                entry[1] = position
+                try:
+                    notify(position)
+                except Exception as ex:  # pragma: no cover
+                    self._logger.exception(ex)
+        self._schedule_notices()
+
+    def report(self):
+        """
+        :return str: "active/limit/queued, latency ms"
+        """
+        return "{}/{}/{}, {:.1f}".format(self.active, int(self.limit), len(self._waiting),
+                                         (self.latency or 0.0) * 1000)
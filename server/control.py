@@ -5,32 +5,73 @@ Tiny local-only http server for getting stats and performing various tasks
 import asyncio
 from aiohttp import web
 import logging
-from server import PlayerService, GameService
+from server import PlayerService, GameService, stats
 
 logger = logging.getLogger(__name__)
 
-def make_handler(player_service: PlayerService, game_service: GameService):
+def write_buffer_stats(player_service: PlayerService):
+    lines = []
+    for player in player_service:
+        lobby = player.lobby_connection
+        if lobby is None or lobby.protocol is None:
+            continue
+        proto = lobby.protocol
+        lines.append("{}: {}/{}/{}".format(player.login,
+                                           proto.get_write_buffer_size(),
+                                           proto.deferred_messages,
+                                           proto.messages_dropped))
+    return "\n".join(lines)
+
+
+def make_handler(player_service: PlayerService, game_service: GameService, admission=None, geoip=None):
     @asyncio.coroutine
     def handler(request):
         body = """
 Users ({}):
 {}
 Games ({}):
+{}
+Write buffers (bytes buffered/deferred messages/dropped messages):
+{}
+Lobby commands (calls/total/mean/p50/p99/max ms):
+{}
+GPGNet actions (calls/total/mean/p50/p99/max ms):
+{}
+Login queue (active/limit/queued, latency ms): {}
+{}
+Login stages (calls/total/mean/p50/p99/max ms):
+{}
+GeoIP cache (cached prefixes, hits/misses): {}
+Ping round trips (pongs/total/mean/p50/p99/max ms):
+{}
+Periodic flushes (calls/total/mean/p50/p99/max ms):
+{}
+Items per flush (flushes/total/mean/p50/p99/max):
 {}
     """.format(len(player_service.players),
                player_service.players,
                len(game_service.live_games),
-               game_service.live_games)
+               game_service.live_games,
+               write_buffer_stats(player_service),
+               stats.lobby_commands.report(),
+               stats.game_actions.report(),
+               admission.report() if admission is not None else "-",
+               stats.login_queue.report(),
+               stats.login_stages.report(),
+               geoip.report() if geoip is not None else "-",
+               stats.round_trips.report(),
+               stats.flushes.report(),
+               stats.flush_sizes.report(scale=1))
         return web.Response(body=body.encode('utf-8'))
     return handler
 
 @asyncio.coroutine
-def init(loop, player_service, game_service):
+def init(loop, player_service, game_service, admission=None, geoip=None):
     """
     Initialize the http control server
     """
     app = web.Application(loop=loop)
-    app.router.add_route('GET', '/', make_handler(player_service, game_service))
+    app.router.add_route('GET', '/', make_handler(player_service, game_service, admission, geoip))
 
     srv = yield from loop.create_server(app.make_handler(), '127.0.0.1', '4040')
     logger.info("Control server listening on http://127.0.0.1:4040")
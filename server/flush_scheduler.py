@@ -0,0 +1,88 @@
+import time
+
+import config
+from server import stats
+from server.decorators import with_logger
+
+
+@with_logger
+class FlushScheduler:
+    """
+    Calls a flush function over and over, sooner when the server is idle
+
+    After every call the next one is scheduled between min_interval and
+    max_interval seconds away, in proportion to how loaded the server is.
+    The load is the largest of, each capped at 1:
+
+      - how late the event loop got around to this call, over lag_budget
+      - the share of backed up connections, over congestion_budget
+      - how many items were waiting to be flushed, over batch_budget
+
+    Load counts in full as soon as it is seen, and halves per call once it
+    goes away, so one quiet moment doesn't snap back to the fastest cadence.
+
+    Flush sizes, durations, intervals and event loop lag are recorded in
+    server.stats under name.
+    """
+    def __init__(self, loop, name, flush, pending, congestion=lambda: 0.0,
+                 min_interval=None, max_interval=None,
+                 lag_budget=None, congestion_budget=None, batch_budget=None):
+        """
+        :param flush: function flushing everything pending, returns the number of items sent
+        :param pending: function returning the number of items waiting to be flushed
+        :param congestion: function returning the share of backed up connections, between 0 and 1
+        """
+        self.loop = loop
+        self.name = name
+        self._flush = flush
+        self._pending = pending
+        self._congestion = congestion
+        self.min_interval = min_interval if min_interval is not None else config.FLUSH_MIN_INTERVAL
+        self.max_interval = max_interval if max_interval is not None else config.FLUSH_MAX_INTERVAL
+        self.lag_budget = lag_budget if lag_budget is not None else config.FLUSH_LAG_BUDGET
+        self.congestion_budget = congestion_budget if congestion_budget is not None \
+            else config.FLUSH_CONGESTION_BUDGET
+        self.batch_budget = batch_budget if batch_budget is not None else config.FLUSH_BATCH_BUDGET
+        self.load = 0.0
+        self.interval = self.min_interval
+        self._due = None
+        self._handle = None
+
+    def start(self):
+        if self._handle is None:
+            self._schedule(self.min_interval)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self, interval):
+        self.interval = interval
+        self._due = self.loop.time() + interval
+        self._handle = self.loop.call_later(interval, self.run)
+
+    def run(self):
+        """
+        Flush if anything is pending and schedule the next call
+        """
+        self._handle = None
+        lag = max(0.0, self.loop.time() - self._due) if self._due is not None else 0.0
+        stats.flushes.add('{} lag'.format(self.name), lag)
+        waiting = self._pending()
+        try:
+            if waiting:
+                start = time.perf_counter()
+                sent = self._flush()
+                stats.flushes.add('{} duration'.format(self.name), time.perf_counter() - start)
+                stats.flush_sizes.add(self.name, sent)
+        except Exception as ex:
+            self._logger.exception(ex)
+        finally:
+            load = max(min(1.0, lag / self.lag_budget),
+                       min(1.0, self._congestion() / self.congestion_budget),
+                       min(1.0, waiting / self.batch_budget))
+            self.load = max(load, self.load / 2)
+            interval = self.min_interval + (self.max_interval - self.min_interval) * self.load
+            stats.flushes.add('{} interval'.format(self.name), interval)
+            self._schedule(interval)
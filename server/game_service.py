@@ -1,14 +1,17 @@
 import asyncio
+from collections import defaultdict
 
 import aiocron
 
+import config
 import server.db as db
 from server import GameState, VisibilityState
 from server.decorators import with_logger
 
-from server.games import FeaturedMod, LadderService, LadderGame, CoopGame
+from server.games import FeaturedMod, LadderService, LadderGame, CoopGame, GameFilter, LadderLeaderboard
 from server.games.game import Game
 from server.players import Player
+from server.protocol import codec
 from passwords import DB_NAME
 
 @with_logger
@@ -33,8 +36,25 @@ class GameService:
         # Temporary proxy for the ladder service
         self.ladder_service = None
 
+        # Standings of the current ladder season, loaded with the static-ish data and
+        # reloaded every leaderboard_refresh_interval seconds after
+        self.ladder_leaderboard = LadderLeaderboard()
+        self.leaderboard_refresh_interval = config.LADDER_LEADERBOARD_REFRESH_INTERVAL
+        self._leaderboard_refresh = None
+
         # The set of active games
         self.games = dict()
+        # Ids of the active games, by featured mod
+        self._games_by_mod = defaultdict(set)
+
+        # Lobby connections subscribed to the game list, and the filter each subscribed with.
+        # Subscribers are indexed by the featured mod they filter on, None for any.
+        self._subscriptions = dict()
+        self._subscribers_by_mod = defaultdict(set)
+
+        # Last game_info broadcast per game id, as the baseline for the next delta:
+        # (message, each field JSON encoded, message encoded per protocol class)
+        self._game_info_snapshots = dict()
 
         # Cached versions for files by game_mode ( featured mod name )
         # For use by the patcher
@@ -43,6 +63,7 @@ class GameService:
         # Synchronously initialise the game-id counter and static-ish-data.
         asyncio.get_event_loop().run_until_complete(asyncio.async(self.initialise_game_counter()))
         asyncio.get_event_loop().run_until_complete(asyncio.async(self.really_update_static_ish_data()))
+        self.schedule_leaderboard_refresh()
 
     @asyncio.coroutine
     def initialise_game_counter(self):
@@ -105,6 +126,27 @@ class GameService:
             # meh meh
             self.ladder_service = LadderService(self)
 
+        yield from self.ladder_leaderboard.refresh()
+
+    def schedule_leaderboard_refresh(self):
+        """
+        Reload the ladder leaderboard leaderboard_refresh_interval seconds from now, and then every
+        leaderboard_refresh_interval seconds
+        """
+        if self._leaderboard_refresh is not None:
+            self._leaderboard_refresh.cancel()
+        self._leaderboard_refresh = asyncio.get_event_loop().call_later(
+            self.leaderboard_refresh_interval, lambda: asyncio.async(self.refresh_ladder_leaderboard()))
+
+    @asyncio.coroutine
+    def refresh_ladder_leaderboard(self):
+        try:
+            yield from self.ladder_leaderboard.refresh()
+        except Exception as ex:
+            self._logger.exception(ex)
+        finally:
+            self.schedule_leaderboard_refresh()
+
     @aiocron.crontab('0 * * * *')
     @asyncio.coroutine
     def update_static_ish_data(self):
@@ -115,6 +157,8 @@ class GameService:
         return self._dirty_games
 
     def mark_dirty(self, game):
+        # Assigning what to_dict reports bumps the version already, changing it in place doesn't
+        game.bump_version()
         self._dirty_games.add(game)
 
     def clear_dirty(self):
@@ -153,6 +197,7 @@ class GameService:
         else:
             game = Game(**args)
         self.games[id] = game
+        self._games_by_mod[game.game_mode].add(id)
 
         self._logger.info("{} created".format(game))
         game.visibility = visibility
@@ -173,6 +218,104 @@ class GameService:
 
     def remove_game(self, game: Game):
         del self.games[game.id]
+        self._games_by_mod[game.game_mode].discard(game.id)
+        self._game_info_snapshots.pop(game.id, None)
+
+    def snapshot_game_info(self, game: Game):
+        """
+        Take the game_info to broadcast for game, keeping it as the baseline for the next delta
+
+        :return (dict, dict): the full game_info, and the fields that changed since
+                              the previous snapshot (None if there is none)
+        """
+        previous = self._game_info_snapshots.get(game.id)
+        message = game.to_dict()
+        if previous is not None and previous[0] is message:
+            # Unchanged since the last snapshot
+            return message, {}
+        fields = {field: codec.dumps(value) for field, value in message.items()}
+        self._game_info_snapshots[game.id] = (message, fields, {})
+        if previous is None:
+            return message, None
+        _, previous_fields, _ = previous
+        return message, {field: message[field] for field, value in fields.items()
+                         if previous_fields.get(field) != value}
+
+    def game_info(self, game: Game):
+        """
+        The game_info clients were last sent for game, so that deltas that follow apply to it
+        """
+        snapshot = self._game_info_snapshots.get(game.id)
+        if snapshot is None:
+            return game.to_dict()
+        return snapshot[0]
+
+    def encoded_game_info(self, game: Game):
+        """
+        Cache of game_info(game) encoded per protocol class, for ServerContext.broadcast_game_info
+
+        :return dict: protocol class -> bytes, filled in as needed
+        """
+        snapshot = self._game_info_snapshots.get(game.id)
+        if snapshot is None:
+            # Never broadcast yet, so there is no snapshot to attach encodings to
+            return {}
+        return snapshot[2]
+
+    def subscribe(self, connection, game_filter: GameFilter):
+        """
+        Only tell connection about games passing game_filter from now on
+
+        Replaces any earlier subscription of connection.
+        """
+        self.unsubscribe(connection)
+        self._subscriptions[connection] = game_filter
+        self._subscribers_by_mod[game_filter.featured_mod].add(connection)
+
+    def unsubscribe(self, connection):
+        """
+        Go back to telling connection about every game it may see
+        """
+        game_filter = self._subscriptions.pop(connection, None)
+        if game_filter is not None:
+            self._subscribers_by_mod[game_filter.featured_mod].discard(connection)
+
+    def matching_games(self, game_filter: GameFilter):
+        """
+        Games that haven't ended and pass game_filter
+        """
+        if game_filter.featured_mod is not None:
+            candidates = (self.games[id] for id in self._games_by_mod[game_filter.featured_mod])
+        else:
+            candidates = self.games.values()
+        return [game for game in candidates
+                if game.state != GameState.ENDED and game_filter.matches(game)]
+
+    def game_subscribers(self, game: Game, audience):
+        """
+        Narrow the audience of a game_info down to the connections that want it
+
+        Connections without a subscription get everything, as they always have.
+        Subscribers get games passing their filter, plus one last update for games
+        they were sent before that stopped passing it.
+
+        :param audience: connections allowed to see game
+        :return (list, list): connections to send game to, and those of them
+                              that should forget about it afterwards
+        """
+        if not self._subscriptions:
+            return audience, []
+        matching = {conn for mod in (None, game.game_mode)
+                    for conn in self._subscribers_by_mod.get(mod, ())
+                    if self._subscriptions[conn].matches(game)}
+        recipients, leaving = [], []
+        for conn in audience:
+            if conn not in self._subscriptions or conn in matching:
+                recipients.append(conn)
+            elif game.id in conn.protocol.games_known:
+                recipients.append(conn)
+                leaving.append(conn)
+        return recipients, leaving
 
     def all_game_modes(self):
         mods = []
@@ -5,10 +5,12 @@ import socket
 import time
 import logging
 import functools
+from collections import namedtuple
 
 import json
 import config
 
+from server import stats
 from server.abc.base_game import GameConnectionState
 from server.connectivity import TestPeer, ConnectivityState
 from server.games.game import Game, GameState, Victory
@@ -28,19 +30,36 @@ class AuthenticationError(Exception):
     pass
 
 
+ActionHandler = namedtuple('ActionHandler', 'function is_coroutine')
+
+# GPGNet action key -> ActionHandler, filled in by @gpgnet_action
+ACTION_HANDLERS = {}
+
+
+def gpgnet_action(key):
+    """
+    Register the decorated GameConnection method as the handler for a GPGNet action
+    """
+    def decorator(function):
+        ACTION_HANDLERS[key] = ActionHandler(function, asyncio.iscoroutinefunction(function))
+        return function
+    return decorator
+
+
 @with_logger
 class GameConnection(Subscribable, GpgNetServerProtocol):
     """
     Responsible for connections to the game, using the GPGNet protocol
     """
 
-    def __init__(self, loop, player_service, games: GameService):
+    def __init__(self, loop, player_service, games: GameService, liveness=None):
         """
         Construct a new GameConnection
 
         :param loop: asyncio event loop to use
         :param player_service: PlayerService
         :param games: GamesService
+        :param liveness: LivenessWheel to report pongs to
         :return:
         """
         super().__init__()
@@ -50,6 +69,7 @@ class GameConnection(Subscribable, GpgNetServerProtocol):
         self.loop = loop
         self.player_service = player_service
         self.games = games
+        self.liveness = liveness
 
         self.log = logging.getLogger(__name__)
         self.initTime = time.time()
@@ -58,14 +78,11 @@ class GameConnection(Subscribable, GpgNetServerProtocol):
         self.logGame = "\t"
         self._game = None
 
-        self.last_pong = time.time()
-
         self._authenticated = asyncio.Future()
         self.ip, self.port = None, None
         self.lobby = None
         self._transport = None
         self.nat_packets = {}
-        self.ping_task = None
 
         self._connectivity_state = asyncio.Future()
 
@@ -134,32 +151,18 @@ class GameConnection(Subscribable, GpgNetServerProtocol):
         self.game = self.player.game
         self.player.game_connection = self
 
-        self.ping_task = asyncio.async(self.ping())
         self._state = GameConnectionState.INITIALIZED
         self._authenticated.set_result(session)
 
     def send_message(self, message):
         self.protocol.send_message(message)
 
-    @asyncio.coroutine
-    def ping(self):
+    def send_ping(self):
         """
         Ping the relay server to check if the player is still there.
         """
-        while True:
-            if self._state == GameConnectionState.ENDED:
-                break
-            if time.time() - self.last_pong > 30:
-                self._logger.debug('Missed ping, terminating')
-                self.abort()
-                break
+        if self._state != GameConnectionState.ENDED:
             self.send_Ping()
-            try:
-                yield from asyncio.sleep(20)
-            # quamash will yield a runtime error if the qtimer was already deleted
-            # asyncio yields a cancelled error which we use to break the loop
-            except (RuntimeError, CancelledError):  # pragma: no cover
-                break
 
     def _handle_idle_state(self):
         """
@@ -376,119 +379,24 @@ class GameConnection(Subscribable, GpgNetServerProtocol):
         :return: None
         """
         try:
-            if key == 'Authenticate':
-                yield from self.authenticate(int(values[0]), int(values[1]))
-            elif not self._authenticated.done():
+            handler = ACTION_HANDLERS.get(key)
+            if key != 'Authenticate' and not self._authenticated.done():
                 @asyncio.coroutine
                 def queue_until_authed():
                     yield from self._authenticated
                     yield from self.handle_action(key, values)
                 asyncio.async(queue_until_authed())
                 return
-            elif key == 'pong':
-                self.last_pong = time.time()
+            if handler is None:
                 return
-
-            elif key == 'ProcessNatPacket':
-                address, message = values[0], values[1]
-                self._logger.info("{}.ProcessNatPacket: {} {}".format(self, values[0], values[1]))
-                if message in self.nat_packets and isinstance(self.nat_packets[message], asyncio.Future):
-                    if not self.nat_packets[message].done():
-                        self.nat_packets[message].set_result(address)
-
-            elif key == 'Desync':
-                self.game.desyncs += 1
-
-            elif key == 'GameState':
-                state = values[0]
-                yield from self.handle_game_state(state)
-                self._mark_dirty()
-
-            elif key == 'GameOption':
-                option_key = values[0]
-                option_value = values[1]
-                if option_key == 'Victory':
-                    self.game.gameOptions['Victory'] = Victory.from_gpgnet_string(option_value)
-                elif option_key in self.game.gameOptions:
-                    self.game.gameOptions[option_key] = option_value
-
-                if option_key == "Slots":
-                    self.game.max_players = option_value
-
-                if option_key == 'ScenarioFile':
-                    raw = "%r" % option_value
-                    path = raw.replace('\\', '/')
-                    self.game.map_file_path = str(path.split('/')[2]).lower()
-                self._mark_dirty()
-
-            elif key == 'GameMods':
-                if values[0] == "activated":
-                    if values[1] == 0:
-                        self.game.mods = {}
-
-                if values[0] == "uids":
-                    uids = values[1].split()
-                    self.game.mods = {uid: "Unknown sim mod" for uid in uids}
-                    with (yield from db.db_pool) as conn:
-                        cursor = yield from conn.cursor()
-                        yield from cursor.execute("SELECT uid, name from table_mod WHERE uid in %s", (uids, ))
-                        mods = yield from cursor.fetchall()
-                        for (uid, name) in mods:
-                            self.game.mods[uid] = name
-                self._mark_dirty()
-
-            elif key == 'PlayerOption':
-                if self.player.state == PlayerState.HOSTING:
-                    id = values[0]
-                    key = values[1]
-                    value = values[2]
-                    self.game.set_player_option(int(id), key, value)
-                    self._mark_dirty()
-
-            elif key == 'AIOption':
-                if self.player.state == PlayerState.HOSTING:
-                    name = values[0]
-                    key = values[1]
-                    value = values[2]
-                    self.game.set_ai_option(str(name), key, value)
-                    self._mark_dirty()
-
-            elif key == 'ClearSlot':
-                if self.player.state == PlayerState.HOSTING:
-                    slot = values[0]
-                    self.game.clear_slot(slot)
-                self._mark_dirty()
-
-            elif key == 'GameResult':
-                army = int(values[0])
-                result = str(values[1])
-                try:
-                    if not any(map(functools.partial(str.startswith, result),
-                            ['score', 'default', 'victory', 'draw'])):
-                        raise ValueError()  # pragma: no cover
-                    result = result.split(' ')
-                    self.game.add_result(self.player, army, result[0], int(result[1]))
-                except (KeyError, ValueError):  # pragma: no cover
-                    self.log.warn("Invalid result for {} reported: {}".format(army, result))
-                    pass
-
-            elif key == 'OperationComplete':
-                if int(values[0]) == 1:
-                    secondary, delta = int(values[1]), str(values[2])
-                    with (yield from db.db_pool) as conn:
-                        cursor = yield from conn.cursor()
-                        # FIXME: Resolve used map earlier than this
-                        yield from cursor.execute("SELECT id FROM coop_map WHERE filename LIKE '%/"
-                                                  + self.game.map_file_path+".%'")
-                        (mission, ) = yield from cursor.fetchone()
-                        if not mission:
-                            self._logger.debug("can't find coop map: {}".format(self.game.map_file_path))
-                            return
-
-                        yield from cursor.execute("INSERT INTO `coop_leaderboard`"
-                                                  "(`mission`, `gameuid`, `secondary`, `time`) "
-                                                  "VALUES (%s, %s, %s, %s);",
-                                                  (mission, self.game.id, secondary, delta))
+            start = time.perf_counter()
+            try:
+                if handler.is_coroutine:
+                    yield from handler.function(self, values)
+                else:
+                    handler.function(self, values)
+            finally:
+                stats.game_actions.add(key, time.perf_counter() - start)
         except AuthenticationError as e:
             self.log.exception("Authentication error: {}".format(e))
             self.abort()
@@ -497,6 +405,131 @@ class GameConnection(Subscribable, GpgNetServerProtocol):
             self.log.exception(self.logGame + "Something awful happened in a game thread!")
             self.abort()
 
+    @gpgnet_action('Authenticate')
+    @asyncio.coroutine
+    def action_Authenticate(self, values):
+        yield from self.authenticate(int(values[0]), int(values[1]))
+
+    @gpgnet_action('pong')
+    def action_pong(self, values):
+        if self.liveness is not None:
+            self.liveness.pong(self)
+
+    @gpgnet_action('ProcessNatPacket')
+    def action_ProcessNatPacket(self, values):
+        address, message = values[0], values[1]
+        self._logger.info("{}.ProcessNatPacket: {} {}".format(self, values[0], values[1]))
+        if message in self.nat_packets and isinstance(self.nat_packets[message], asyncio.Future):
+            if not self.nat_packets[message].done():
+                self.nat_packets[message].set_result(address)
+
+    @gpgnet_action('Desync')
+    def action_Desync(self, values):
+        self.game.desyncs += 1
+
+    @gpgnet_action('GameState')
+    @asyncio.coroutine
+    def action_GameState(self, values):
+        state = values[0]
+        yield from self.handle_game_state(state)
+        self._mark_dirty()
+
+    @gpgnet_action('GameOption')
+    def action_GameOption(self, values):
+        option_key = values[0]
+        option_value = values[1]
+        if option_key == 'Victory':
+            self.game.gameOptions['Victory'] = Victory.from_gpgnet_string(option_value)
+        elif option_key in self.game.gameOptions:
+            self.game.gameOptions[option_key] = option_value
+
+        if option_key == "Slots":
+            self.game.max_players = option_value
+
+        if option_key == 'ScenarioFile':
+            raw = "%r" % option_value
+            path = raw.replace('\\', '/')
+            self.game.map_file_path = str(path.split('/')[2]).lower()
+        self._mark_dirty()
+
+    @gpgnet_action('GameMods')
+    @asyncio.coroutine
+    def action_GameMods(self, values):
+        if values[0] == "activated":
+            if values[1] == 0:
+                self.game.mods = {}
+
+        if values[0] == "uids":
+            uids = values[1].split()
+            mods = {uid: "Unknown sim mod" for uid in uids}
+            self.game.mods = mods
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
+                yield from cursor.execute("SELECT uid, name from table_mod WHERE uid in %s", (uids, ))
+                for (uid, name) in (yield from cursor.fetchall()):
+                    mods[uid] = name
+            self.game.mods = mods
+        self._mark_dirty()
+
+    @gpgnet_action('PlayerOption')
+    def action_PlayerOption(self, values):
+        if self.player.state == PlayerState.HOSTING:
+            id = values[0]
+            key = values[1]
+            value = values[2]
+            self.game.set_player_option(int(id), key, value)
+            self._mark_dirty()
+
+    @gpgnet_action('AIOption')
+    def action_AIOption(self, values):
+        if self.player.state == PlayerState.HOSTING:
+            name = values[0]
+            key = values[1]
+            value = values[2]
+            self.game.set_ai_option(str(name), key, value)
+            self._mark_dirty()
+
+    @gpgnet_action('ClearSlot')
+    def action_ClearSlot(self, values):
+        if self.player.state == PlayerState.HOSTING:
+            slot = values[0]
+            self.game.clear_slot(slot)
+        self._mark_dirty()
+
+    @gpgnet_action('GameResult')
+    def action_GameResult(self, values):
+        army = int(values[0])
+        result = str(values[1])
+        try:
+            if not any(map(functools.partial(str.startswith, result),
+                    ['score', 'default', 'victory', 'draw'])):
+                raise ValueError()  # pragma: no cover
+            result = result.split(' ')
+            self.game.add_result(self.player, army, result[0], int(result[1]))
+        except (KeyError, ValueError):  # pragma: no cover
+            self.log.warn("Invalid result for {} reported: {}".format(army, result))
+            pass
+
+    @gpgnet_action('OperationComplete')
+    @asyncio.coroutine
+    def action_OperationComplete(self, values):
+        if int(values[0]) == 1:
+            secondary, delta = int(values[1]), str(values[2])
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
+                # FIXME: Resolve used map earlier than this
+                yield from cursor.execute("SELECT id FROM coop_map WHERE filename LIKE '%/"
+                                          + self.game.map_file_path+".%'")
+                (mission, ) = yield from cursor.fetchone()
+                if not mission:
+                    self._logger.debug("can't find coop map: {}".format(self.game.map_file_path))
+                    return
+
+                yield from cursor.execute("INSERT INTO `coop_leaderboard`"
+                                          "(`mission`, `gameuid`, `secondary`, `time`) "
+                                          "VALUES (%s, %s, %s, %s);",
+                                          (mission, self.game.id, secondary, delta))
+
     def on_ProcessNatPacket(self, address_and_port, message):
         self.nat_packets[message] = address_and_port
 
@@ -600,8 +633,6 @@ class GameConnection(Subscribable, GpgNetServerProtocol):
         finally:
             if not self._connectivity_state.done():
                 self._connectivity_state.cancel()
-            if self.ping_task is not None:
-                self.ping_task.cancel()
             if self._player:
                 self._player.state = PlayerState.IDLE
 
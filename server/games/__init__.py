@@ -4,5 +4,7 @@ from .game import Game
 from .ladder_game import LadderGame
 from .coop import CoopGame
 from .custom_game import CustomGame
+from .game_filter import GameFilter
+from .ladder_leaderboard import LadderLeaderboard
 
 FeaturedMod = namedtuple('FeaturedMod', 'name full_name description publish')
@@ -77,12 +77,42 @@ class GameError(Exception):
     pass
 
 
+def _reported(name):
+    """
+    Property for an attribute of Game that to_dict reports
+
+    Assigning it bumps the version of the game, so that callers setting it
+    directly don't leave a stale to_dict behind.
+    """
+    attr = '_' + name
+
+    def get(self):
+        return getattr(self, attr)
+
+    def set(self, value):
+        setattr(self, attr, value)
+        self.bump_version()
+    return property(get, set)
+
+
 class Game(BaseGame):
     """
     Object that lasts for the lifetime of a game on FAF.
     """
     init_mode = InitMode.NORMAL_LOBBY
 
+    visibility = _reported('visibility')
+    password = _reported('password')
+    name = _reported('name')
+    state = _reported('state')
+    game_mode = _reported('game_mode')
+    mods = _reported('mods')
+    map_file_path = _reported('map_file_path')
+    host = _reported('host')
+    gameType = _reported('gameType')
+    options = _reported('options')
+    max_players = _reported('max_players')
+
     def __init__(self, id, game_service,
                  host=None,
                  name='None',
@@ -96,6 +126,9 @@ class Game(BaseGame):
         :return: Game
         """
         super().__init__()
+        # Bumped on every change to what to_dict reports
+        self.version = 0
+        self._dict_cache = None
         self._results = {}
         self.game_service = game_service
         self._player_options = {}
@@ -130,6 +163,12 @@ class Game(BaseGame):
         self.mods = []
         self._logger.info("{} created".format(self))
 
+    def bump_version(self):
+        """
+        Note a change to anything to_dict reports, so it gets recomputed
+        """
+        self.version += 1
+
     @property
     def armies(self):
         return frozenset({self.get_player_option(player.id, 'Army')
@@ -188,6 +227,7 @@ class Game(BaseGame):
             raise GameError("Invalid GameState: {state}".format(state=self.state))
         self._logger.info("Added game connection {}".format(game_connection))
         self._connections[game_connection.player] = game_connection
+        self.bump_version()
 
     def remove_game_connection(self, game_connection):
         """
@@ -200,6 +240,7 @@ class Game(BaseGame):
         """
         assert game_connection in self._connections.values()
         del self._connections[game_connection.player]
+        self.bump_version()
         self._logger.info("Removed game connection {}".format(game_connection))
         if len(self._connections) == 0:
             self.on_game_end()
@@ -283,6 +324,7 @@ class Game(BaseGame):
         if id not in self._player_options:
             self._player_options[id] = {}
         self._player_options[id][key] = value
+        self.bump_version()
 
     def get_player_option(self, id, key):
         """
@@ -330,6 +372,7 @@ class Game(BaseGame):
                 to_remove.append(ai)
         for item in to_remove:
             del self.AIs[item]
+        self.bump_version()
 
     def validate_game_settings(self):
         """
@@ -520,9 +563,32 @@ class Game(BaseGame):
             for row in rows:
                 (player_id, mean, deviation) = row
 
-                self.game_service.player_service[player_id].global_rating = (mean, deviation)
+                player = self.game_service.player_service[player_id]
+                player.global_rating = (mean, deviation)
+                self.game_service.player_service.player_info_changed(player)
 
     def to_dict(self):
+        """
+        The game_info message for this game
+
+        The same dict is returned until the version is bumped or the featured mod
+        versions are reloaded, so it must not be modified.
+        """
+        mod_versions = self.getGamemodVersion()
+        if self._dict_cache is not None:
+            version, cached_mod_versions, message = self._dict_cache
+            if version == self.version and cached_mod_versions is mod_versions:
+                return message
+        message = self._to_dict(mod_versions)
+        self._dict_cache = (self.version, mod_versions, message)
+        return message
+
+    def _to_dict(self, mod_versions):
+        players = self.players
+        teams = {}
+        for player in players:
+            team = self.get_player_option(player.id, 'Team')
+            teams.setdefault(team, []).append(player.login)
         client_state = {
             GameState.LOBBY: 'open',
             GameState.LIVE: 'closed',
@@ -538,19 +604,15 @@ class Game(BaseGame):
             "title": self.name,
             "state": client_state,
             "featured_mod": self.game_mode,
-            "featured_mod_versions": self.getGamemodVersion(),
+            "featured_mod_versions": mod_versions,
             "sim_mods": self.mods,
             "map_file_path": self.map_file_path.lower(),
             "host": self.host.login if self.host else '',
-            "num_players": len(self.players),
+            "num_players": len(players),
             "game_type": self.gameType,
             "options": self.options,
             "max_players": self.max_players,
-            "teams": {
-                team: [player.login for player in self.players
-                       if self.get_player_option(player.id, 'Team') == team]
-                for team in self.teams
-            }
+            "teams": teams
         }
 
     def setGameMap(self, map):
@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+
+class GameFilter(namedtuple('GameFilter', 'state featured_mod map_file_path password_protected '
+                                          'rating_min rating_max')):
+    """
+    What a client subscribed to the game list wants to hear about
+
+    Every field is optional, None matches anything.
+    """
+    STATES = ('open', 'closed')
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Build a filter from a game_subscribe message
+
+        :raise ValueError: on malformed filters
+        """
+        state = message.get('state')
+        if state is not None and state not in cls.STATES:
+            raise ValueError("Invalid game state filter: {}".format(state))
+        featured_mod = message.get('featured_mod')
+        map_file_path = message.get('map')
+        password_protected = message.get('password_protected')
+        rating_min = message.get('rating_min')
+        rating_max = message.get('rating_max')
+        return cls(state=state,
+                   featured_mod=str(featured_mod) if featured_mod is not None else None,
+                   map_file_path=str(map_file_path).lower() if map_file_path is not None else None,
+                   password_protected=bool(password_protected) if password_protected is not None else None,
+                   rating_min=float(rating_min) if rating_min is not None else None,
+                   rating_max=float(rating_max) if rating_max is not None else None)
+
+    def matches(self, game):
+        """
+        :param Game game:
+        :return bool: whether game passes the filter
+        """
+        if self.featured_mod is not None and game.game_mode != self.featured_mod:
+            return False
+        info = game.to_dict()
+        if self.state is not None and info['state'] != self.state:
+            return False
+        if self.map_file_path is not None and info['map_file_path'] != self.map_file_path:
+            return False
+        if self.password_protected is not None and info['password_protected'] != self.password_protected:
+            return False
+        if self.rating_min is not None or self.rating_max is not None:
+            if game.host is None:
+                return False
+            mean, deviation = game.host.global_rating
+            rating = mean - 3 * deviation
+            if self.rating_min is not None and rating < self.rating_min:
+                return False
+            if self.rating_max is not None and rating > self.rating_max:
+                return False
+        return True
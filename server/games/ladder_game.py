@@ -9,7 +9,6 @@ logger = logging.getLogger(__name__)
 
 from .game import Game, ValidityState
 
-import operator
 import config
 
 
@@ -46,9 +45,12 @@ class LadderGame(Game):
             return
 
         # The highest league of any player in the game, and a flag indicating if all players are in
-        # the same league.
-        maxleague = max(iter(self.players), key=operator.itemgetter("league"))
-        evenLeague = all(self.players, lambda p: p.league == self.players[0].league)
+        # the same league. Players without a league yet are below all of them.
+        leagues = set(player.league for player in self.players)
+        ranked = [league for league in leagues if league is not None]
+        maxleague = max(ranked) if ranked else None
+        evenLeague = len(leagues) == 1
+        leaderboard = self.game_service.ladder_leaderboard
 
         with (yield from db.db_pool) as conn:
             with (yield from conn.cursor()) as cursor:
@@ -69,15 +71,19 @@ class LadderGame(Game):
                                 score_change = 0
 
                     yield from cursor.execute("UPDATE {} "
-                                              "SET score = GREATEST(0, (score + %s))"
+                                              "SET score = GREATEST(0, (score + %s)) "
                                               "WHERE idUser = %s".format(config.LADDER_SEASON),
                                               (score_change, player.id))
 
-                    yield from cursor.execute("SELECT league, score FROM {}"
+                    yield from cursor.execute("SELECT league, score FROM {} "
                                               "WHERE `idUser` = %s".format(config.LADDER_SEASON),
                                               (player.id, ))
 
-                    pleague, pscore = yield from cursor.fetchone()
+                    row = yield from cursor.fetchone()
+                    if row is None:
+                        # Not playing in this season yet, so there is no score to move
+                        continue
+                    pleague, pscore = row
                     # Minimum scores, by league, to move to next league
                     # But, but, these are defined in the database (threshold values)
                     #  Why are they hardcoded here?!
@@ -89,17 +95,15 @@ class LadderGame(Game):
                     league_incr_min = {1: 50, 2: 75, 3: 100, 4: 150}
                     if pleague in league_incr_min and pscore > league_incr_min[pleague]:
                         pleague += 1
-                        yield from cursor.execute("UPDATE {} SET league = %s, score = 0"
+                        pscore = 0
+                        yield from cursor.execute("UPDATE {} SET league = %s, score = 0 "
                                                   "WHERE `idUser` = %s".format(config.LADDER_SEASON),
-                                                  (player.id, pleague))
+                                                  (pleague, player.id))
 
-                    yield from cursor.execute("SELECT name "
-                                              "FROM `ladder_division` "
-                                              "WHERE `league` = ? AND threshold >= ?"
-                                              "ORDER BY threshold ASC LIMIT 1",
-                                              (pleague, pscore))
-
-                    player.division = yield from cursor.fetchone()
+                    leaderboard.update(player.id, pleague, pscore)
+                    division = leaderboard.division(player.id)
+                    if division is not None:
+                        player.league, player.division, _ = division
 
     @property
     def is_draw(self):
@@ -0,0 +1,128 @@
+import asyncio
+import bisect
+from collections import defaultdict
+
+import config
+import server.db as db
+from server.decorators import with_logger
+
+
+@with_logger
+class LadderLeaderboard:
+    """
+    In-memory standings of the current ladder season
+
+    Holds the league and score of everybody in config.LADDER_SEASON and, per
+    league, everybody ordered by score, so places in a league or division are
+    found by bisection rather than by sorting a whole league in the database.
+    A player is in the division of their league with the lowest
+    ladder_division threshold at or above their score, so every division is
+    a contiguous stretch of its league's standings.
+
+    Loaded by refresh() and kept current by update() as ladder games end.
+    """
+    def __init__(self):
+        # Player id -> (league, score)
+        self._scores = dict()
+        # League -> [(-score, player id)], sorted, so the best come first
+        self._standings = defaultdict(list)
+        # League -> [(threshold, division name)], sorted
+        self._divisions = dict()
+
+    def __len__(self):
+        return len(self._scores)
+
+    @asyncio.coroutine
+    def refresh(self):
+        """
+        Reload the divisions and the whole season from the database
+        """
+        with (yield from db.db_pool) as conn:
+            cursor = yield from conn.cursor()
+            yield from cursor.execute("SELECT league, threshold, name FROM ladder_division")
+            division_rows = yield from cursor.fetchall()
+            yield from cursor.execute("SELECT idUser, league, score FROM {}".format(config.LADDER_SEASON))
+            score_rows = yield from cursor.fetchall()
+
+        divisions = defaultdict(list)
+        for league, threshold, name in division_rows:
+            divisions[int(league)].append((int(threshold), str(name)))
+        scores = dict()
+        standings = defaultdict(list)
+        for player_id, league, score in score_rows:
+            scores[player_id] = (int(league), float(score))
+            standings[int(league)].append((-float(score), player_id))
+        for entries in divisions.values():
+            entries.sort()
+        for entries in standings.values():
+            entries.sort()
+
+        self._divisions = dict(divisions)
+        self._scores = scores
+        self._standings = standings
+        self._logger.debug("Loaded {} ladder players in {} leagues".format(len(scores), len(standings)))
+
+    def update(self, player_id, league, score):
+        """
+        Record the new league and score of player_id
+        """
+        score = float(score)
+        old = self._scores.get(player_id)
+        if old is not None:
+            old_league, old_score = old
+            entries = self._standings[old_league]
+            del entries[bisect.bisect_left(entries, (-old_score, player_id))]
+        self._scores[player_id] = (league, score)
+        bisect.insort(self._standings[league], (-score, player_id))
+
+    def score(self, player_id):
+        """
+        :return (int, float): league and score of player_id, None if not in the ladder
+        """
+        return self._scores.get(player_id)
+
+    def division(self, player_id):
+        """
+        :return (int, str, int): league, division name and division threshold of player_id,
+                                 None if not in the ladder or above every threshold
+        """
+        entry = self._scores.get(player_id)
+        if entry is None:
+            return None
+        league, score = entry
+        divisions = self._divisions.get(league, ())
+        i = bisect.bisect_left(divisions, (score, ))
+        if i == len(divisions):
+            return None
+        threshold, name = divisions[i]
+        return league, name, threshold
+
+    def division_place(self, player_id):
+        """
+        :return int: 1 to 3 if player_id is in the top three of a division of at least four,
+                     None otherwise
+        """
+        division = self.division(player_id)
+        if division is None:
+            return None
+        league, _, threshold = division
+        entries = self._standings[league]
+        # Everybody at or below the threshold, best first
+        return self._place(entries, bisect.bisect_left(entries, (-threshold, )), player_id)
+
+    def league_place(self, player_id):
+        """
+        :return int: 1 to 3 if player_id is in the top three of a league of at least four,
+                     None otherwise
+        """
+        entry = self._scores.get(player_id)
+        if entry is None:
+            return None
+        return self._place(self._standings[entry[0]], 0, player_id)
+
+    def _place(self, entries, start, player_id):
+        _, score = self._scores[player_id]
+        if score <= 0 or len(entries) - start < 4:
+            return None
+        place = bisect.bisect_left(entries, (-score, player_id)) - start + 1
+        return place if place <= 3 else None
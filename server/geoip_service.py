@@ -0,0 +1,92 @@
+import socket
+import struct
+from collections import OrderedDict
+
+import pygeoip
+
+import config
+from server.decorators import with_logger
+
+
+@with_logger
+class GeoIpService:
+    """
+    Resolves the country of IPv4 addresses
+
+    The database is memory mapped rather than read in, so opening it is
+    quick and the pages are shared with any other process mapping it.
+
+    Lookups are cached by network prefix: addresses sharing their first
+    prefix bits are taken to be in the same country, so a whole /24 costs
+    one walk of the database. The cache holds the cache_size most recently
+    used prefixes.
+    """
+    def __init__(self, path=None, cache_size=None, prefix=None):
+        self.path = path if path is not None else config.GEOIP_DATABASE
+        self.cache_size = cache_size if cache_size is not None else config.GEOIP_CACHE_SIZE
+        self.prefix = prefix if prefix is not None else config.GEOIP_CACHE_PREFIX
+        self._db = pygeoip.GeoIP(self.path, pygeoip.MMAP_CACHE)
+        # Network prefix -> country code or None, least recently used first
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, ip):
+        try:
+            return struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0] >> (32 - self.prefix)
+        except (OSError, TypeError):
+            return None
+
+    def country_code(self, ip):
+        """
+        :return str: two letter country code of ip, None if unknown
+        """
+        key = self._key(ip)
+        if key is None:
+            return None
+        try:
+            country = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            country = self._lookup(ip)
+            self._cache[key] = country
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return country
+
+    def country_codes(self, ips):
+        """
+        Resolve many addresses at once, looking up each prefix once
+
+        :return dict: ip -> two letter country code, None if unknown
+        """
+        by_key = dict()
+        countries = dict()
+        for ip in ips:
+            key = self._key(ip)
+            if key is None:
+                countries[ip] = None
+            elif key not in by_key:
+                by_key[key] = countries[ip] = self.country_code(ip)
+            else:
+                countries[ip] = by_key[key]
+        return countries
+
+    def _lookup(self, ip):
+        try:
+            return self._db.country_code_by_addr(ip) or None
+        except (pygeoip.GeoIPError, OSError) as ex:
+            self._logger.debug("No country for {}: {}".format(ip, ex))
+            return None
+
+    def report(self):
+        """
+        :return str: "cached prefixes, hits/misses"
+        """
+        return "{}, {}/{}".format(len(self._cache), self.hits, self.misses)
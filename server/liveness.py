@@ -0,0 +1,140 @@
+import math
+
+import config
+from server import stats
+from server.decorators import with_logger
+
+
+class _Peer:
+    __slots__ = ('connection', 'last_seen', 'ping_sent', 'slot', 'rounds')
+
+    def __init__(self, connection, now):
+        self.connection = connection
+        self.last_seen = now
+        self.ping_sent = None
+        self.slot = None
+        self.rounds = 0
+
+
+@with_logger
+class LivenessWheel:
+    """
+    Hashed timing wheel keeping track of which connections are still there
+
+    Connections that were idle for idle seconds get a ping through their
+    send_ping method. Those that stay silent for timeout seconds more are
+    reaped through their abort method. Anything received from a connection
+    counts as a sign of life, and connections that keep talking are never
+    pinged at all.
+
+    Every connection sits in one slot of the wheel, which advances one slot
+    per tick, so each tick only looks at the connections due around then and
+    pings go out spread over time rather than all at once. Sightings just
+    update a timestamp: a connection due in a slot that turns out to have
+    been active since is moved further along instead.
+
+    Round-trip times of answered pings are recorded in server.stats.round_trips
+    by connection class.
+    """
+    def __init__(self, loop, idle=None, timeout=None, tick=1.0, slots=64):
+        self.loop = loop
+        self.idle = idle if idle is not None else config.PING_IDLE_INTERVAL
+        self.timeout = timeout if timeout is not None else config.PING_TIMEOUT
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._cursor = 0
+        # Connection -> _Peer
+        self._peers = {}
+        self._handle = None
+
+    def __len__(self):
+        return len(self._peers)
+
+    def __contains__(self, connection):
+        return connection in self._peers
+
+    def start(self):
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.tick, self.advance)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def add(self, connection):
+        peer = _Peer(connection, self.loop.time())
+        self._peers[connection] = peer
+        self._schedule(peer, self.idle)
+
+    def remove(self, connection):
+        peer = self._peers.pop(connection, None)
+        if peer is not None:
+            self._slots[peer.slot].discard(peer)
+
+    def seen(self, connection):
+        """
+        Note that connection just sent something
+        """
+        peer = self._peers.get(connection)
+        if peer is not None:
+            peer.last_seen = self.loop.time()
+            peer.ping_sent = None
+
+    def pong(self, connection):
+        """
+        Note that connection answered a ping
+        """
+        peer = self._peers.get(connection)
+        if peer is None:
+            return
+        now = self.loop.time()
+        if peer.ping_sent is not None:
+            stats.round_trips.add(type(connection).__name__, now - peer.ping_sent)
+        peer.last_seen = now
+        peer.ping_sent = None
+
+    def _schedule(self, peer, delay):
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        peer.slot = (self._cursor + ticks) % len(self._slots)
+        peer.rounds = (ticks - 1) // len(self._slots)
+        self._slots[peer.slot].add(peer)
+
+    def advance(self):
+        """
+        Move the wheel on by one slot and deal with the connections due there
+        """
+        self._handle = self.loop.call_later(self.tick, self.advance)
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        slot = self._slots[self._cursor]
+        due = []
+        for peer in slot:
+            if peer.rounds:
+                peer.rounds -= 1
+            else:
+                due.append(peer)
+        slot.difference_update(due)
+        now = self.loop.time()
+        for peer in due:
+            try:
+                self._check(peer, now)
+            except Exception as ex:  # pragma: no cover
+                self._logger.exception(ex)
+
+    def _check(self, peer, now):
+        if peer.ping_sent is not None:
+            silent = now - peer.ping_sent
+            if silent < self.timeout:
+                self._schedule(peer, self.timeout - silent)
+                return
+            self._logger.debug("No answer to ping in {:.1f}s, dropping {}".format(silent, peer.connection))
+            del self._peers[peer.connection]
+            peer.connection.abort()
+            return
+        idle = now - peer.last_seen
+        if idle < self.idle:
+            self._schedule(peer, self.idle - idle)
+            return
+        peer.ping_sent = now
+        self._schedule(peer, self.timeout)
+        peer.connection.send_ping()
@@ -12,36 +12,64 @@ import shutil
 import random
 import re
 import pymysql
-import rsa
 import time
 import smtplib
 import string
 import email
+from collections import namedtuple
 from email.mime.text import MIMEText
 
-from PySide.QtCore import QIODevice, QFile, QObject
-from PySide.QtSql import QSqlQuery
+from PySide.QtCore import QObject
 from Crypto import Random
 from Crypto.Random.random import choice
 from Crypto.Cipher import Blowfish
-from Crypto.Cipher import AES
-import pygeoip
 from server.matchmaker import Search
 
+from server import stats
 from server.decorators import timed, with_logger
+from server.games import GameFilter
 from server.games.game import GameState, VisibilityState
 from server.players import Player, PlayerState
+from server.uniqueid import UniqueIdDecoder
 import server.db as db
 from .game_service import GameService
-from passwords import PRIVATE_KEY, MAIL_ADDRESS, VERIFICATION_HASH_SECRET, VERIFICATION_SECRET_KEY
+from passwords import MAIL_ADDRESS, VERIFICATION_HASH_SECRET, VERIFICATION_SECRET_KEY
 import config
 from config import Config
-from server.protocol import QDataStreamProtocol
-
-gi = pygeoip.GeoIP('GeoIP.dat', pygeoip.MEMORY_CACHE)
+from server.protocol import QDataStreamProtocol, Upload, PROTOCOL_VERSIONS
 
 MAX_ACCOUNTS_PER_MACHINE = 3
 
+# Commands a client may send before logging in
+UNAUTHENTICATED_COMMANDS = frozenset(['hello', 'ask_session', 'create_account', 'ping', 'pong'])
+
+CommandHandler = namedtuple('CommandHandler', 'function is_coroutine requires_auth')
+
+
+def negotiate_protocol_version(message):
+    """
+    Newest protocol version we speak that is no newer than the one asked for in a hello
+
+    Clients that ask for none, or for something that isn't a version, get the legacy protocol.
+    """
+    try:
+        requested = int(message.get('protocol_version', 1))
+    except (TypeError, ValueError):
+        requested = 1
+    return max(v for v in PROTOCOL_VERSIONS if v <= max(requested, 1))
+
+
+@asyncio.coroutine
+def login_stage(name, coro):
+    """
+    Wait for coro, recording how long it took in stats.login_stages under name
+    """
+    start = time.perf_counter()
+    try:
+        return (yield from coro)
+    finally:
+        stats.login_stages.add(name, time.perf_counter() - start)
+
 
 class ClientError(Exception):
     """
@@ -59,19 +87,28 @@ class ClientError(Exception):
 @with_logger
 class LobbyConnection(QObject):
     @timed()
-    def __init__(self, loop, context=None, games: GameService=None, players=None, db=None):
+    def __init__(self, loop, context=None, games: GameService=None, players=None, presence=None,
+                 liveness=None, admission=None, uniqueid=None, geoip=None, sessions=None, writes=None):
         super(LobbyConnection, self).__init__()
         self.loop = loop
-        self.db = db
         self.game_service = games
         self.player_service = players
+        self.presence = presence
+        self.liveness = liveness
+        self.admission = admission
+        # Without a pool of its own, uniqueids are decoded right here
+        self.uniqueid = uniqueid if uniqueid is not None else UniqueIdDecoder(loop, workers=0)
+        self.geoip = geoip
+        self.sessions = sessions
+        self.writes = writes
+        self.resume_token = None
+        self._queued_login = None
         self.context = context
         self.ladderPotentialPlayers = []
         self.warned = False
         self._authenticated = False
         self.player = None
         self.logPrefix = "\t"
-        self.missedPing = 0
         self.leagueAvatar = None
         self.ip = None
         self.port = None
@@ -84,6 +121,25 @@ class LobbyConnection(QObject):
     def authenticated(self):
         return self._authenticated
 
+    @classmethod
+    def command_handlers(cls):
+        """
+        Map of command name to CommandHandler, built once per class from its command_* methods
+        """
+        handlers = cls.__dict__.get('_command_handlers')
+        if handlers is None:
+            handlers = {}
+            for attr in dir(cls):
+                if not attr.startswith('command_'):
+                    continue
+                function = getattr(cls, attr)
+                command = attr[len('command_'):]
+                handlers[command] = CommandHandler(function,
+                                                   asyncio.iscoroutinefunction(function),
+                                                   command not in UNAUTHENTICATED_COMMANDS)
+            cls._command_handlers = handlers
+        return handlers
+
     @asyncio.coroutine
     def on_connection_made(self, protocol: QDataStreamProtocol, peername: (str, int)):
         self.protocol = protocol
@@ -95,6 +151,7 @@ class LobbyConnection(QObject):
         else:
             self._logger.warning("Aborting %s. %s" % (self.ip, logspam))
         self._authenticated = False
+        self.protocol.flush()
         self.protocol.writer.write_eof()
         self.protocol.reader.feed_eof()
 
@@ -103,19 +160,39 @@ class LobbyConnection(QObject):
         """
         Dispatches incoming messages
         """
+        start = None
         try:
             cmd = message['command']
             if not isinstance(cmd, str):
                 raise ValueError("Command is not a string")
-            if not self._authenticated:
-                if cmd not in ['hello', 'ask_session', 'create_account', 'ping', 'pong']:
-                    self.abort("Message invalid for unauthenticated connection: %s" % cmd)
-            handler = getattr(self, 'command_{}'.format(cmd))
-            if asyncio.iscoroutinefunction(handler):
-                yield from handler(message)
+            handler = self.command_handlers().get(cmd)
+            if handler is None:
+                self.protocol.send_message({'command': 'invalid'})
+                self.abort("Unknown command: %s" % cmd)
+                return
+            if handler.requires_auth and not self._authenticated:
+                self.abort("Message invalid for unauthenticated connection: %s" % cmd)
+                return
+            start = time.perf_counter()
+            if handler.is_coroutine:
+                yield from handler.function(self, message)
             else:
-                handler(message)
-        except ClientError as ex:
+                handler.function(self, message)
+        except Exception as ex:
+            self.on_command_error(ex, message)
+        finally:
+            if start is not None:
+                stats.lobby_commands.add(cmd, time.perf_counter() - start)
+            # Uploads arrive as temporary files, which the handler moves into place on success
+            upload = message.get('upload') if isinstance(message, dict) else None
+            if isinstance(upload, Upload) and os.path.exists(upload.path):
+                os.remove(upload.path)
+
+    def on_command_error(self, ex, message):
+        """
+        Tell the client about an exception raised handling message, dropping it if need be
+        """
+        if isinstance(ex, ClientError):
             self.protocol.send_message(
                 {'command': 'notice',
                  'style': 'error',
@@ -123,27 +200,34 @@ class LobbyConnection(QObject):
             )
             if not ex.recoverable:
                 self.abort(ex.message)
-        except (KeyError, ValueError) as ex:
+        elif isinstance(ex, (KeyError, ValueError)):
             self._logger.exception(ex)
             self.abort("Garbage command: {}".format(message))
-        except Exception as ex:
+        else:
             self.protocol.send_message({'command': 'invalid'})
             self._logger.exception(ex)
             self.abort("Error processing command")
 
     def command_ping(self, msg):
-        self.protocol.send_raw(self.protocol.pack_message('PONG'))
+        self.protocol.send_message({'command': 'pong'})
 
     def command_pong(self, msg):
-        pass
+        if self.liveness is not None:
+            self.liveness.pong(self)
+
+    def send_ping(self):
+        self.protocol.send_message({'command': 'ping'})
 
     @asyncio.coroutine
     def command_upload_mod(self, msg): # pragma: no cover
         zipmap = msg['name']
         infos = msg['info']
-        fileDatas = msg['data']
         message = infos
 
+        if not isinstance(msg.get('upload'), Upload):
+            self.sendJSON(dict(command="notice", style="error", text=msg.get('error', "Upload failed.")))
+            return
+
         for key, readable in {
             'name': "mod name",
             'uid': "uid",
@@ -183,12 +267,7 @@ class LobbyConnection(QObject):
 
         # Yield the database connection back to the pool here, as we shouldn't hold it while doing
         # crazy expensive zipfile manipulation crap.
-        writeFile = QFile(Config['content_path'] + "vault/mods/%s" % zipmap)
-
-        if writeFile.open(QIODevice.WriteOnly):
-            writeFile.write(fileDatas)
-
-        writeFile.close()
+        shutil.move(msg['upload'].path, Config['content_path'] + "vault/mods/%s" % zipmap)
 
         if not zipfile.is_zipfile(Config['content_path'] + "vault/mods/%s" % zipmap):
             self.sendJSON(
@@ -233,15 +312,19 @@ class LobbyConnection(QObject):
 
         self.sendJSON(dict(command="notice", style="info", text="Mod correctly uploaded."))
 
+    @asyncio.coroutine
     def command_upload_map(self, msg): # pragma: no cover
         zipmap = msg['name']
         infos = msg['info']
-        fileDatas = msg['data']
 
         message = infos
 
         unranked = False
 
+        if not isinstance(msg.get('upload'), Upload):
+            self.sendJSON(dict(command="notice", style="error", text=msg.get('error', "Upload failed.")))
+            return
+
         if not 'name' in message:
             self.sendJSON(dict(command="notice", style="error", text="No map name provided."))
             return
@@ -283,30 +366,21 @@ class LobbyConnection(QObject):
         map_size_Y = str(map_size["1"])
         version = message["version"]
 
-        query = QSqlQuery(self.db)
-        query.prepare("SELECT * FROM table_map WHERE name = ? and version = ?")
-        query.addBindValue(name)
-        query.addBindValue(version)
-        query.exec_()
-        if query.size() != 0:
-            error = name + " version " + version + "already exists in the database."
-            self.sendJSON(dict(command="notice", style="error", text=error))
-            return
-
-        query.prepare("SELECT filename FROM table_map WHERE filename LIKE ?")
-        query.addBindValue("%" + zipmap + "%")
-        query.exec_()
-
-        if query.size() != 0:
-            self.sendJSON(
-                dict(command="notice", style="error", text="This map is already in the database !"))
-            return
+        with (yield from db.db_pool) as conn:
+            cursor = yield from conn.cursor()
+            yield from cursor.execute("SELECT * FROM table_map WHERE name = %s and version = %s", (name, version))
+            if cursor.rowcount > 0:
+                error = name + " version " + version + "already exists in the database."
+                self.sendJSON(dict(command="notice", style="error", text=error))
+                return
 
-        writeFile = QFile(Config['content_path'] + "vault/maps/%s" % zipmap)
+            yield from cursor.execute("SELECT filename FROM table_map WHERE filename LIKE %s", "%" + zipmap + "%")
+            if cursor.rowcount > 0:
+                self.sendJSON(
+                    dict(command="notice", style="error", text="This map is already in the database !"))
+                return
 
-        if writeFile.open(QIODevice.WriteOnly):
-            writeFile.write(fileDatas)
-        writeFile.close()
+        shutil.move(msg['upload'].path, Config['content_path'] + "vault/maps/%s" % zipmap)
 
         # Corrupt zipfile?
         if not zipfile.is_zipfile(Config['content_path'] + "vault/maps/%s" % zipmap):
@@ -359,57 +433,34 @@ class LobbyConnection(QObject):
                                 unranked = True
                     fopen.close()
 
-            # check if the map name is already there
-            gmuid = 0
-            query = QSqlQuery(self.db)
-            query.prepare("SELECT mapuid FROM table_map WHERE name = ?")
-            query.addBindValue(name)
-            query.exec_()
-            if query.size() != 0:
-                query.first()
-                gmuid = int(query.value(0))
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
 
-            else:
-                query = QSqlQuery(self.db)
-                query.prepare("SELECT MAX(mapuid) FROM table_map")
-                query.exec_()
-                if query.size() != 0:
-                    query.first()
-                    gmuid = int(query.value(0)) + 1
-
-            #add the data in the db
-            filename = "maps/%s" % zipmap
-
-            query = QSqlQuery(self.db)
-            query.prepare(
-                "INSERT INTO table_map(name,description,max_players,map_type,battle_type,map_sizeX,map_sizeY,version,filename, mapuid) VALUES (?,?,?,?,?,?,?,?,?,?)")
-            query.addBindValue(name)
-            query.addBindValue(description)
-            query.addBindValue(max_players)
-            query.addBindValue(map_type)
-            query.addBindValue(battle_type)
-            query.addBindValue(map_size_X)
-            query.addBindValue(map_size_Y)
-            query.addBindValue(version)
-            query.addBindValue(filename)
-            query.addBindValue(gmuid)
-
-            if not query.exec_():
-                self._logger.debug(query.lastError())
-
-            id = query.lastInsertId()
-
-            query.prepare("INSERT INTO `table_map_uploaders`(`mapid`, `userid`) VALUES (?,?)")
-            query.addBindValue(id)
-            query.addBindValue(self.player.id)
-            if not query.exec_():
-                self._logger.debug(query.lastError())
-
-            if unranked:
-                query.prepare("INSERT INTO `table_map_unranked`(`id`) VALUES (?)")
-                query.addBindValue(id)
-                if not query.exec_():
-                    self._logger.debug(query.lastError())
+                # check if the map name is already there
+                gmuid = 0
+                yield from cursor.execute("SELECT mapuid FROM table_map WHERE name = %s", name)
+                if cursor.rowcount > 0:
+                    (gmuid, ) = yield from cursor.fetchone()
+                    gmuid = int(gmuid)
+                else:
+                    yield from cursor.execute("SELECT MAX(mapuid) FROM table_map")
+                    (max_uid, ) = yield from cursor.fetchone()
+                    if max_uid is not None:
+                        gmuid = int(max_uid) + 1
+
+                #add the data in the db
+                filename = "maps/%s" % zipmap
+
+                yield from cursor.execute(
+                    "INSERT INTO table_map(name,description,max_players,map_type,battle_type,map_sizeX,map_sizeY,version,filename, mapuid) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                    (name, description, max_players, map_type, battle_type, map_size_X, map_size_Y, version,
+                     filename, gmuid))
+                id = cursor.lastrowid
+
+                yield from cursor.execute("INSERT INTO `table_map_uploaders`(`mapid`, `userid`) VALUES (%s,%s)",
+                                          (id, self.player.id))
+                if unranked:
+                    yield from cursor.execute("INSERT INTO `table_map_unranked`(`id`) VALUES (%s)", id)
 
         zip.close()
 
@@ -452,6 +503,7 @@ class LobbyConnection(QObject):
 
         return base64.urlsafe_b64encode(iv), base64.urlsafe_b64encode(ciphertext), verify_hex
 
+    @asyncio.coroutine
     def command_create_account(self, message):
         login = message['login']
         user_email = message['email']
@@ -475,16 +527,18 @@ class LobbyConnection(QObject):
             reply_no("Please don't use \",\" in your username.")
             return
 
-        query = QSqlQuery(self.db)
-        query.prepare("SELECT id FROM `login` WHERE LOWER(`login`) = ?")
-        query.addBindValue(login.lower())
-        if not query.exec_():
+        try:
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
+                yield from cursor.execute("SELECT id FROM `login` WHERE LOWER(`login`) = %s", login.lower())
+                taken = cursor.rowcount > 0
+        except pymysql.MySQLError as ex:
             self._logger.debug("Error inserting login %s", login)
-            self._logger.debug(query.lastError())
+            self._logger.exception(ex)
             reply_no("The server experienced an error attempting to process your request. Panic.")
             return
 
-        if query.size() != 0:
+        if taken:
             reply_no("Sorry, that username is not available.")
             return
 
@@ -612,13 +666,68 @@ Thanks,\n\
 
     @timed()
     def send_game_list(self):
-        self.protocol.send_messages([game.to_dict() for game in self.game_service.live_games])
+        self.send_games(self.game_service.live_games)
+
+    def send_games(self, games):
+        """
+        Send full game_info for games
+        """
+        protocol_class = type(self.protocol)
+        for game in games:
+            # Games that haven't changed since they were last sent to anyone are already encoded
+            encoded = self.game_service.encoded_game_info(game)
+            if protocol_class not in encoded:
+                encoded[protocol_class] = protocol_class.encode_message(self.game_service.game_info(game))
+            self.protocol.send_raw(encoded[protocol_class], key=('game_info', game.id))
+            self.protocol.games_known.add(game.id)
+
+    def command_game_subscribe(self, message):
+        """
+        Only receive game_info for games passing the filters in message
+
+        The games passing them right now are sent straight away; the client
+        should drop whatever games it knew about before.
+        """
+        try:
+            game_filter = GameFilter.from_message(message)
+        except (TypeError, ValueError) as ex:
+            raise ClientError(str(ex))
+        self.game_service.subscribe(self, game_filter)
+        self.protocol.games_known.clear()
+        self.send_games(game for game in self.game_service.matching_games(game_filter)
+                        if self.player_service.in_game_audience(self.player, game.host,
+                                                                friends_only=game.visibility == VisibilityState.FRIENDS))
+
+    def command_game_unsubscribe(self, message):
+        """
+        Go back to receiving game_info for every game, starting with the game list
+        """
+        self.game_service.unsubscribe(self)
+        self.send_game_list()
+
+    def command_game_info(self, message):
+        """
+        Resend full game_info for one game, or the whole game list
+
+        Lets a client that opted in to deltas get back in sync.
+        """
+        if 'uid' in message:
+            game = self.game_service.games.get(int(message['uid']))
+            if game is None:
+                raise ClientError("No such game: {}".format(message['uid']))
+            self.protocol.send_message(self.game_service.game_info(game))
+            self.protocol.games_known.add(game.id)
+        else:
+            self.send_game_list()
 
+    @asyncio.coroutine
     def command_social_remove(self, message):
         if "friend" in message:
             target_id = message['friend']
+            targets = self.player.friends
         elif "foe" in message:
             target_id = message['foe']
+            targets = self.player.foes
         else:
             self.abort("No-op social_remove.")
             return
@@ -626,7 +735,10 @@ Thanks,\n\
         with (yield from db.db_pool) as conn:
             cursor = yield from conn.cursor()
 
-            yield from cursor.execute("DELETE FROM friends_and_foes WHERE user_id = %s AND subject_id = %s", self.player.id, target_id)
+            yield from cursor.execute("DELETE FROM friends_and_foes WHERE user_id = %s AND subject_id = %s",
+                                      (self.player.id, target_id))
+
+        targets.discard(target_id)
 
     @timed()
     @asyncio.coroutine
@@ -634,9 +746,11 @@ Thanks,\n\
         if "friend" in message:
             status = "FRIEND"
             target_id = message['friend']
+            targets, others = self.player.friends, self.player.foes
         elif "foe" in message:
             status = "FOE"
             target_id = message['foe']
+            targets, others = self.player.foes, self.player.friends
         else:
             self.abort("No-op social_add.")
             return
@@ -644,9 +758,16 @@ Thanks,\n\
         with (yield from db.db_pool) as conn:
             cursor = yield from conn.cursor()
 
-            yield from cursor.execute("INSERT INTO friends_and_foes(user_id, subject_id, `status`) VALUES(%s, %s, %s)", self.player.id, target_id, status)
+            # A friend becoming a foe, or the other way round, only changes the status
+            yield from cursor.execute("INSERT INTO friends_and_foes(user_id, subject_id, `status`) VALUES(%s, %s, %s) "
+                                      "ON DUPLICATE KEY UPDATE `status` = VALUES(`status`)",
+                                      (self.player.id, target_id, status))
+
+        targets.add(target_id)
+        others.discard(target_id)
 
     @timed()
+    @asyncio.coroutine
     def command_admin(self, message):
         action = message['action']
 
@@ -675,14 +796,12 @@ Thanks,\n\
                     player.lobby_connection.abort()
 
             elif action == "requestavatars":
-                query = QSqlQuery(self.db)
-                query.prepare("SELECT url, tooltip FROM `avatars_list`")
-                query.exec_()
-                if query.size() > 0:
-                    avatarList = []
-                    while query.next():
-                        avatar = {"url": str(query.value(0)), "tooltip": str(query.value(1))}
-                        avatarList.append(avatar)
+                with (yield from db.db_pool) as conn:
+                    cursor = yield from conn.cursor()
+                    yield from cursor.execute("SELECT url, tooltip FROM `avatars_list`")
+                    rows = yield from cursor.fetchall()
+                if rows:
+                    avatarList = [{"url": str(url), "tooltip": str(tooltip)} for url, tooltip in rows]
 
                     jsonToSend = {"command": "admin", "avatarlist": avatarList}
                     self.sendJSON(jsonToSend)
@@ -690,26 +809,24 @@ Thanks,\n\
             elif action == "remove_avatar":
                 idavatar = message["idavatar"]
                 iduser = message["iduser"]
-                query = QSqlQuery(self.db)
-                query.prepare("DELETE FROM `avatars` WHERE `idUser` = ? AND `idAvatar` = ?")
-                query.addBindValue(iduser)
-                query.addBindValue(idavatar)
-                query.exec_()
+                with (yield from db.db_pool) as conn:
+                    cursor = yield from conn.cursor()
+                    yield from cursor.execute("DELETE FROM `avatars` WHERE `idUser` = %s AND `idAvatar` = %s",
+                                              (iduser, idavatar))
 
             elif action == "list_avatar_users":
                 avatar = message['avatar']
+                avatarList = []
+                avatarid = None
                 if avatar is not None:
-                    query = QSqlQuery(self.db)
-                    query.prepare(
-                        "SELECT `idUser`, `login`, `idAvatar` FROM `avatars` LEFT JOIN `login` ON `login`.`id` = `idUser`  WHERE `idAvatar` = (SELECT id FROM avatars_list WHERE avatars_list.url = ?)")
-                    query.addBindValue(avatar)
-                    query.exec_()
-                    if query.size() > 0:
-                        avatarList = []
-                        while query.next():
-                            avatar = {"iduser": str(query.value(0)), "login": str(query.value(1))}
-                            avatarid = query.value(2)
-                            avatarList.append(avatar)
+                    with (yield from db.db_pool) as conn:
+                        cursor = yield from conn.cursor()
+                        yield from cursor.execute(
+                            "SELECT `idUser`, `login`, `idAvatar` FROM `avatars` LEFT JOIN `login` ON `login`.`id` = `idUser`  WHERE `idAvatar` = (SELECT id FROM avatars_list WHERE avatars_list.url = %s)",
+                            avatar)
+                        rows = yield from cursor.fetchall()
+                    for iduser, login, avatarid in rows:
+                        avatarList.append({"iduser": str(iduser), "login": str(login)})
 
                 jsonToSend = {"command": "admin", "player_avatar_list": avatarList, "avatar_id": avatarid}
                 self.sendJSON(jsonToSend)
@@ -718,19 +835,16 @@ Thanks,\n\
                 who = message['user']
                 avatar = message['avatar']
 
-                query = QSqlQuery(self.db)
-                if avatar is None:
-                    query.prepare(
-                        "DELETE FROM `avatars` WHERE `idUser` = (SELECT `id` FROM `login` WHERE `login`.`login` = ?)")
-                    query.addBindValue(who)
-                    query.exec_()
-                else:
-                    query.prepare(
-                        "INSERT INTO `avatars`(`idUser`, `idAvatar`) VALUES ((SELECT id FROM login WHERE login.login = ?),(SELECT id FROM avatars_list WHERE avatars_list.url = ?)) ON DUPLICATE KEY UPDATE `idAvatar` = (SELECT id FROM avatars_list WHERE avatars_list.url = ?)")
-                    query.addBindValue(who)
-                    query.addBindValue(avatar)
-                    query.addBindValue(avatar)
-                    query.exec_()
+                with (yield from db.db_pool) as conn:
+                    cursor = yield from conn.cursor()
+                    if avatar is None:
+                        yield from cursor.execute(
+                            "DELETE FROM `avatars` WHERE `idUser` = (SELECT `id` FROM `login` WHERE `login`.`login` = %s)",
+                            who)
+                    else:
+                        yield from cursor.execute(
+                            "INSERT INTO `avatars`(`idUser`, `idAvatar`) VALUES ((SELECT id FROM login WHERE login.login = %s),(SELECT id FROM avatars_list WHERE avatars_list.url = %s)) ON DUPLICATE KEY UPDATE `idAvatar` = (SELECT id FROM avatars_list WHERE avatars_list.url = %s)",
+                            (who, avatar, avatar))
         elif self.player.mod:
             if action == "join_channel":
                 user_ids = message['user_ids']
@@ -764,69 +878,37 @@ Thanks,\n\
             raise ClientError("You are banned from FAF.\n Reason :\n {}".format(ban_reason))
 
         self._logger.debug("Login from: {}, {}".format(player_id, self.session))
-        self._authenticated = True
 
         return player_id, real_username, steamid
 
-    def decodeUniqueId(self, serialized_uniqueid):
-        try:
-            message = (base64.b64decode(serialized_uniqueid))
-
-            trailing = ord(message[0])
-
-            message = message[1:]
-
-            iv = (base64.b64decode(message[:24]))
-            encoded = message[24:-40]
-            key = (base64.b64decode(message[-40:]))
-
-            AESkey = rsa.decrypt(key, PRIVATE_KEY)
-
-            # What the hell is this?
-            cipher = AES.new(AESkey, AES.MODE_CBC, iv)
-            DecodeAES = lambda c, e: c.decrypt(base64.b64decode(e))
-            decoded = DecodeAES(cipher, encoded)[:-trailing]
-            regexp = re.compile(r'[0-9a-zA-Z\\]("")')
-            decoded = regexp.sub('"', decoded)
-            decoded = decoded.replace("\\", "\\\\")
-            regexp = re.compile('[^\x09\x0A\x0D\x20-\x7F]')
-            decoded = regexp.sub('', decoded)
-            jstring = json.loads(decoded)
-
-            if str(jstring["session"]) != str(self.session) :
-                self.sendJSON(dict(command="notice", style="error", text="Your session is corrupted. Try relogging"))
-                return None
-
-            machine = jstring["machine"]
-
-            UUID = str(machine.get('UUID', 0))
-            mem_SerialNumber = str(machine.get('mem_SerialNumber', 0))
-            DeviceID = str(machine.get('DeviceID', 0))
-            Manufacturer = str(machine.get('Manufacturer', 0))
-            Name = str(machine.get('Name', 0))
-            ProcessorId = str(machine.get('ProcessorId', 0))
-            SMBIOSBIOSVersion = str(machine.get('SMBIOSBIOSVersion', 0))
-            SerialNumber = str(machine.get('SerialNumber', 0))
-            VolumeSerialNumber = str(machine.get('VolumeSerialNumber', 0))
-
-            for i in  machine.values() :
-                low = i.lower()
-                if "vmware" in low or "virtual" in low or "innotek" in low or "qemu" in low or "parallels" in low or "bochs" in low :
-                    return "VM"
-
-            m = hashlib.md5()
-            m.update(UUID + mem_SerialNumber + DeviceID + Manufacturer + Name + ProcessorId + SMBIOSBIOSVersion + SerialNumber + VolumeSerialNumber)
-
-            return m.hexdigest(), (UUID, mem_SerialNumber, DeviceID, Manufacturer, Name, ProcessorId, SMBIOSBIOSVersion, SerialNumber, VolumeSerialNumber)
-        except Exception as ex:
-            self._logger.exception(ex)
+    def _set_league_avatar(self, place, kind, title):
+        """
+        Give the player the avatar for their place in the top three, if they made it
+        """
+        if place is None:
+            return
+        avatar = {
+            "url": str(Config['content_url'] + "avatars/" + kind + str(place) + ".png"),
+            "tooltip": "{} in my {}!".format(["First", "Second", "Third"][place - 1], title)
+        }
+        self.player.avatar = avatar
+        self.leagueAvatar = avatar
 
+    @asyncio.coroutine
     def validate_unique_id(self, cursor, player_id, steamid, encoded_unique_id):
         # Accounts linked to steam are exempt from uniqueId checking.
         if steamid:
             return True
 
-        uid_hash, hardware_info = self.decodeUniqueId(encoded_unique_id)
+        try:
+            session, uid_hash, hardware_info = yield from self.uniqueid.decode(encoded_unique_id)
+        except Exception as ex:
+            self._logger.exception(ex)
+            session = None
+
+        if session != str(self.session):
+            self.sendJSON(dict(command="notice", style="error", text="Your session is corrupted. Try relogging"))
+            return False
 
         # VM users must use steam.
         if uid_hash == "VM":
@@ -838,81 +920,128 @@ Thanks,\n\
         yield from cursor.execute("SELECT user_id FROM unique_id_users WHERE uniqueid_hash = %s", uid_hash)
 
         rows = yield from cursor.fetchall()
-        ids = rows.map(lambda x: x[0])
+        ids = [row[0] for row in rows]
 
         # Is the user we're logging in with not currently associated with this uid?
         if player_id not in ids:
             # Do we have a spare slot into which we can allocate this new account?
-            if cursor.rowcount >= MAX_ACCOUNTS_PER_MACHINE:
-                yield from cursor.execute("SELECT login FROM login WHERE id IN(%s)" % ids.join(","))
+            if len(ids) >= MAX_ACCOUNTS_PER_MACHINE:
+                yield from cursor.execute("SELECT login FROM login WHERE id IN ({})".format(
+                    ",".join(["%s"] * len(ids))), ids)
                 rows = yield from cursor.fetchall()
 
-                names = rows.map(lambda x: x[0])
+                names = [row[0] for row in rows]
 
                 self.sendJSON(dict(command="notice", style="error",
-                                   text="This computer is already associated with too many FAF accounts: %s.<br><br>You might want to try SteamLink: <a href='" +
-                                        Config['app_url'] + "faf/steam.php'>" +
-                                        Config['app_url'] + "faf/steam.php</a>" %
-                                        names.join(", ")))
+                                   text="This computer is already associated with too many FAF accounts: {}.<br><br>"
+                                        "You might want to try SteamLink: <a href='{app_url}faf/steam.php'>"
+                                        "{app_url}faf/steam.php</a>".format(", ".join(names),
+                                                                            app_url=Config['app_url'])))
 
                 return False
 
             # Is this a uuid we have never seen before?
-            if cursor.rowcount == 0:
+            if not ids:
                 # Store its component parts in the table for doing that sort of thing. (just for
                 # human-reading, really)
                 yield from cursor.execute("INSERT INTO `uniqueid` (`hash`, `uuid`, `mem_SerialNumber`, `deviceID`, `manufacturer`, `name`, `processorId`, `SMBIOSBIOSVersion`, `serialNumber`, `volumeSerialNumber`)"
-                                          "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", uid_hash, *hardware_info)
+                                          "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)", (uid_hash, ) + hardware_info)
 
             # Associate this account with this hardware hash.
-            yield from cursor.execute("INSERT INTO unique_id_users(user_id, uniqueid_hash) VALUES(%s, %s)", player_id, uid_hash)
+            yield from cursor.execute("INSERT INTO unique_id_users(user_id, uniqueid_hash) VALUES(%s, %s)", (player_id, uid_hash))
 
         # TODO: Mildly unpleasant
-        yield from cursor.execute("UPDATE login SET ip = %s WHERE id = %s", (self.ip, player_id))
+        if self.writes is not None:
+            self.writes.put("UPDATE login SET ip = %s WHERE id = %s", player_id, (self.ip, player_id))
+        else:
+            yield from cursor.execute("UPDATE login SET ip = %s WHERE id = %s", (self.ip, player_id))
 
         return True
 
-
     @asyncio.coroutine
     def command_hello(self, message):
+        # Picking up a dropped session is cheap, so it doesn't queue
+        if self.resume_session(message):
+            return
+        if self.admission is None:
+            yield from self.log_in(message)
+            return
+        if self._queued_login is not None:
+            raise ClientError("You are already logging in.")
+        # Wait for a turn alongside the read loop, so the client's pongs keep being read
+        # and a client going away while queued drops out of the queue
+        self._queued_login = asyncio.async(self.queued_log_in(message))
+
+    @asyncio.coroutine
+    def queued_log_in(self, message):
+        try:
+            with (yield from self.admission.admit(self.send_login_queue_position)):
+                yield from self.log_in(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as ex:
+            self.on_command_error(ex, message)
+        finally:
+            self._queued_login = None
+
+    def send_login_queue_position(self, position):
+        self.sendJSON(dict(command="notice", style="info",
+                           text="The server is busy logging people in. "
+                                "You are number {} in the queue.".format(position)))
+
+    def resume_session(self, message):
+        """
+        Take over the session of a dropped connection, if message carries a token resuming it
+
+        :return bool: whether the session was resumed
+        """
+        token = message.get('resume_token')
+        if self.sessions is None or token is None:
+            return False
+        resumed = self.sessions.resume(token, message['login'].strip())
+        if resumed is None:
+            return False
+        self.player, self.leagueAvatar = resumed
+        self.logPrefix = self.player.login + "\t"
+        self._logger.debug("Resumed session of: {}, {}".format(self.player.id, self.session))
+        self._authenticated = True
+
+        self.player.ip = self.ip
+        self.player.lobby_connection = self
+        self.player_service.resume_player(self.player)
+
+        self.send_welcome(message, self.player_service.get_permission_group(self.player.id))
+        return True
+
+    @asyncio.coroutine
+    def log_in(self, message):
         version = message['version']
         login = message['login'].strip()
         password = message['password']
 
         self.logPrefix = login + "\t"
+        login_start = time.perf_counter()
 
         # Check their client is reporting the right version number.
-        with (yield from db.db_pool) as conn:
-            cursor = yield from conn.cursor()
-            versionDB, updateFile = self.player_service.client_version_info
+        versionDB, updateFile = self.player_service.client_version_info
 
-            # Version of zero represents a developer build.
-            if version < versionDB and version != 0:
-                self.sendJSON(dict(command="update", update=updateFile))
-                return
+        # Version of zero represents a developer build.
+        if version < versionDB and version != 0:
+            self.sendJSON(dict(command="update", update=updateFile))
+            return
 
-            player_id, login, steamid = yield from self.check_user_login(cursor, login, password)
+        with (yield from db.db_pool) as conn:
+            cursor = yield from conn.cursor()
+            player_id, login, steamid = yield from login_stage(
+                'credentials', self.check_user_login(cursor, login, password))
 
             if not self.player_service.is_uniqueid_exempt(player_id):
                 # UniqueID check was rejected (too many accounts or tamper-evident madness)
-                if not self.validate_unique_id(cursor, player_id, steamid, message['unique_id']):
+                if not (yield from login_stage('uniqueid', self.validate_unique_id(
+                        cursor, player_id, steamid, message['unique_id']))):
                     return
 
-            # Update the user's IRC registration (why the fuck is this here?!)
-            m = hashlib.md5()
-            m.update(password.encode())
-            passwordmd5 = m.hexdigest()
-            m = hashlib.md5()
-            # Since the password is hashed on the client, what we get at this point is really
-            # md5(md5(sha256(password))). This is entirely insane.
-            m.update(passwordmd5.encode())
-            irc_pass = "md5:" + str(m.hexdigest())
-
-            try:
-                yield from cursor.execute("UPDATE anope.anope_db_NickCore SET pass = %s WHERE display = %s", (irc_pass, login))
-            except (pymysql.OperationalError, pymysql.ProgrammingError):
-                self._logger.info("Failure updating NickServ password for {}".format(login))
-
+        self._authenticated = True
         permission_group = self.player_service.get_permission_group(player_id)
         self.player = Player(login=str(login),
                              session=self.session,
@@ -922,171 +1051,63 @@ Thanks,\n\
                              permissionGroup=permission_group,
                              lobbyThread=self)
 
-        yield from self.player_service.fetch_player_data(self.player)
-
         # Country
         # -------
 
-        country = gi.country_code_by_addr(self.ip)
-        if country is not None:
-            self.player.country = str(country)
+        if self.geoip is not None:
+            self.player.country = self.geoip.country_code(self.ip)
 
         # LADDER LEAGUES ICONS
         # --------------------
-        # If a user is top of their division or league, set their avatar appropriately.
-
-        # Query to extract the user's league and division info.
-        query = QSqlQuery(self.db)
-        query.prepare(
-        "SELECT\
-          score,\
-          ladder_division.league,\
-          ladder_division.name AS division,\
-          ladder_division.threshold AS threshold`\
-        FROM\
-          %s,\
-          ladder_division\
-        WHERE\
-          %s.idUser = ? AND\
-          %s.league = ladder_division.league AND\
-          ladder_division.threshold >= %s.score\
-        ORDER BY ladder_division.threshold ASC\
-        LIMIT 1;" % (config.LADDER_SEASON, config.LADDER_SEASON, config.LADDER_SEASON, config.LADDER_SEASON))
-        query.addBindValue(self.player.id)
-        query.exec_()
-        if query.size() > 0:
-            query.first()
-            score = float(query.value(0))
-            league = int(query.value(1))
-            self.player.league = league
-            self.player.division = str(query.value(2))
-            threshold = int(query.value(3))
-
-            cancontinue = True
-            if league == 1 and score == 0:
-                cancontinue = False
-
-            # Is it just me, or is most of what follows completely bananas?
-            # I mean _honestly_.
-            if cancontinue:
-                # check if top of the division :
-                query.prepare(
-                    "SELECT score, idUser FROM %s WHERE score <= ? and league = ? ORDER BY score DESC" % config.LADDER_SEASON)
-                query.addBindValue(threshold)
-                query.addBindValue(league)
-                #query.addBindValue(self.player.getId())
-                query.exec_()
-
-                if query.size() >= 4:
-                    query.first()
-                    for i in range(1, 4):
-
-                        score = float(query.value(0))
-                        idUser = int(query.value(1))
-
-                        if idUser != self.player.id or score <= 0:
-                            query.next()
-                            continue
-
-                        avatar = {
-                            "url": str(Config['content_url'] + "avatars/div" + str(i) + ".png")
-                        }
-                        if i == 1:
-                            avatar.tooltip = "First in my division!"
-                        elif i == 2:
-                            avatar.tooltip = "Second in my division!"
-                        elif i == 3:
-                            avatar.tooltip = "Third in my division!"
-
-                        self.player.avatar = avatar
-                        self.leagueAvatar = avatar
-
-                        break
-
-                # check if top of the league :
-                query.prepare(
-                    "SELECT score, idUser FROM %s  WHERE league = ? ORDER BY score DESC" % config.LADDER_SEASON)
-                query.addBindValue(league)
-                query.exec_()
-                if query.size() >= 4:
-                    query.first()
-                    for i in range(1, 4):
-                        score = float(query.value(0))
-                        idUser = int(query.value(1))
-
-                        if idUser != self.player.id or score <= 0:
-                            query.next()
-                            continue
-
-                        avatar = {
-                            "url": str(Config['content_url'] + "avatars/league" + str(i) + ".png")
-                        }
-                        if i == 1:
-                            avatar.tooltip = "First in my League!"
-                        elif i == 2:
-                            avatar.tooltip = "Second in my League!"
-                        elif i == 3:
-                            avatar.tooltip = "Third in my League!"
-
-                        self.player.avatar = avatar
-                        self.leagueAvatar = avatar
-                        break
-
-        ## AVATARS
-        ## -------------------
-        query.prepare(
-            "SELECT url, tooltip FROM `avatars` LEFT JOIN `avatars_list` ON `idAvatar` = `avatars_list`.`id` WHERE `idUser` = ? AND `selected` = 1")
-        query.addBindValue(self.player.id)
-        query.exec_()
-        if query.size() > 0:
-            query.first()
-            avatar = {"url": str(query.value(0)), "tooltip": str(query.value(1))}
+        self.assign_league(self.player)
+
+        # Everything else about the player is independent, so it is looked up all at once,
+        # each on a connection of its own
+        _, _, avatar, (friends, foes), _ = yield from asyncio.gather(
+            login_stage('ratings', self.player_service.fetch_ratings(self.player)),
+            login_stage('clan', self.player_service.fetch_clan(self.player)),
+            login_stage('avatar', self.fetch_avatar(self.player)),
+            login_stage('social', self.fetch_social(self.player)),
+            login_stage('irc', self.update_irc_password(login, password)))
+
+        # The avatar picked by the player wins over any league avatar
+        if avatar is not None:
             self.player.avatar = avatar
+        self.player.friends = set(friends)
+        self.player.foes = set(foes)
 
         self.player_service.addUser(self.player)
 
-        self.sendJSON(dict(command="welcome", id=self.player.id, login=login))
-
-        # Tell player about everybody online
-        self.sendJSON(
-            {
-                "command": "player_info",
-                "players": [player.to_dict() for player in self.player_service]
-            }
-        )
-
-        # Tell everyone else online about us
-        # FIXME: Introduce a system akin to dirty_games
-        player_info = self.player.to_dict()
-        for player in self.player_service:
-            if player != self.player:
-                lobby = player.lobby_connection
-                if lobby is not None:
-                    lobby.sendJSON(
-                        {
-                            "command": "player_info",
-                            "players": [player_info]
-                        }
-                    )
+        self.send_welcome(message, permission_group)
 
-        friends = []
-        foes = []
-        query = QSqlQuery(self.db)
-        query.prepare("SELECT `subject_id`, `status` FROM friends_and_foes WHERE user_id = ?")
-        query.addBindValue(self.player.id)
-        query.exec_()
+        # Tell everyone else online about us, along with whoever else logged in around now
+        if self.presence is not None:
+            self.presence.player_online(self.player)
 
-        while query.next():
-            target_id = query.value(0)
-            status = query.value(1)
+        stats.login_stages.add('total', time.perf_counter() - login_start)
 
-            if status == "FRIEND":
-                friends.append(target_id)
-            else:
-                foes.append(target_id)
+    def send_welcome(self, message, permission_group):
+        """
+        Welcome the client of a player that just logged in or resumed, and tell it everything it needs to know
+        """
+        welcome = dict(command="welcome", id=self.player.id, login=self.player.login)
+        if self.sessions is not None:
+            self.resume_token = self.sessions.issue(self.player)
+            welcome['resume_token'] = self.resume_token
+        protocol_version = negotiate_protocol_version(message)
+        if protocol_version != 1:
+            welcome['protocol_version'] = protocol_version
+        self.sendJSON(welcome)
+
+        # The welcome still goes out in the legacy protocol, everything after it in the negotiated one
+        if protocol_version != 1:
+            self.protocol = self.context.upgrade_protocol(self, PROTOCOL_VERSIONS[protocol_version])
+        self.protocol.game_info_deltas = bool(message.get('game_info_deltas'))
 
-        self.player.friends = set(friends)
-        self.player.foes = set(foes)
+        # Tell player about everybody online
+        self.protocol.send_raw(self.player_service.encoded_online_players(type(self.protocol)))
+        if self.presence is not None:
+            self.presence.online_players_sent()
 
         self.send_mod_list()
         self.send_game_list()
@@ -1099,15 +1120,97 @@ Thanks,\n\
         if self.player.clan is not None:
             channels.append("#%s_clan" % self.player.clan)
 
-        jsonToSend = {"command": "social", "autojoin": channels, "channels": channels, "friends": friends, "foes": foes, "power": permission_group}
+        jsonToSend = {"command": "social", "autojoin": channels, "channels": channels,
+                      "friends": list(self.player.friends), "foes": list(self.player.foes), "power": permission_group}
         self.sendJSON(jsonToSend)
 
+    @asyncio.coroutine
+    def update_irc_password(self, login, password):
+        """
+        Update the user's IRC registration (why the fuck is this here?!)
+
+        Only queued if there is a write-behind queue, done right away otherwise.
+        """
+        m = hashlib.md5()
+        m.update(password.encode())
+        passwordmd5 = m.hexdigest()
+        m = hashlib.md5()
+        # Since the password is hashed on the client, what we get at this point is really
+        # md5(md5(sha256(password))). This is entirely insane.
+        m.update(passwordmd5.encode())
+        irc_pass = "md5:" + str(m.hexdigest())
+
+        if self.writes is not None:
+            self.writes.put("UPDATE anope.anope_db_NickCore SET pass = %s WHERE display = %s", login, (irc_pass, login))
+            return
+
+        with (yield from db.db_pool) as conn:
+            cursor = yield from conn.cursor()
+            try:
+                yield from cursor.execute("UPDATE anope.anope_db_NickCore SET pass = %s WHERE display = %s", (irc_pass, login))
+            except (pymysql.OperationalError, pymysql.ProgrammingError):
+                self._logger.info("Failure updating NickServ password for {}".format(login))
+
+    def assign_league(self, player):
+        """
+        Set the ladder league and division of player from the leaderboard
+
+        If a user is top of their division or league, set their avatar appropriately.
+        """
+        leaderboard = self.game_service.ladder_leaderboard
+        division = leaderboard.division(player.id)
+        if division is None:
+            return
+        league, player.division, _ = division
+        player.league = league
+        _, score = leaderboard.score(player.id)
+
+        if league == 1 and score == 0:
+            return
+
+        self._set_league_avatar(leaderboard.division_place(player.id), "div", "division")
+        self._set_league_avatar(leaderboard.league_place(player.id), "league", "League")
+
+    @asyncio.coroutine
+    def fetch_avatar(self, player):
+        """
+        :return dict: the avatar selected by player, None if there is none
+        """
+        with (yield from db.db_pool) as conn:
+            cursor = yield from conn.cursor()
+            yield from cursor.execute(
+                "SELECT url, tooltip FROM `avatars` LEFT JOIN `avatars_list` ON `idAvatar` = `avatars_list`.`id` WHERE `idUser` = %s AND `selected` = 1",
+                player.id)
+            if cursor.rowcount == 0:
+                return None
+            url, tooltip = yield from cursor.fetchone()
+            return {"url": str(url), "tooltip": str(tooltip)}
+
+    @asyncio.coroutine
+    def fetch_social(self, player):
+        """
+        :return ([int], [int]): ids of the friends and foes of player
+        """
+        friends = []
+        foes = []
+        with (yield from db.db_pool) as conn:
+            cursor = yield from conn.cursor()
+            yield from cursor.execute("SELECT `subject_id`, `status` FROM friends_and_foes WHERE user_id = %s",
+                                      player.id)
+            for target_id, status in (yield from cursor.fetchall()):
+                if status == "FRIEND":
+                    friends.append(target_id)
+                else:
+                    foes.append(target_id)
+        return friends, foes
+
     @timed
     def command_ask_session(self, message):
         jsonToSend = {"command": "session", "session": self.session}
         self.sendJSON(jsonToSend)
 
     @timed
+    @asyncio.coroutine
     def command_avatar(self, message):
         action = message['action']
 
@@ -1116,16 +1219,14 @@ Thanks,\n\
             if self.leagueAvatar:
                 avatarList.append(self.leagueAvatar)
 
-            query = QSqlQuery(self.db)
-            query.prepare(
-                "SELECT url, tooltip FROM `avatars` LEFT JOIN `avatars_list` ON `idAvatar` = `avatars_list`.`id` WHERE `idUser` = ?")
-            query.addBindValue(self.player.id)
-            query.exec_()
-            if query.size() > 0:
-
-                while query.next():
-                    avatar = {"url": str(query.value(0)), "tooltip": str(query.value(1))}
-                    avatarList.append(avatar)
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
+                yield from cursor.execute(
+                    "SELECT url, tooltip FROM `avatars` LEFT JOIN `avatars_list` ON `idAvatar` = `avatars_list`.`id` WHERE `idUser` = %s",
+                    self.player.id)
+                rows = yield from cursor.fetchall()
+            for url, tooltip in rows:
+                avatarList.append({"url": str(url), "tooltip": str(tooltip)})
 
             if len(avatarList) > 0:
                 jsonToSend = {"command": "avatar", "avatarlist": avatarList}
@@ -1134,20 +1235,14 @@ Thanks,\n\
         elif action == "select":
             avatar = message['avatar']
 
-            query = QSqlQuery(self.db)
-
-            # remove old avatar
-            query.prepare(
-                "UPDATE `avatars` SET `selected` = 0 WHERE `idUser` = ?")
-            query.addBindValue(self.player.id)
-            query.exec_()
-            if avatar is not None:
-                query = QSqlQuery(self.db)
-                query.prepare(
-                    "UPDATE `avatars` SET `selected` = 1 WHERE `idAvatar` = (SELECT id FROM avatars_list WHERE avatars_list.url = ?) and `idUser` = ?")
-                query.addBindValue(avatar)
-                query.addBindValue(self.player.id)
-                query.exec_()
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
+                # remove old avatar
+                yield from cursor.execute("UPDATE `avatars` SET `selected` = 0 WHERE `idUser` = %s", self.player.id)
+                if avatar is not None:
+                    yield from cursor.execute(
+                        "UPDATE `avatars` SET `selected` = 1 WHERE `idAvatar` = (SELECT id FROM avatars_list WHERE avatars_list.url = %s) and `idUser` = %s",
+                        (avatar, self.player.id))
         else:
             raise KeyError('invalid action')
 
@@ -1343,5 +1438,25 @@ Thanks,\n\
             self._logger.exception(ex)
 
     def on_connection_lost(self):
+        if self.game_service is not None:
+            self.game_service.unsubscribe(self)
+        if self._queued_login is not None:
+            # Still queued or logging in, so nobody has seen the player online yet
+            self._queued_login.cancel()
+            return
         if self.player:
-            self.player_service.remove_player(self.player)
+            # Dropped rather than thrown out, so the client gets a while to come back
+            if self._authenticated and self.sessions is not None and \
+                    self.sessions.suspend(self.resume_token, self.player, self.leagueAvatar, self.end_session):
+                self.player_service.suspend_player(self.player)
+                return
+            if self.sessions is not None:
+                self.sessions.revoke(self.player, self.resume_token)
+            # Unless the player logged in again before this connection was found to be gone
+            if self.player_service.players.get(self.player.id) is self.player:
+                self.end_session(self.player)
+
+    def end_session(self, player):
+        self.player_service.remove_player(player)
+        if self.presence is not None:
+            self.presence.player_offline(player)
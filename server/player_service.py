@@ -1,9 +1,11 @@
 import aiomysql
 import asyncio
+from collections import OrderedDict
 import aiocron
 import marisa_trie
 import pymysql
 from server.matchmaker import MatchmakerQueue
+from server.protocol import codec
 
 
 class PlayerService:
@@ -11,6 +13,14 @@ class PlayerService:
         self.players = dict()
         self.db_pool = db_pool
 
+        # Lobby connections of the players online, by player id
+        self._lobby_connections = dict()
+
+        # player_info of the players online, by player id, each already serialized to JSON
+        self._player_info = OrderedDict()
+        # The player_info message listing all of them, encoded per protocol class
+        self._online_players_encoded = dict()
+
         # Static-ish data fields.
         self.privileged_users = {}
         self.uniqueid_exempt = {}
@@ -47,21 +57,34 @@ class PlayerService:
             yield from cursor.execute('UPDATE `{}_rating` '
                                       'SET mean=%s, deviation=%s '
                                       'WHERE id=%s', (mean, deviation, player.id))
+        self.player_info_changed(player)
 
     @asyncio.coroutine
     def fetch_player_data(self, player):
+        """
+        Load the ratings and clan of player, over two pooled connections at once
+        """
+        yield from asyncio.gather(self.fetch_ratings(player), self.fetch_clan(player))
+
+    @asyncio.coroutine
+    def fetch_ratings(self, player):
         with (yield from self.db_pool) as conn:
             cur = yield from conn.cursor()
-            yield from cur.execute('SELECT mean, deviation, numGames FROM `global_rating` '
-                                   'WHERE id=%s', player.id)
-            (mean, dev, num_games) = yield from cur.fetchone()
+            yield from cur.execute('SELECT global.mean, global.deviation, global.numGames, '
+                                   'ladder.mean, ladder.deviation '
+                                   'FROM `global_rating` AS global '
+                                   'LEFT JOIN `ladder1v1_rating` AS ladder ON ladder.id = global.id '
+                                   'WHERE global.id=%s', player.id)
+            (mean, dev, num_games, ladder_mean, ladder_dev) = yield from cur.fetchone()
             player.global_rating = (mean, dev)
             player.numGames = num_games
-            yield from cur.execute('SELECT mean, deviation FROM `ladder1v1_rating` '
-                                   'WHERE id=%s', player.id)
-            player.ladder_rating = yield from cur.fetchone()
+            if ladder_mean is not None:
+                player.ladder_rating = (ladder_mean, ladder_dev)
 
-            ## Clan informations
+    @asyncio.coroutine
+    def fetch_clan(self, player):
+        with (yield from self.db_pool) as conn:
+            cur = yield from conn.cursor()
             try:
                 yield from cur.execute(
                     "SELECT `clan_tag` "
@@ -75,9 +98,86 @@ class PlayerService:
 
     def addUser(self, newplayer):
         self.players[newplayer.id] = newplayer
+        lobby = newplayer.lobby_connection
+        if lobby is not None:
+            self._lobby_connections[newplayer.id] = lobby
+        self._player_info[newplayer.id] = codec.dumps(newplayer.to_dict())
+        self._online_players_encoded.clear()
 
     def remove_player(self, player):
         del self.players[player.id]
+        self._lobby_connections.pop(player.id, None)
+        self._player_info.pop(player.id, None)
+        self._online_players_encoded.clear()
+
+    def suspend_player(self, player):
+        """
+        Keep player online while it has no lobby connection, see SessionService
+        """
+        self._lobby_connections.pop(player.id, None)
+
+    def resume_player(self, player):
+        """
+        Take the new lobby connection of a suspended player
+        """
+        lobby = player.lobby_connection
+        if lobby is not None and player.id in self.players:
+            self._lobby_connections[player.id] = lobby
+
+    def player_info_changed(self, player):
+        """
+        Refresh the cached player_info of player, after its ratings or the like changed
+        """
+        if player.id in self._player_info:
+            self._player_info[player.id] = codec.dumps(player.to_dict())
+            self._online_players_encoded.clear()
+
+    def encoded_online_players(self, protocol_class):
+        """
+        The player_info message listing everybody online, encoded for protocol_class
+
+        Built from the cached JSON of every player, and kept until somebody
+        logs in or out or their player_info changes.
+        """
+        encoded = self._online_players_encoded.get(protocol_class)
+        if encoded is None:
+            text = '{"command":"player_info","players":[' + ','.join(self._player_info.values()) + ']}'
+            encoded = protocol_class.encode_json(text)
+            self._online_players_encoded[protocol_class] = encoded
+        return encoded
+
+    @staticmethod
+    def in_game_audience(player, host, friends_only=False):
+        """
+        Whether player gets to see a game hosted by host, see game_audience
+        """
+        if host is None:
+            return True
+        if friends_only:
+            return player.id == host.id or player.id in host.friends
+        return player.id not in host.foes
+
+    def game_audience(self, host, friends_only=False):
+        """
+        Lobby connections that get to see a game hosted by host
+
+        Friend and foe lists are looked up in the host's own sets, so this only
+        walks the connections that actually receive the game.
+
+        :param friends_only: only the host and their friends, otherwise everybody but their foes
+        :return list: lobby connections
+        """
+        if host is None:
+            return list(self._lobby_connections.values())
+        if friends_only:
+            connections = self._lobby_connections
+            return [connections[player_id] for player_id in host.friends | {host.id}
+                    if player_id in connections]
+        foes = host.foes
+        if not foes:
+            return list(self._lobby_connections.values())
+        return [conn for player_id, conn in self._lobby_connections.items()
+                if player_id not in foes]
 
     def get_permission_group(self, user_id):
         return self.privileged_users.get(user_id, 0)
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+import config
+from server.decorators import with_logger
+
+
+@with_logger
+class PresenceService:
+    """
+    Tells everybody online about players logging in and out, in batches
+
+    Logins and logouts are collected for config.PRESENCE_INTERVAL seconds and
+    then go out as one player_info broadcast, encoded once per protocol:
+
+        {"command": "player_info", "players": [...], "offline": ["login", ...]}
+
+    "offline" is only present if somebody announced earlier, or sent to a
+    newcomer in the list of everybody online, has left.
+    """
+    def __init__(self, context, loop, interval=None):
+        self.context = context
+        self.loop = loop
+        self.interval = interval if interval is not None else config.PRESENCE_INTERVAL
+        # Player id -> Player, for players to announce
+        self._online = OrderedDict()
+        # Player id -> login, for announced players that left
+        self._offline = OrderedDict()
+        # Ids of the players everybody has been told about
+        self._announced = set()
+        # Ids of players yet to be announced that some newcomer was already told about
+        self._listed = set()
+        self._flush_handle = None
+
+    def player_online(self, player):
+        self._offline.pop(player.id, None)
+        self._online[player.id] = player
+        self._schedule_flush()
+
+    def player_offline(self, player):
+        # Nobody needs to hear about a player that left before anybody heard of it
+        self._online.pop(player.id, None)
+        if player.id in self._announced or player.id in self._listed:
+            self._offline[player.id] = player.login
+            self._schedule_flush()
+
+    def online_players_sent(self):
+        """
+        Note that a newcomer was just sent the list of everybody online,
+        players yet to be announced included
+        """
+        self._listed.update(self._online.keys())
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        """
+        Broadcast the logins and logouts collected so far
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._online and not self._offline:
+            return
+        message = {
+            'command': 'player_info',
+            'players': [player.to_dict() for player in self._online.values()]
+        }
+        if self._offline:
+            message['offline'] = list(self._offline.values())
+        self._announced.update(self._online.keys())
+        self._announced.difference_update(self._offline.keys())
+        self._logger.debug("Announcing {} players online, {} offline"
+                           .format(len(self._online), len(self._offline)))
+        self._online.clear()
+        self._offline.clear()
+        self._listed.clear()
+        self.context.broadcast(message, lambda lobby_conn: lobby_conn.authenticated)
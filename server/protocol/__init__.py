@@ -1,2 +1,11 @@
-from .protocol import QDataStreamProtocol
+from . import codec
+from .protocol import Protocol, QDataStreamProtocol, Upload, conflation_key
+from .simple_json import SimpleJsonProtocol
 from .gpgnet import GpgNetClientProtocol, GpgNetServerProtocol
+
+# Wire protocols a lobby client can negotiate in its hello, by version number.
+# Connections always start out speaking version 1.
+PROTOCOL_VERSIONS = {
+    1: QDataStreamProtocol,
+    2: SimpleJsonProtocol
+}
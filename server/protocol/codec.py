@@ -0,0 +1,68 @@
+"""
+JSON codec shared by every protocol path
+
+Uses orjson when it is installed and falls back to the standard library.
+Whatever the fast path refuses (NaN, lone surrogates, oversized integers)
+is retried with the standard library, so the two accept the same messages.
+The one visible difference is that orjson writes NaN and Infinity as null.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Teams and mod versions are keyed by ints (and sometimes None) in our messages,
+# which the standard library stringifies and orjson only does when asked to.
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+BACKEND = 'orjson' if orjson else 'json'
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def _stdlib_loads(data):
+    if not isinstance(data, str):
+        data = str(data, 'UTF-8')
+    return json.loads(data)
+
+
+def dumps_bytes(obj) -> bytes:
+    """
+    Encode obj as compact UTF-8 JSON
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+        except TypeError:
+            pass
+    return _stdlib_dumps(obj).encode('UTF-8')
+
+
+def dumps(obj) -> str:
+    """
+    Encode obj as compact JSON text
+    """
+    if orjson:
+        try:
+            return str(orjson.dumps(obj, option=_ORJSON_OPTIONS), 'UTF-8')
+        except TypeError:
+            pass
+    return _stdlib_dumps(obj)
+
+
+def loads(data):
+    """
+    Decode JSON from a str, bytes or memoryview
+
+    Raises ValueError on malformed input, like json.loads.
+    """
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return _stdlib_loads(data)
@@ -1,54 +1,295 @@
-from abc import ABCMeta
+from abc import ABCMeta, abstractmethod
 
 from asyncio import StreamReader, StreamWriter
 import asyncio
+import itertools
+import os
 import struct
-import json
+import tempfile
+from collections import OrderedDict, namedtuple
+
+import config
 from server.decorators import with_logger
+from . import codec
 
-@with_logger
-class QDataStreamProtocol(metaclass=ABCMeta):
+_UINT32 = struct.Struct('!I')
+_INT32 = struct.Struct('!i')
+_PLACEHOLDER = bytes(4)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# A file streamed to disk by QDataStreamProtocol.read_upload.
+# Only ever constructed by the protocol, so a message can't claim one by way of JSON.
+Upload = namedtuple('Upload', 'path size')
+
+
+def conflation_key(message: dict):
     """
-    Implements the legacy QDataStream-based encoding scheme
+    Identify messages that supersede earlier ones with the same key
+
+    A queued message is dropped when a newer one with the same key is sent
+    before the queue has been flushed. game_info deltas only make sense on
+    top of what came before them, so they never conflate.
+
+    :return: hashable key, or None if the message can't be conflated
     """
-    def __init__(self, reader: StreamReader, writer: StreamWriter):
+    command = message.get('command')
+    if command == 'game_info':
+        if message.get('delta'):
+            return None
+        return command, message.get('uid')
+    elif command == 'player_info':
+        players = message.get('players')
+        # Batches announcing players going offline carry more than the one player
+        if players and len(players) == 1 and not message.get('offline'):
+            return command, players[0].get('login')
+    return None
+
+
+class Protocol(metaclass=ABCMeta):
+    """
+    Base class for the wire protocols spoken over a pair of asyncio streams
+
+    Subclasses define the framing by implementing read_message and encode_messages.
+
+    Outgoing messages are queued and flushed to the writer once per event
+    loop iteration, with a single writelines call.
+    """
+    def __init__(self, reader: StreamReader, writer: StreamWriter, loop=None):
         """
         Initialize the protocol
 
         :param StreamReader reader: asyncio stream to read from
+        :param StreamWriter writer: asyncio stream to write to
+        :param loop: event loop to schedule flushes on
         """
         self.reader = reader
         self.writer = writer
+        self.loop = loop or asyncio.get_event_loop()
+        # Maps a conflation key (or a unique sequence number) to either a
+        # message dict that is yet to be encoded, or already encoded bytes.
+        self._outbox = OrderedDict()
+        self._outbox_seq = itertools.count()
+        self._flush_handle = None
+        self.messages_conflated = 0
+
+        # Broadcast traffic held back while the transport is congested
+        self._deferred = OrderedDict()
+        self.messages_dropped = 0
+        # Loop time at which the write buffer went over the hard limit, if it is now
+        self.over_limit_since = None
+
+        # Whether the client asked for game_info deltas, and the games it holds
+        # a full game_info for that they can be applied to
+        self.game_info_deltas = False
+        self.games_known = set()
+
+        # Called without arguments as the parts of a long message, like an upload, arrive
+        self.on_data = None
+        # Cleared when the rest of a block is left unread, after which nothing more can be read
+        self.in_sync = True
+
+    @abstractmethod
+    def read_message(self):
+        """
+        Coroutine reading a single message from the stream
+
+        :return dict: Parsed message
+        """
+        pass  # pragma: no cover
+
+    @classmethod
+    @abstractmethod
+    def encode_messages(cls, messages):
+        """
+        Encode a batch of messages into a single buffer
+
+        :param messages: iterable of dicts
+        :return: bytes-like object ready to be written to the transport
+        """
+        pass  # pragma: no cover
+
+    @classmethod
+    def encode_message(cls, message: dict):
+        return cls.encode_messages((message, ))
+
+    @classmethod
+    @abstractmethod
+    def encode_json(cls, text: str):
+        """
+        Encode a single message that is already serialized to JSON
+
+        :return: bytes-like object ready to be written to the transport
+        """
+        pass  # pragma: no cover
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+        Flush queued messages and await the write buffer to empty.
+
+        See StreamWriter.drain()
+        """
+        self.flush()
+        yield from self.writer.drain()
+
+    def close(self):
+        """
+        Flush queued messages and close writer stream
+        :return:
+        """
+        self.flush()
+        self.writer.close()
+
+    def send_message(self, message: dict):
+        """
+        Queue message for sending
+
+        Encoding is deferred until the queue is flushed, so the message must
+        not be modified after it has been handed over.
+        """
+        self._enqueue(conflation_key(message), message)
+
+    def send_messages(self, messages):
+        for message in messages:
+            self._enqueue(conflation_key(message), message)
+
+    def send_raw(self, data, key=None):
+        """
+        Write already encoded data to the stream, verbatim
+
+        :param key: conflation key of the encoded message, if any
+        """
+        self._enqueue(key, data)
+
+    def _enqueue(self, key, entry):
+        if key is None:
+            key = next(self._outbox_seq)
+        elif key in self._outbox:
+            # Superseded: drop the queued one, and send the newer one in order
+            del self._outbox[key]
+            self.messages_conflated += 1
+        self._outbox[key] = entry
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_soon(self.flush)
+
+    def defer_raw(self, data, key=None):
+        """
+        Hold back already encoded broadcast data while the connection is congested
+
+        Messages with a conflation key are kept, newest per key, until
+        resume_deferred is called; messages without one are dropped.
+        """
+        if key is None:
+            self.messages_dropped += 1
+            return
+        if key in self._deferred:
+            del self._deferred[key]
+            self.messages_conflated += 1
+        self._deferred[key] = data
+
+    def resume_deferred(self):
+        """
+        Queue all held back broadcast data for sending
+        """
+        for key, data in self._deferred.items():
+            self._enqueue(key, data)
+        self._deferred.clear()
+
+    @property
+    def queued_messages(self):
+        return len(self._outbox)
+
+    @property
+    def deferred_messages(self):
+        return len(self._deferred)
+
+    def get_write_buffer_size(self):
+        """
+        Number of bytes buffered in the transport, waiting to be sent
+        """
+        transport = self.writer.transport
+        if transport is None:
+            return 0
+        return transport.get_write_buffer_size()
+
+    def abort(self):
+        """
+        Close the connection immediately, discarding anything still buffered
+        """
+        self._outbox.clear()
+        self._deferred.clear()
+        self.writer.transport.abort()
+
+    def flush(self):
+        """
+        Write out all queued messages with a single writelines call
+
+        Consecutive message dicts are encoded together into one buffer.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._outbox:
+            return
+
+        chunks, pending = [], []
+        for entry in self._outbox.values():
+            if isinstance(entry, dict):
+                pending.append(entry)
+            else:
+                if pending:
+                    chunks.append(self.encode_messages(pending))
+                    pending = []
+                chunks.append(entry)
+        if pending:
+            chunks.append(self.encode_messages(pending))
+        self._outbox.clear()
+        self.writer.writelines(chunks)
+
+
+@with_logger
+class QDataStreamProtocol(Protocol):
+    """
+    Implements the legacy QDataStream-based encoding scheme
+    """
+    # Keepalives are sent as bare QStrings rather than JSON
+    KEEPALIVES = {
+        'PING': {'command': 'ping'},
+        'PONG': {'command': 'pong'}
+    }
+    # Blocks carrying a file, see read_upload
+    UPLOADS = ('UPLOAD_MAP', 'UPLOAD_MOD')
 
     @staticmethod
     def read_qstring(buffer, pos=0):
         """
         Parse a serialized QString from buffer (A bytes like object) at given position
 
-        Requires len(buffer[pos:]) >= 4.
+        Requires len(buffer) >= pos + 4.
 
-        Pos is added to buffer_pos.
+        Pass a memoryview to avoid copying the payload before decoding it.
 
-        :type buffer: bytes
+        :type buffer: bytes | memoryview
         :return (int, str): (buffer_pos, message)
         """
-        assert len(buffer[pos:pos + 4]) == 4
-        (size, ) = struct.unpack('!I', buffer[pos:pos + 4])
-        if len(buffer[pos + 4:]) < size:
+        (size, ) = _UINT32.unpack_from(buffer, pos)
+        start = pos + 4
+        end = start + size
+        if end > len(buffer):
             raise ValueError("Malformed QString: Claims length {} but actually {}"
-                             .format(size, len(buffer[pos + 4:])))
-        return size + pos + 4, (buffer[pos + 4:pos + 4 + size]).decode('UTF-16BE')
+                             .format(size, len(buffer) - start))
+        return end, str(buffer[start:end], 'UTF-16BE')
 
     @staticmethod
     def read_int32(buffer, pos=0):
         """
         Read a serialized 32-bit integer from the given buffer at given position
 
-        :type buffer: bytes
+        :type buffer: bytes | memoryview
         :return (int, int): (buffer_pos, int)
         """
-        assert len(buffer[pos:pos + 4]) == 4
-        (num, ) = struct.unpack('!i', buffer[pos:pos + 4])
+        (num, ) = _INT32.unpack_from(buffer, pos)
         return pos + 4, num
 
     @staticmethod
@@ -61,61 +302,111 @@ class QDataStreamProtocol(metaclass=ABCMeta):
         return struct.pack('!I', len(block)) + block
 
     @staticmethod
-    def read_block(data):
-        buffer_pos = 0
-        while len(data[buffer_pos:]) > 4:
-            buffer_pos, msg = QDataStreamProtocol.read_qstring(data, buffer_pos)
+    def read_block(data, pos=0):
+        """
+        Iterate over the QStrings in data, starting at pos
+
+        Works over a memoryview of data, so no intermediate copies are made.
+        """
+        view = memoryview(data)
+        end = len(view)
+        while end - pos > 4:
+            pos, msg = QDataStreamProtocol.read_qstring(view, pos)
             yield msg
 
+    @staticmethod
+    def write_block(buffer, *strings):
+        """
+        Append a block of QStrings to buffer, in place
+
+        Length prefixes are reserved up front and patched once the payload
+        is written, so no intermediate bytes objects are built for framing.
+
+        :type buffer: bytearray
+        :return bytearray: buffer
+        """
+        block_start = len(buffer)
+        buffer += _PLACEHOLDER
+        for string in strings:
+            if not isinstance(string, str):
+                raise NotImplementedError("Only string serialization is supported")
+            string_start = len(buffer)
+            buffer += _PLACEHOLDER
+            buffer += string.encode('UTF-16BE')
+            _UINT32.pack_into(buffer, string_start, len(buffer) - string_start - 4)
+        _UINT32.pack_into(buffer, block_start, len(buffer) - block_start - 4)
+        return buffer
+
     @staticmethod
     def pack_message(message, *args):
         """
         For sending a bunch of QStrings packed together in a 'block'
         """
-        msg = QDataStreamProtocol.pack_qstring(message)
-        for arg in args:
-            if isinstance(arg, str):
-                msg += QDataStreamProtocol.pack_qstring(arg)
+        return bytes(QDataStreamProtocol.write_block(bytearray(), message, *args))
+
+    @staticmethod
+    def pack_messages(messages):
+        """
+        Encode a batch of messages into a single buffer, one block per message
+
+        Keepalive messages are encoded as their bare QString.
+
+        :param messages: iterable of dicts
+        :return bytearray:
+        """
+        buffer = bytearray()
+        for message in messages:
+            if message == QDataStreamProtocol.KEEPALIVES['PING']:
+                QDataStreamProtocol.write_block(buffer, 'PING')
+            elif message == QDataStreamProtocol.KEEPALIVES['PONG']:
+                QDataStreamProtocol.write_block(buffer, 'PONG')
             else:
-                raise NotImplementedError("Only string serialization is supported")
-        return QDataStreamProtocol.pack_block(msg)
+                QDataStreamProtocol.write_block(buffer, codec.dumps(message))
+        return buffer
 
-    @asyncio.coroutine
-    def read_message(self):
+    @classmethod
+    def encode_messages(cls, messages):
+        return cls.pack_messages(messages)
+
+    @classmethod
+    def encode_json(cls, text):
+        return cls.pack_message(text)
+
+    @staticmethod
+    def decode_message(block):
         """
-        Read a message from the stream
+        Decode a single block (without its length prefix) into a message
 
-        On malformed stream, raises IncompleteReadError
+        Uploads can't be decoded this way, read_message streams those to disk instead.
 
         :return dict: Parsed message
         """
-        (block_length, ) = struct.unpack('!I', (yield from self.reader.readexactly(4)))
-        block = yield from self.reader.readexactly(block_length)
-        # FIXME: New protocol will remove the need for this
+        view = memoryview(block)
+        pos, action = QDataStreamProtocol.read_qstring(view)
+        if action in QDataStreamProtocol.UPLOADS:
+            raise ValueError("{} blocks must be streamed".format(action))
+        return QDataStreamProtocol.decode_fields(action, view, pos)
 
-        pos, action = self.read_qstring(block)
-        if action in ['UPLOAD_MAP', 'UPLOAD_MOD']:
-            pos, _ = self.read_qstring(block, pos)  # login
-            pos, _ = self.read_qstring(block, pos)  # session
-            pos, name = self.read_qstring(block, pos)
-            pos, info = self.read_qstring(block, pos)
-            pos, size = self.read_int32(block, pos)
-            data = block[pos:size]
-            return {
-                'command': action.lower(),
-                'name': name,
-                'info': json.loads(info),
-                'data': data
-            }
-        elif action in ['PING', 'PONG']:
+    @staticmethod
+    def decode_fields(action, view, pos=0):
+        """
+        Decode the remainder of a block, given its leading QString
+
+        :param str action: the first QString of the block
+        :param memoryview view: the block
+        :param int pos: offset of the QString following action
+        :return dict: Parsed message
+        """
+        # FIXME: New protocol will remove the need for this
+        if action in QDataStreamProtocol.KEEPALIVES:
             return {
                 'command': action.lower()
             }
         else:
-            message = json.loads(action)
-            for part in self.read_block(block):
+            message = codec.loads(action)
+            for part in QDataStreamProtocol.read_block(view, pos):
                 try:
-                    message_part = json.loads(part)
+                    message_part = codec.loads(part)
                     message.update(message_part)
                 except (ValueError, TypeError):
                     if 'legacy' not in message:
@@ -124,27 +415,99 @@ class QDataStreamProtocol(metaclass=ABCMeta):
             return message
 
     @asyncio.coroutine
-    def drain(self):
+    def read_message(self):
         """
-        Await the write buffer to empty.
+        Read a message from the stream
 
-        See StreamWriter.drain()
+        The leading QString is read on its own, so that uploads can be spotted
+        and streamed to disk before the rest of the block is buffered.
+
+        On malformed stream, raises IncompleteReadError
+
+        :return dict: Parsed message
         """
-        yield from self.writer.drain()
+        if not self.in_sync:
+            raise ConnectionAbortedError("Stream left in the middle of a block")
+        (block_length, ) = _UINT32.unpack((yield from self.reader.readexactly(4)))
+        remaining, action = yield from self._read_stream_qstring(block_length)
+        if action in self.UPLOADS:
+            return (yield from self.read_upload(action, remaining))
+        rest = yield from self.reader.readexactly(remaining)
+        return self.decode_fields(action, memoryview(rest))
 
-    def close(self):
+    @asyncio.coroutine
+    def _read_stream_qstring(self, remaining):
         """
-        Close writer stream
-        :return:
+        Read a QString straight from the stream, within the remaining bytes of a block
+
+        :return (int, str): (remaining, string)
         """
-        self.writer.close()
+        if remaining < 4:
+            raise ValueError("Malformed block: {} bytes left for a QString".format(remaining))
+        (size, ) = _UINT32.unpack((yield from self.reader.readexactly(4)))
+        remaining -= 4
+        if size > remaining:
+            raise ValueError("Malformed QString: Claims length {} but block has {} left"
+                             .format(size, remaining))
+        data = yield from self.reader.readexactly(size)
+        return remaining - size, str(data, 'UTF-16BE')
 
-    def send_message(self, message: dict):
-        self.writer.write(self.pack_message(json.dumps(message)))
+    @asyncio.coroutine
+    def read_upload(self, action, remaining):
+        """
+        Stream the payload of an UPLOAD_MAP/UPLOAD_MOD block into a temporary file
 
-    def send_messages(self, messages):
-        payload = [self.pack_message(json.dumps(msg)) for msg in messages]
-        self.writer.writelines(payload)
+        Payloads over config.MAX_UPLOAD_SIZE are left unread. The returned
+        message then carries an error, and reading any further message drops
+        the connection.
+
+        :param int remaining: bytes of the block left after the action
+        :return dict: message whose 'upload' is an Upload for the temporary file,
+                      which the receiver is responsible for moving or removing
+        """
+        remaining, _ = yield from self._read_stream_qstring(remaining)  # login
+        remaining, _ = yield from self._read_stream_qstring(remaining)  # session
+        remaining, name = yield from self._read_stream_qstring(remaining)
+        remaining, info = yield from self._read_stream_qstring(remaining)
+        if remaining < 4:
+            raise ValueError("Malformed {} block: missing payload size".format(action))
+        # Declared payload size, the rest of the block is the payload itself
+        yield from self.reader.readexactly(4)
+        remaining -= 4
+
+        message = {
+            'command': action.lower(),
+            'name': name,
+            'info': codec.loads(info),
+            'upload': None
+        }
+        if remaining > config.MAX_UPLOAD_SIZE:
+            self._logger.info("Rejecting {} of {} bytes".format(action, remaining))
+            self.in_sync = False
+            message['error'] = "File is too large, the maximum is {} MB."\
+                .format(config.MAX_UPLOAD_SIZE // (1024 * 1024))
+            return message
 
-    def send_raw(self, data):
-        self.writer.write(data)
+        upload = tempfile.NamedTemporaryFile(prefix='faf_upload_', delete=False)
+        try:
+            with upload:
+                yield from self._copy_stream(upload, remaining)
+        except BaseException:
+            os.remove(upload.name)
+            raise
+        message['upload'] = Upload(upload.name, remaining)
+        return message
+
+    @asyncio.coroutine
+    def _copy_stream(self, target, length):
+        """
+        Copy length bytes from the stream into target in chunks
+        """
+        while length > 0:
+            chunk = yield from self.reader.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', length)
+            target.write(chunk)
+            length -= len(chunk)
+            if self.on_data is not None:
+                self.on_data()
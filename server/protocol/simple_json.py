@@ -0,0 +1,55 @@
+import asyncio
+import struct
+
+from server.decorators import with_logger
+from . import codec
+from .protocol import Protocol
+
+_UINT32 = struct.Struct('!I')
+_PLACEHOLDER = bytes(4)
+
+
+@with_logger
+class SimpleJsonProtocol(Protocol):
+    """
+    Implements the compact "v2" encoding scheme
+
+    Every frame is a 32-bit big-endian length followed by that many bytes
+    of UTF-8 encoded JSON, holding exactly one message.
+    """
+    @staticmethod
+    def decode_message(frame):
+        """
+        Decode a single frame (without its length prefix) into a message
+
+        :return dict: Parsed message
+        """
+        return codec.loads(frame)
+
+    @classmethod
+    def encode_messages(cls, messages):
+        buffer = bytearray()
+        for message in messages:
+            frame_start = len(buffer)
+            buffer += _PLACEHOLDER
+            buffer += codec.dumps_bytes(message)
+            _UINT32.pack_into(buffer, frame_start, len(buffer) - frame_start - 4)
+        return buffer
+
+    @classmethod
+    def encode_json(cls, text):
+        data = text.encode('UTF-8')
+        return _UINT32.pack(len(data)) + data
+
+    @asyncio.coroutine
+    def read_message(self):
+        """
+        Read a message from the stream
+
+        On malformed stream, raises IncompleteReadError
+
+        :return dict: Parsed message
+        """
+        (frame_length, ) = _UINT32.unpack((yield from self.reader.readexactly(4)))
+        frame = yield from self.reader.readexactly(frame_length)
+        return self.decode_message(frame)
@@ -1,6 +1,8 @@
 import asyncio
+
+import config
 from server.decorators import with_logger
-from server.protocol import QDataStreamProtocol
+from server.protocol import QDataStreamProtocol, conflation_key
 
 
 @with_logger
@@ -9,14 +11,19 @@ class ServerContext:
     Base class for managing connections and holding state about them.
     """
 
-    def __init__(self, connection_factory, loop, name='Unknown server'):
+    def __init__(self, connection_factory, loop, name='Unknown server', liveness=None):
         super().__init__()
         self.loop = loop
         self.name = name
         self._server = None
         self._connection_factory = connection_factory
         self.connections = {}
+        # LivenessWheel pinging idle connections, if any
+        self.liveness = liveness
         self._transport = None
+        self._write_buffer_check = None
+        # Connections over the high water mark or holding back broadcasts, as of the last check
+        self.congested_connections = 0
         self._logger.info("{} initialized with loop: {}".format(self, loop))
 
     def __repr__(self):
@@ -29,9 +36,13 @@ class ServerContext:
                                             host=host,
                                             port=port,
                                             loop=self.loop)
+        self._write_buffer_check = self.loop.call_later(1, self.check_write_buffers)
         return self._server
 
     def close(self):
+        if self._write_buffer_check is not None:
+            self._write_buffer_check.cancel()
+            self._write_buffer_check = None
         self._server.close()
         self._logger.info("Closed")
         del self._server
@@ -39,15 +50,142 @@ class ServerContext:
     def __contains__(self, connection):
         return connection in self.connections.keys()
 
-    def broadcast_raw(self, message, validate_fn=lambda a: True):
+    def broadcast(self, message: dict, validate_fn=lambda a: True):
+        """
+        Send message to every connection accepted by validate_fn
+
+        The message is encoded at most once per protocol in use.
+        """
+        encoded = {}
+        key = conflation_key(message)
         for conn, proto in self.connections.items():
             if validate_fn(conn):
-                proto.send_raw(message)
+                protocol_class = type(proto)
+                if protocol_class not in encoded:
+                    encoded[protocol_class] = protocol_class.encode_message(message)
+                if proto.get_write_buffer_size() > config.WRITE_BUFFER_HIGH_WATER:
+                    # Slow consumer: don't make its backlog any longer than it has to be
+                    proto.defer_raw(encoded[protocol_class], key=key)
+                else:
+                    proto.send_raw(encoded[protocol_class], key=key)
+
+    def broadcast_game_info(self, message: dict, changes: dict=None, recipients=None, encoded=None):
+        """
+        Send a game_info to recipients, or every connection if None
+
+        Protocols that opted in to deltas and already hold a full game_info
+        for the game only get the changed fields, if there are any.
+        Everybody else gets the full message.
+
+        :param message: full game_info
+        :param changes: fields changed since the previous broadcast, None if there was none
+        :param recipients: iterable of connections, those not connected here are skipped
+        :param encoded: cache of message encoded per protocol class, filled in as needed
+        """
+        uid = message['uid']
+        key = conflation_key(message)
+        delta = None
+        if changes is not None:
+            delta = dict(changes, command='game_info', uid=uid, delta=True)
+        if encoded is None:
+            encoded = {}
+        encoded_delta = {}
+        if recipients is None:
+            recipients = self.connections.keys()
+        for conn in recipients:
+            proto = self.connections.get(conn)
+            if proto is None:
+                continue
+            protocol_class = type(proto)
+            congested = proto.deferred_messages or proto.get_write_buffer_size() > config.WRITE_BUFFER_HIGH_WATER
+            if delta is not None and proto.game_info_deltas and uid in proto.games_known and not congested:
+                if changes:
+                    if protocol_class not in encoded_delta:
+                        encoded_delta[protocol_class] = protocol_class.encode_message(delta)
+                    proto.send_raw(encoded_delta[protocol_class])
+                continue
+            if protocol_class not in encoded:
+                encoded[protocol_class] = protocol_class.encode_message(message)
+            proto.games_known.add(uid)
+            if congested:
+                # Deltas would pile up behind the backlog, a conflated snapshot won't
+                proto.defer_raw(encoded[protocol_class], key=key)
+            else:
+                proto.send_raw(encoded[protocol_class], key=key)
+
+    def write_buffer_sizes(self):
+        """
+        Bytes buffered in the transport, per connection
+
+        :return dict: connection -> int
+        """
+        return {conn: proto.get_write_buffer_size()
+                for conn, proto in self.connections.items()}
+
+    def congestion(self):
+        """
+        Share of connections that were backed up at the last write buffer check
+
+        :return float: between 0 and 1
+        """
+        if not self.connections:
+            return 0.0
+        return min(1.0, self.congested_connections / len(self.connections))
+
+    def check_write_buffers(self):
+        """
+        Periodically resume held back broadcasts for connections that caught
+        up, and disconnect those stuck over the hard limit for too long
+        """
+        now = self.loop.time()
+        congested = 0
+        for conn, proto in list(self.connections.items()):
+            size = proto.get_write_buffer_size()
+            if size > config.WRITE_BUFFER_LIMIT:
+                if proto.over_limit_since is None:
+                    proto.over_limit_since = now
+                elif now - proto.over_limit_since > config.WRITE_BUFFER_LIMIT_TIMEOUT:
+                    self._logger.warning("{}: Evicting slow consumer {} with {} bytes buffered"
+                                         .format(self, conn, size))
+                    proto.abort()
+                    continue
+            else:
+                proto.over_limit_since = None
+            if size <= config.WRITE_BUFFER_HIGH_WATER and proto.deferred_messages:
+                proto.resume_deferred()
+            if size > config.WRITE_BUFFER_HIGH_WATER or proto.deferred_messages:
+                congested += 1
+        self.congested_connections = congested
+        self._write_buffer_check = self.loop.call_later(1, self.check_write_buffers)
+
+    def upgrade_protocol(self, connection, protocol_class):
+        """
+        Switch the protocol spoken with connection
+
+        Takes effect for the next message read and all messages sent through
+        the returned protocol.
+
+        :return Protocol: the new protocol object
+        """
+        old_protocol = self.connections[connection]
+        # Anything queued or held back so far was meant to go out in the old protocol
+        old_protocol.resume_deferred()
+        old_protocol.flush()
+        protocol = protocol_class(old_protocol.reader, old_protocol.writer, loop=self.loop)
+        protocol.messages_conflated = old_protocol.messages_conflated
+        protocol.messages_dropped = old_protocol.messages_dropped
+        protocol.over_limit_since = old_protocol.over_limit_since
+        protocol.game_info_deltas = old_protocol.game_info_deltas
+        protocol.games_known = old_protocol.games_known
+        protocol.on_data = old_protocol.on_data
+        self.connections[connection] = protocol
+        self._logger.debug("{}: {} switched to {}".format(self, connection, protocol_class.__name__))
+        return protocol
 
     @asyncio.coroutine
     def client_connected(self, stream_reader, stream_writer):
         self._logger.info("{}: Client connected".format(self))
-        protocol = QDataStreamProtocol(stream_reader, stream_writer)
+        protocol = QDataStreamProtocol(stream_reader, stream_writer, loop=self.loop)
         try:
             connection = self._connection_factory()
             yield from connection.on_connection_made(protocol, stream_writer.get_extra_info('peername'))
@@ -55,10 +193,18 @@ class ServerContext:
         except Exception as ex:
             self._logger.exception(ex)
             return
+        if self.liveness is not None:
+            self.liveness.add(connection)
+            # Long uploads count as signs of life all the way through, not just once done
+            protocol.on_data = lambda: self.liveness.seen(connection)
         try:
             while True:
-                message = yield from protocol.read_message()
+                message = yield from self.connections[connection].read_message()
+                if self.liveness is not None:
+                    self.liveness.seen(connection)
                 yield from connection.on_message_received(message)
+                if self.liveness is not None:
+                    self.liveness.seen(connection)
         except ConnectionResetError:
             pass
         except ConnectionAbortedError:
@@ -69,6 +215,8 @@ class ServerContext:
         except Exception as ex:
             self._logger.exception(ex)
         finally:
-            del self.connections[connection]
-            protocol.writer.close()
+            if self.liveness is not None:
+                self.liveness.remove(connection)
+            protocol = self.connections.pop(connection)
+            protocol.close()
             connection.on_connection_lost()
@@ -0,0 +1,94 @@
+import base64
+import os
+
+import config
+from server.decorators import with_logger
+
+
+@with_logger
+class SessionService:
+    """
+    Holds on to the players of dropped lobby connections for a while
+
+    Every login is handed a resume token. When its connection drops, the
+    player is suspended rather than logged out and stays online for everybody
+    else for grace seconds. A reconnect presenting the token within that time
+    gets the very same Player back, without going through the database again
+    and without anybody hearing about it leaving or joining. Otherwise
+    on_expire(player) is called to log it out after all.
+
+    A token is good for one resume, and a player only has one at a time:
+    logging in again or resuming issues a new one.
+    """
+    def __init__(self, loop, grace=None):
+        self.loop = loop
+        self.grace = grace if grace is not None else config.SESSION_RESUME_GRACE
+        # Player id -> the token last issued to it
+        self._issued = dict()
+        # Token -> (player, state, expiry handle), for suspended sessions
+        self._suspended = dict()
+
+    def __len__(self):
+        return len(self._suspended)
+
+    def issue(self, player):
+        """
+        Issue a new resume token for player
+
+        Any earlier token of player stops working, and a session of it still
+        suspended is dropped without calling its on_expire.
+
+        :return str: the token
+        """
+        self.revoke(player, self._issued.get(player.id))
+        token = base64.urlsafe_b64encode(os.urandom(24)).decode()
+        self._issued[player.id] = token
+        return token
+
+    def revoke(self, player, token):
+        """
+        Make token stop working, unless player has been issued another one since
+        """
+        if token is None or self._issued.get(player.id) != token:
+            return
+        del self._issued[player.id]
+        entry = self._suspended.pop(token, None)
+        if entry is not None:
+            entry[2].cancel()
+
+    def suspend(self, token, player, state, on_expire):
+        """
+        Keep player around for a resume with token
+
+        :param state: whatever else the connection needs back when resuming
+        :param on_expire: called with player if nobody resumes in time
+        :return bool: whether player was suspended, False if token is not its current one
+        """
+        if self._issued.get(player.id) != token:
+            return False
+        handle = self.loop.call_later(self.grace, self._expire, token, on_expire)
+        self._suspended[token] = (player, state, handle)
+        return True
+
+    def resume(self, token, login):
+        """
+        Take a suspended session back
+
+        :return (Player, state): as suspended, None if token doesn't resume a session of login
+        """
+        entry = self._suspended.get(token)
+        if entry is None or entry[0].login != login:
+            return None
+        player, state, handle = entry
+        handle.cancel()
+        del self._suspended[token]
+        del self._issued[player.id]
+        return player, state
+
+    def _expire(self, token, on_expire):
+        player, _, _ = self._suspended.pop(token)
+        del self._issued[player.id]
+        try:
+            on_expire(player)
+        except Exception as ex:  # pragma: no cover
+            self._logger.exception(ex)
@@ -0,0 +1,104 @@
+"""
+In-process call counters and latency histograms, read by the control server
+"""
+import bisect
+from collections import defaultdict
+
+
+class Histogram:
+    """
+    Latency histogram over fixed bucket bounds, in seconds
+    """
+    BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+              0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds if bounds is not None else self.BOUNDS
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th percentile
+
+        Samples past the last bound report the largest sample seen.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Timings:
+    """
+    A histogram per name, created on first use
+    """
+    def __init__(self, bounds=None):
+        self.histograms = defaultdict(lambda: Histogram(bounds))
+
+    def add(self, name, seconds):
+        self.histograms[name].add(seconds)
+
+    def __getitem__(self, name):
+        return self.histograms[name]
+
+    def __contains__(self, name):
+        return name in self.histograms
+
+    def clear(self):
+        self.histograms.clear()
+
+    def report(self, scale=1000):
+        """
+        One line per name, the largest total time first
+
+        :param scale: factor applied to every value, the default reports seconds as milliseconds
+        :return str: "name: calls/total/mean/p50/p99/max"
+        """
+        lines = []
+        for name, hist in sorted(self.histograms.items(), key=lambda item: -item[1].total):
+            lines.append("{}: {}/{:.1f}/{:.3f}/{:.3f}/{:.3f}/{:.3f}".format(
+                name, hist.count, hist.total * scale, hist.mean * scale,
+                hist.percentile(50) * scale, hist.percentile(99) * scale, hist.max * scale))
+        return "\n".join(lines)
+
+
+# Time spent in LobbyConnection command handlers, by command
+lobby_commands = Timings()
+
+# Time spent in GameConnection GPGNet action handlers, by action
+game_actions = Timings()
+
+# Time spent in each stage of command_hello, and 'total' for whole logins
+login_stages = Timings()
+
+# Time logins spent in the admission queue ('wait') and running once admitted ('login')
+login_queue = Timings()
+
+# Ping round-trip times, by connection class
+round_trips = Timings()
+
+# Periodic flushes, by name: "<name> duration", the "<name> interval" chosen
+# until the next one and "<name> lag", how late the event loop ran it
+flushes = Timings()
+
+# Items sent per periodic flush, by name
+flush_sizes = Timings(bounds=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
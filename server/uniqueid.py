@@ -0,0 +1,101 @@
+import asyncio
+import base64
+import hashlib
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import rsa
+from Crypto.Cipher import AES
+
+import config
+from passwords import PRIVATE_KEY
+from server.decorators import with_logger
+
+# Machine fields making up a uniqueid, in the order they are hashed and stored
+HARDWARE_FIELDS = ('UUID', 'mem_SerialNumber', 'DeviceID', 'Manufacturer', 'Name', 'ProcessorId',
+                   'SMBIOSBIOSVersion', 'SerialNumber', 'VolumeSerialNumber')
+
+VIRTUAL_MACHINE_MARKERS = ('vmware', 'virtual', 'innotek', 'qemu', 'parallels', 'bochs')
+
+_QUOTES = re.compile(r'[0-9a-zA-Z\\]("")')
+_UNPRINTABLE = re.compile('[^\x09\x0A\x0D\x20-\x7F]')
+
+
+def decode_unique_id(serialized_uniqueid, private_key):
+    """
+    Decrypt and hash the uniqueid a client sent along with its login
+
+    Only takes and returns plain values so it can run in another process.
+
+    :param serialized_uniqueid: base64 of the AES padding length, the base64 IV,
+                                the base64 encrypted machine description and
+                                the base64 AES key encrypted with our public key
+    :param private_key: rsa.PrivateKey to decrypt the AES key with
+    :return (str, str, tuple): session the uniqueid was made for, hash of the hardware and
+                               the hardware fields. The hash is "VM" and the fields are None
+                               for virtual machines.
+    """
+    message = base64.b64decode(serialized_uniqueid)
+
+    trailing = message[0]
+    message = message[1:]
+
+    iv = base64.b64decode(message[:24])
+    encoded = message[24:-40]
+    key = base64.b64decode(message[-40:])
+
+    aes_key = rsa.decrypt(key, private_key)
+
+    cipher = AES.new(aes_key, AES.MODE_CBC, iv)
+    decoded = cipher.decrypt(base64.b64decode(encoded))[:-trailing].decode('latin-1')
+    decoded = _QUOTES.sub('"', decoded)
+    decoded = decoded.replace("\\", "\\\\")
+    decoded = _UNPRINTABLE.sub('', decoded)
+    jstring = json.loads(decoded)
+
+    session = str(jstring["session"])
+    machine = jstring["machine"]
+
+    for value in machine.values():
+        low = str(value).lower()
+        if any(marker in low for marker in VIRTUAL_MACHINE_MARKERS):
+            return session, "VM", None
+
+    hardware_info = tuple(str(machine.get(field, 0)) for field in HARDWARE_FIELDS)
+    return session, hashlib.md5(''.join(hardware_info).encode()).hexdigest(), hardware_info
+
+
+@with_logger
+class UniqueIdDecoder:
+    """
+    Decodes uniqueids in a pool of worker processes
+
+    Decrypting a uniqueid takes an RSA private key operation in pure Python,
+    which would otherwise hold up the event loop, and everybody on it, for
+    every login.
+
+    With no workers, uniqueids are decoded right away on the event loop.
+    """
+    def __init__(self, loop, workers=None, private_key=None):
+        self.loop = loop
+        self.workers = workers if workers is not None else config.UNIQUEID_WORKERS
+        self.private_key = private_key if private_key is not None else PRIVATE_KEY
+        self._executor = ProcessPoolExecutor(self.workers) if self.workers > 0 else None
+
+    @asyncio.coroutine
+    def decode(self, serialized_uniqueid):
+        """
+        Decode serialized_uniqueid without blocking the event loop
+
+        :return: as decode_unique_id
+        """
+        if self._executor is None:
+            return decode_unique_id(serialized_uniqueid, self.private_key)
+        return (yield from self.loop.run_in_executor(self._executor, decode_unique_id,
+                                                     serialized_uniqueid, self.private_key))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import pymysql
+
+import config
+import server.db as db
+from server import stats
+from server.decorators import with_logger
+
+
+@with_logger
+class WriteBehindQueue:
+    """
+    Database writes nobody has to wait for, done in batches in the background
+
+        writes.put("UPDATE login SET ip = %s WHERE id = %s", player_id, (ip, player_id))
+
+    Writes are keyed by statement and key: a write replaces any write for
+    the same key still queued, so only the latest one goes out. Every
+    interval seconds up to batch_size queued writes are done over one pooled
+    connection, with one executemany per statement.
+
+    Writes that fail are queued again unless superseded in the meantime,
+    and given up on after max_attempts. Programming errors, like a missing
+    table, are given up on straight away.
+
+    flush() does everything queued, for shutting down.
+
+    Batch durations and sizes are recorded in server.stats under "write_behind".
+    """
+    name = 'write_behind'
+
+    def __init__(self, loop, interval=None, batch_size=None, max_attempts=None):
+        self.loop = loop
+        self.interval = interval if interval is not None else config.WRITE_BEHIND_INTERVAL
+        self.batch_size = batch_size if batch_size is not None else config.WRITE_BEHIND_BATCH_SIZE
+        self.max_attempts = max_attempts if max_attempts is not None else config.WRITE_BEHIND_MAX_ATTEMPTS
+        # (statement, key) -> (args, attempts made so far), oldest first
+        self._queued = OrderedDict()
+        self._handle = None
+        self._writing = None
+
+    def __len__(self):
+        return len(self._queued)
+
+    def start(self):
+        if self._handle is None:
+            self._handle = self.loop.call_later(self.interval, self.run)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def put(self, statement, key, args):
+        """
+        Queue statement to be executed with args, replacing any write for key still queued
+        """
+        self._queued[(statement, key)] = (args, 0)
+
+    def run(self):
+        """
+        Start writing a batch, unless one is still being written, and schedule the next
+        """
+        self._handle = self.loop.call_later(self.interval, self.run)
+        if self._queued and (self._writing is None or self._writing.done()):
+            self._writing = asyncio.async(self.write_batch(self.batch_size), loop=self.loop)
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Write everything queued, for shutting down
+        """
+        if self._writing is not None and not self._writing.done():
+            yield from self._writing
+        while self._queued:
+            yield from self.write_batch()
+
+    @asyncio.coroutine
+    def write_batch(self, limit=None):
+        """
+        Write the oldest limit queued writes, or all of them
+
+        :return int: the number of writes done
+        """
+        batch = OrderedDict()
+        while self._queued and (limit is None or limit > 0):
+            (statement, key), (args, attempts) = self._queued.popitem(last=False)
+            batch.setdefault(statement, []).append((key, args, attempts))
+            if limit is not None:
+                limit -= 1
+
+        start = time.perf_counter()
+        written = 0
+        try:
+            with (yield from db.db_pool) as conn:
+                cursor = yield from conn.cursor()
+                while batch:
+                    statement, writes = batch.popitem(last=False)
+                    try:
+                        yield from cursor.executemany(statement, [args for _, args, _ in writes])
+                        written += len(writes)
+                    except pymysql.ProgrammingError as ex:
+                        self._give_up(statement, writes, ex)
+                    except pymysql.Error as ex:
+                        self._retry(statement, writes, ex)
+        except (pymysql.Error, OSError) as ex:
+            # Lost the connection itself, everything not written yet goes back in the queue
+            for statement, writes in batch.items():
+                self._retry(statement, writes, ex)
+
+        stats.flushes.add('{} duration'.format(self.name), time.perf_counter() - start)
+        stats.flush_sizes.add(self.name, written)
+        return written
+
+    def _retry(self, statement, writes, ex):
+        for key, args, attempts in writes:
+            if (statement, key) in self._queued:
+                continue
+            if attempts + 1 >= self.max_attempts:
+                self._give_up(statement, [(key, args, attempts)], ex)
+            else:
+                self._queued[(statement, key)] = (args, attempts + 1)
+
+    def _give_up(self, statement, writes, ex):
+        self._logger.info("Giving up on {} writes of {}: {}".format(len(writes), statement, ex))
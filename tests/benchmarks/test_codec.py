@@ -0,0 +1,50 @@
+"""
+Benchmarks for the JSON codec against the standard library
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import json
+
+import pytest
+
+from server.protocol import codec
+from tests.utils import benchmark, report
+
+slow = pytest.mark.slow
+
+GAME_INFO = {'command': 'game_info', 'uid': 4242, 'title': 'Seton 4v4 1500+ no noobs', 'state': 'open',
+             'featured_mod': 'faf', 'featured_mod_versions': {}, 'sim_mods': {'a' * 36: 'Some sim mod'},
+             'map_file_path': 'maps/setons_clutch.zip', 'host': 'Dostya', 'num_players': 6,
+             'max_players': 8, 'game_type': 'demoralization', 'options': [], 'visibility': 'public',
+             'teams': {1: ['Dostya', 'Rhiza', 'Kael'], 2: ['Hall', 'Fletcher', 'Brackman']},
+             'password_protected': False}
+
+PLAYER_INFO = {'command': 'player_info',
+               'players': [{'login': 'player{}'.format(i), 'id': i,
+                            'global_rating': [1500.0 + i, 500.0 - i / 10],
+                            'ladder_rating': [1300.0 + i, 400.0 - i / 10],
+                            'number_of_games': i, 'avatar': {'url': 'http://example.com/a.png',
+                                                             'tooltip': 'Avatar'},
+                            'country': 'DK', 'clan': 'FAF'} for i in range(100)]}
+
+PAYLOADS = {'game_info': GAME_INFO, 'player_info': PLAYER_INFO}
+
+
+@slow
+@pytest.mark.parametrize('name', sorted(PAYLOADS.keys()))
+def test_encode(name):
+    payload = PAYLOADS[name]
+    report("stdlib dumps {}".format(name), benchmark(lambda: json.dumps(payload)))
+    report("{} dumps {}".format(codec.BACKEND, name), benchmark(lambda: codec.dumps(payload)))
+    report("{} dumps_bytes {}".format(codec.BACKEND, name), benchmark(lambda: codec.dumps_bytes(payload)))
+
+
+@slow
+@pytest.mark.parametrize('name', sorted(PAYLOADS.keys()))
+def test_decode(name):
+    text = json.dumps(PAYLOADS[name])
+    data = text.encode()
+    report("stdlib loads {}".format(name), benchmark(lambda: json.loads(text)))
+    report("{} loads {}".format(codec.BACKEND, name), benchmark(lambda: codec.loads(text)))
+    report("{} loads bytes {}".format(codec.BACKEND, name), benchmark(lambda: codec.loads(data)))
+
@@ -0,0 +1,56 @@
+"""
+Benchmarks for GPGNet message handling
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import asyncio
+from unittest import mock
+
+import pytest
+
+from server.gameconnection import GameConnection
+from tests.utils import benchmark, report
+
+slow = pytest.mark.slow
+
+OPTIONS = ['Victory', 'Timeouts', 'CheatsEnabled', 'CivilianAlliance', 'GameSpeed', 'FogOfWar',
+           'NoRushOption', 'PrebuiltUnits', 'RevealCivilians', 'Score', 'Share', 'ShareUnitCap',
+           'TeamLock', 'TeamSpawn', 'UnitCap', 'AllowObservers', 'RandomMap', 'Slots']
+SLOT_OPTIONS = ['Faction', 'Color', 'Team', 'StartSpot', 'Army', 'Ready']
+
+# What a host's game sends while an 8 player lobby fills up and gets set up
+LOBBY_SETUP = (
+    [('GameOption', ['ScenarioFile', '/maps/setons_clutch/setons_clutch_scenario.lua'])] +
+    [('GameOption', [option, 'default']) for option in OPTIONS] +
+    [('GameMods', ['activated', 0])] +
+    [('PlayerOption', [slot, option, slot]) for slot in range(1, 9) for option in SLOT_OPTIONS] +
+    [('AIOption', ['AI: Sorian', option, slot]) for slot in range(7, 9) for option in SLOT_OPTIONS] +
+    [('ClearSlot', [8])] +
+    [('GameOption', [option, 'default']) for option in OPTIONS] +
+    [('PlayerOption', [slot, 'Ready', 'true']) for slot in range(1, 8)]
+)
+
+
+@pytest.fixture
+def host_connection(loop, game, players):
+    conn = GameConnection(loop=loop, player_service=mock.Mock(), games=mock.Mock())
+    conn.protocol = mock.Mock()
+    conn.player = players.hosting
+    conn.game = game
+    conn._authenticated = asyncio.Future()
+    conn._authenticated.set_result(players.hosting.id)
+    return conn
+
+
+def replay(conn):
+    for action, chunks in LOBBY_SETUP:
+        # None of these actions wait on anything, so the coroutine runs to completion
+        for _ in conn.on_message_received({'action': action, 'chunks': list(chunks)}):
+            pass
+
+
+@slow
+def test_replay_lobby_setup(host_connection):
+    elapsed = benchmark(lambda: replay(host_connection), number=100)
+    report("replay lobby setup ({} messages)".format(len(LOBBY_SETUP)), elapsed)
+    report("  per message", elapsed / len(LOBBY_SETUP))
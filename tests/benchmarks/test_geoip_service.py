@@ -0,0 +1,53 @@
+"""
+Benchmarks for resolving the countries of logging in players
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import random
+
+import pygeoip
+import pytest
+
+from server.geoip_service import GeoIpService
+from tests.utils import benchmark, report
+
+slow = pytest.mark.slow
+
+
+def random_ips(count, networks):
+    rng = random.Random(42)
+    prefixes = ['{}.{}.{}'.format(rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255))
+                for _ in range(networks)]
+    return ['{}.{}'.format(rng.choice(prefixes), rng.randint(1, 254)) for _ in range(count)]
+
+
+@slow
+def test_geoip_startup():
+    report("open GeoIP.dat, MEMORY_CACHE",
+           benchmark(lambda: pygeoip.GeoIP('GeoIP.dat', pygeoip.MEMORY_CACHE), number=20))
+    report("open GeoIP.dat, MMAP_CACHE",
+           benchmark(lambda: pygeoip.GeoIP('GeoIP.dat', pygeoip.MMAP_CACHE), number=20))
+    report("GeoIpService()", benchmark(lambda: GeoIpService('GeoIP.dat'), number=20))
+
+
+@slow
+@pytest.mark.parametrize('networks', [100, 1000, 10000])
+def test_geoip_lookup(networks):
+    ips = random_ips(10000, networks)
+    memory = pygeoip.GeoIP('GeoIP.dat', pygeoip.MEMORY_CACHE)
+    geoip = GeoIpService('GeoIP.dat')
+
+    def uncached():
+        for ip in ips:
+            memory.country_code_by_addr(ip)
+
+    def cached():
+        for ip in ips:
+            geoip.country_code(ip)
+
+    def batch():
+        geoip.country_codes(ips)
+
+    report("per lookup over {} networks, MEMORY_CACHE".format(networks), benchmark(uncached, number=3) / len(ips))
+    report("per lookup over {} networks, cached".format(networks), benchmark(cached, number=3) / len(ips))
+    report("per lookup over {} networks, batch".format(networks), benchmark(batch, number=3) / len(ips))
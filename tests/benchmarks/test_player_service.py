@@ -0,0 +1,49 @@
+"""
+Benchmarks for what a login costs, against the number of players online
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import pytest
+
+from server.players import Player
+from server.protocol import QDataStreamProtocol
+from tests.utils import benchmark, report
+
+slow = pytest.mark.slow
+
+
+def make_player(i):
+    player = Player(login='player{}'.format(i), id=i,
+                    global_rating=(1500.0 + i % 500, 80.0), ladder_rating=(1400.0, 120.0), numGames=i % 1000)
+    player.country = 'DK'
+    player.clan = 'FAF'
+    return player
+
+
+@slow
+@pytest.mark.parametrize('online', [100, 1000, 5000])
+def test_login_player_list(player_service, online):
+    for i in range(1, online + 1):
+        player_service.addUser(make_player(i))
+    newcomer = make_player(online + 1)
+
+    def legacy():
+        QDataStreamProtocol.encode_message({
+            'command': 'player_info',
+            'players': [player.to_dict() for player in player_service]
+        })
+
+    def during_login_storm():
+        # Somebody else just logged in, so the snapshot gets rebuilt from its cached parts
+        player_service.addUser(newcomer)
+        player_service.encoded_online_players(QDataStreamProtocol)
+        player_service.remove_player(newcomer)
+
+    def steady_state():
+        player_service.encoded_online_players(QDataStreamProtocol)
+
+    number = max(1, 20000 // online)
+    report("player list for {} online, to_dict per login".format(online), benchmark(legacy, number=number))
+    report("player list for {} online, during login storm".format(online),
+           benchmark(during_login_storm, number=number))
+    report("player list for {} online, cached".format(online), benchmark(steady_state, number=number))
@@ -0,0 +1,90 @@
+"""
+Benchmarks for the lobby wire protocol
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import json
+
+import pytest
+
+from server.protocol import QDataStreamProtocol
+from tests.utils import benchmark, report
+
+slow = pytest.mark.slow
+
+
+def make_block(*parts):
+    return b''.join(QDataStreamProtocol.pack_qstring(part) for part in parts)
+
+
+LOBBY_COMMANDS = {
+    'hello': make_block(json.dumps({'command': 'hello',
+                                    'version': 0,
+                                    'login': 'Dostya',
+                                    'password': 'b' * 64,
+                                    'unique_id': 'c' * 512})),
+    'game_host': make_block(json.dumps({'command': 'game_host',
+                                        'title': 'Test game',
+                                        'gameport': 6112,
+                                        'visibility': 'public',
+                                        'mod': 'faf',
+                                        'mapname': 'scmp_007',
+                                        'password': None})),
+    'social_add': make_block(json.dumps({'command': 'social_add', 'friend': 42})),
+    'PING': make_block('PING'),
+}
+
+
+@slow
+@pytest.mark.parametrize('name', sorted(LOBBY_COMMANDS.keys()))
+def test_decode_lobby_command(name):
+    block = LOBBY_COMMANDS[name]
+    report("decode {}".format(name),
+           benchmark(lambda: QDataStreamProtocol.decode_message(block)))
+
+
+@slow
+@pytest.mark.parametrize('parts', [10, 100, 1000, 10000])
+def test_decode_legacy_multipart(parts):
+    block = make_block('{"command": "legacy"}', *[str(i) * 8 for i in range(parts)])
+    number = max(1, 10000 // parts)
+    elapsed = benchmark(lambda: QDataStreamProtocol.decode_message(block), number=number)
+    report("decode legacy block with {} parts".format(parts), elapsed)
+    report("  per part", elapsed / parts)
+
+
+def legacy_pack_message(message, *args):
+    msg = QDataStreamProtocol.pack_qstring(message)
+    for arg in args:
+        msg += QDataStreamProtocol.pack_qstring(arg)
+    return QDataStreamProtocol.pack_block(msg)
+
+
+LOGIN_BURST = (
+    [{'command': 'player_info',
+      'players': [{'login': 'player{}'.format(i),
+                   'global_rating': [1500.0, 500.0],
+                   'ladder_rating': [1500.0, 500.0],
+                   'number_of_games': i,
+                   'country': 'DK'} for i in range(200)]}] +
+    [{'command': 'mod_info', 'publish': 1, 'name': 'mod{}'.format(i),
+      'fullname': 'Mod {}'.format(i), 'desc': 'A featured mod'} for i in range(15)] +
+    [{'command': 'tutorials_info', 'tutorial': 'tutorial{}'.format(i), 'url': 'http://example.com',
+      'tutorial_section': 'Basics', 'description': 'Learn things', 'mapname': 'scmp_007'}
+     for i in range(40)] +
+    [{'command': 'game_info', 'uid': i, 'title': 'Game {}'.format(i), 'state': 'open',
+      'featured_mod': 'faf', 'map_file_path': 'scmp_007', 'num_players': 2, 'max_players': 8,
+      'teams': {'1': ['a', 'b']}} for i in range(100)]
+)
+
+
+@slow
+def test_encode_login_burst_legacy():
+    report("encode login burst ({} messages, legacy)".format(len(LOGIN_BURST)),
+           benchmark(lambda: [legacy_pack_message(json.dumps(msg)) for msg in LOGIN_BURST], number=100))
+
+
+@slow
+def test_encode_login_burst():
+    report("encode login burst ({} messages)".format(len(LOGIN_BURST)),
+           benchmark(lambda: QDataStreamProtocol.pack_messages(LOGIN_BURST), number=100))
@@ -0,0 +1,57 @@
+"""
+Benchmarks for decoding the uniqueids sent with logins, on and off the event loop
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import asyncio
+import time
+
+import pytest
+import rsa
+
+from server.uniqueid import UniqueIdDecoder, HARDWARE_FIELDS
+from tests.utils import encode_unique_id
+
+slow = pytest.mark.slow
+
+LOGINS = 2000
+
+
+@slow
+@pytest.mark.parametrize('workers', [0, 1, 2, 4])
+@asyncio.coroutine
+def test_uniqueid_logins_per_second(loop, workers):
+    public_key, private_key = rsa.newkeys(240)
+    machine = {field: '{}-value'.format(field) for field in HARDWARE_FIELDS}
+    encoded = [encode_unique_id(i, machine, public_key) for i in range(LOGINS)]
+    decoder = UniqueIdDecoder(loop, workers=workers, private_key=private_key)
+
+    # Longest the event loop went without getting round to anything else
+    longest_stall = 0.0
+    running = True
+
+    @asyncio.coroutine
+    def watch_loop():
+        nonlocal longest_stall
+        last = time.perf_counter()
+        while running:
+            yield from asyncio.sleep(0)
+            now = time.perf_counter()
+            longest_stall = max(longest_stall, now - last)
+            last = now
+
+    try:
+        # Get the worker processes going first
+        yield from decoder.decode(encoded[0])
+        watcher = asyncio.async(watch_loop())
+        start = time.perf_counter()
+        results = yield from asyncio.gather(*[decoder.decode(uid) for uid in encoded])
+        elapsed = time.perf_counter() - start
+        running = False
+        yield from watcher
+    finally:
+        decoder.close()
+
+    assert [session for session, _, _ in results] == [str(i) for i in range(LOGINS)]
+    print("uniqueid decoding with {} workers: {:>8.0f} logins/s, longest loop stall {:>8.2f} ms".format(
+        workers, LOGINS / elapsed, longest_stall * 1000))
@@ -0,0 +1,58 @@
+"""
+Memory benchmarks for map/mod uploads
+
+Run with: py.test --slow -s tests/benchmarks
+"""
+import asyncio
+import os
+import struct
+import tracemalloc
+from asyncio import StreamReader
+from unittest import mock
+
+import pytest
+
+from server.protocol import QDataStreamProtocol
+
+slow = pytest.mark.slow
+
+CHUNK = 64 * 1024
+
+
+def upload_packet(size):
+    header = b''.join(QDataStreamProtocol.pack_qstring(part)
+                      for part in ['UPLOAD_MAP', 'Dostya', '42', 'scmp_001.zip', '{}'])
+    return struct.pack('!I', len(header) + 4 + size) + header + struct.pack('!i', size)
+
+
+@asyncio.coroutine
+def feed(reader, size):
+    reader.feed_data(upload_packet(size))
+    chunk = bytes(CHUNK)
+    for _ in range(size // CHUNK):
+        reader.feed_data(chunk)
+        yield from asyncio.sleep(0)
+
+
+@slow
+@pytest.mark.parametrize('size_mb', [1, 10, 50])
+@asyncio.coroutine
+def test_concurrent_upload_peak_memory(loop, size_mb):
+    size = size_mb * 1024 * 1024
+    uploads = 4
+    protocols = [QDataStreamProtocol(StreamReader(loop=loop), mock.Mock(), loop=loop)
+                 for _ in range(uploads)]
+
+    tracemalloc.start()
+    try:
+        messages = yield from asyncio.gather(*([p.read_message() for p in protocols] +
+                                               [feed(p.reader, size) for p in protocols]))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    for message in messages[:uploads]:
+        assert message['upload'].size == size
+        os.remove(message['upload'].path)
+
+    print("{} concurrent uploads of {:>3} MB: peak {:>10.1f} KB".format(uploads, size_mb, peak / 1024))
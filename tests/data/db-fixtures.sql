@@ -5,6 +5,7 @@ delete from login;
 insert into login (id, login, email, password) values (1, 'test', 'test@example.com', 'test_password');
 insert into login (id, login, email, password) values (2, 'Dostya', 'dostya@cybran.example.com', 'vodka');
 insert into login (id, login, email, password) values (3, 'Rhiza', 'rhiza@aeon.example.com', 'puff_the_magic_dragon');
+insert into login (id, login, email, password) values (4, 'Brackman', 'brackman@cybran.example.com', 'big_brain');
 
 -- global rating
 delete from global_rating;
@@ -24,7 +25,7 @@ values
 
 -- UniqueID_exempt
 delete from uniqueid_exempt;
-insert into uniqueid_exempt (user_id, reason) values (1, 'Because test');
+insert into uniqueid_exempt (user_id, reason) values (1, 'Because test'), (2, 'Because test'), (3, 'Because test');
 
 -- Lobby version table
 delete from version_lobby;
@@ -66,3 +67,24 @@ delete from friends_and_foes;
 insert into friends_and_foes (user_id, subject_id, `status`)
 values(42, 56, "FRIEND"),
       (42, 57, "FOE");
+
+delete from avatars;
+delete from avatars_list;
+insert into avatars_list (id, url, tooltip) values
+  (1, 'http://content.faforever.com/faf/avatars/qai2.png', 'QAI'),
+  (2, 'http://content.faforever.com/faf/avatars/UEF.png', 'UEF');
+insert into avatars (idUser, idAvatar, selected) values
+  (2, 1, 0),
+  (2, 2, 1);
+
+delete from ladder_division;
+insert into ladder_division (id, name, league, threshold) values
+  (1, 'L1D1', 1, 10),
+  (2, 'L1D2', 1, 30),
+  (3, 'L2D1', 2, 15);
+
+delete from ladder_season_5;
+insert into ladder_season_5 (idUser, league, score) values
+  (1, 1, 25),
+  (2, 1, 8),
+  (3, 2, 12);
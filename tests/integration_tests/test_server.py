@@ -46,11 +46,10 @@ from server.protocol import QDataStreamProtocol
 slow = pytest.mark.slow
 
 @pytest.fixture
-def lobby_server(request, loop, db_pool, player_service, game_service, db):
+def lobby_server(request, loop, db_pool, player_service, game_service):
     server = loop.run_until_complete(run_lobby_server(('127.0.0.1', None),
                                                       player_service,
                                                       game_service,
-                                                      db,
                                                       loop))
 
     def fin():
@@ -118,6 +117,19 @@ def test_server_valid_login(loop, lobby_server):
     proto.close()
     yield from lobby_server.wait_closed()
 
+@asyncio.coroutine
+@slow
+def test_server_invalid_uniqueid(loop, lobby_server):
+    proto = yield from connect_client(lobby_server)
+    yield from perform_login(proto, ('Brackman', 'big_brain'))
+    msg = yield from proto.read_message()
+    assert msg == {'command': 'notice',
+                   'style': 'error',
+                   'text': 'Your session is corrupted. Try relogging'}
+    lobby_server.close()
+    proto.close()
+    yield from lobby_server.wait_closed()
+
 @asyncio.coroutine
 def test_player_info_broadcast(loop, lobby_server):
     p1 = yield from connect_client(lobby_server)
@@ -133,6 +145,38 @@ def test_player_info_broadcast(loop, lobby_server):
     p1.close()
     p2.close()
 
+@asyncio.coroutine
+@slow
+def test_login_storm_does_not_block_loop(loop, lobby_server):
+    """
+    Logins wait on the database pool without holding up anybody else
+    """
+    lags = []
+    running = True
+
+    @asyncio.coroutine
+    def measure_lag():
+        while running:
+            start = loop.time()
+            yield from asyncio.sleep(0.01)
+            lags.append(loop.time() - start - 0.01)
+    ticker = asyncio.async(measure_lag())
+
+    credentials = [('Dostya', 'vodka'), ('Rhiza', 'puff_the_magic_dragon'), ('test', 'test_password')] * 20
+    protos = []
+    for _ in credentials:
+        protos.append((yield from connect_client(lobby_server)))
+    for proto, login in zip(protos, credentials):
+        yield from perform_login(proto, login)
+    yield from asyncio.gather(*[read_until(proto, lambda m: m['command'] == 'welcome') for proto in protos])
+
+    running = False
+    yield from ticker
+    for proto in protos:
+        proto.close()
+
+    assert max(lags) < 0.1
+
 @asyncio.coroutine
 def connect_and_sign_in(credentials, lobby_server):
     proto = yield from connect_client(lobby_server)
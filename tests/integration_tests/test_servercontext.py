@@ -1,8 +1,10 @@
 import asyncio
 import pytest
+import config
 from unittest import mock
 
-from server import ServerContext, QDataStreamProtocol
+from server import ServerContext
+from server.protocol import QDataStreamProtocol, SimpleJsonProtocol
 
 @pytest.fixture
 def mock_server(loop):
@@ -42,3 +44,164 @@ def test_serverside_abort(loop, mock_context, mock_server):
     yield from asyncio.sleep(0.1)
 
     mock_server.on_connection_lost.assert_any_call()
+
+
+def test_broadcast_encodes_once_per_protocol(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    legacy = [mock.create_autospec(QDataStreamProtocol(mock.Mock(), mock.Mock())) for _ in range(2)]
+    compact = mock.create_autospec(SimpleJsonProtocol(mock.Mock(), mock.Mock()))
+    for i, proto in enumerate(legacy + [compact]):
+        proto.get_write_buffer_size.return_value = 0
+        ctx.connections[i] = proto
+    message = {'command': 'game_info', 'uid': 1}
+
+    ctx.broadcast(message)
+
+    for proto in legacy:
+        proto.send_raw.assert_called_once_with(QDataStreamProtocol.encode_message(message), key=('game_info', 1))
+    compact.send_raw.assert_called_once_with(SimpleJsonProtocol.encode_message(message), key=('game_info', 1))
+
+
+def test_upgrade_protocol(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    reader, writer = mock.Mock(), mock.Mock()
+    ctx.connections['conn'] = QDataStreamProtocol(reader, writer)
+
+    proto = ctx.upgrade_protocol('conn', SimpleJsonProtocol)
+
+    assert isinstance(proto, SimpleJsonProtocol)
+    assert ctx.connections['conn'] is proto
+    assert (proto.reader, proto.writer) == (reader, writer)
+
+
+def test_upgrade_protocol_keeps_congestion_state(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    writer = mock.Mock()
+    old_proto = ctx.connections['conn'] = QDataStreamProtocol(mock.Mock(), writer)
+    old_proto.defer_raw(b'held back', key=('game_info', 1))
+    old_proto.over_limit_since = 42.0
+
+    proto = ctx.upgrade_protocol('conn', SimpleJsonProtocol)
+
+    # Held back broadcasts are encoded in the old protocol, so they go out before the switch
+    writer.writelines.assert_called_once_with([b'held back'])
+    assert proto.deferred_messages == 0
+    assert proto.over_limit_since == 42.0
+
+
+def test_upgrade_protocol_keeps_game_info_state(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    old_proto = ctx.connections['conn'] = QDataStreamProtocol(mock.Mock(), mock.Mock())
+    old_proto.game_info_deltas = True
+    old_proto.games_known.add(1)
+
+    proto = ctx.upgrade_protocol('conn', SimpleJsonProtocol)
+
+    assert proto.game_info_deltas
+    assert proto.games_known == {1}
+
+
+def test_broadcast_defers_for_slow_consumer(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    proto = mock.create_autospec(QDataStreamProtocol(mock.Mock(), mock.Mock()))
+    proto.get_write_buffer_size.return_value = config.WRITE_BUFFER_HIGH_WATER + 1
+    ctx.connections['slow'] = proto
+    message = {'command': 'game_info', 'uid': 1}
+
+    ctx.broadcast(message)
+
+    assert proto.send_raw.mock_calls == []
+    proto.defer_raw.assert_called_once_with(QDataStreamProtocol.encode_message(message), key=('game_info', 1))
+
+
+def test_deferred_broadcasts_conflate_and_resume(loop):
+    writer = mock.Mock()
+    proto = QDataStreamProtocol(mock.Mock(), writer)
+    proto.defer_raw(b'first', key=('game_info', 1))
+    proto.defer_raw(b'second', key=('game_info', 1))
+    proto.defer_raw(b'ping')
+
+    proto.resume_deferred()
+    proto.flush()
+
+    writer.writelines.assert_called_once_with([b'second'])
+    assert proto.messages_dropped == 1
+
+
+def test_check_write_buffers_evicts_slow_consumer(loop, mocker):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    ctx.loop = mock.Mock()
+    proto = mock.create_autospec(QDataStreamProtocol(mock.Mock(), mock.Mock()))
+    proto.get_write_buffer_size.return_value = config.WRITE_BUFFER_LIMIT + 1
+    proto.over_limit_since = None
+    ctx.connections['slow'] = proto
+
+    ctx.loop.time.return_value = 0
+    ctx.check_write_buffers()
+    assert proto.abort.mock_calls == []
+
+    ctx.loop.time.return_value = config.WRITE_BUFFER_LIMIT_TIMEOUT + 1
+    ctx.check_write_buffers()
+    proto.abort.assert_called_once_with()
+
+
+def delta_protocol(known=()):
+    proto = QDataStreamProtocol(mock.Mock(), mock.Mock())
+    proto.send_raw = mock.Mock()
+    proto.defer_raw = mock.Mock()
+    proto.get_write_buffer_size = mock.Mock(return_value=0)
+    proto.game_info_deltas = True
+    proto.games_known.update(known)
+    return proto
+
+
+def test_broadcast_game_info_sends_delta_to_opted_in(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    legacy = delta_protocol(known=[1])
+    legacy.game_info_deltas = False
+    fresh = delta_protocol()
+    known = delta_protocol(known=[1])
+    ctx.connections.update(legacy=legacy, fresh=fresh, known=known)
+    message = {'command': 'game_info', 'uid': 1, 'num_players': 2, 'title': 'Test'}
+
+    ctx.broadcast_game_info(message, {'num_players': 2})
+
+    full = QDataStreamProtocol.encode_message(message)
+    legacy.send_raw.assert_called_once_with(full, key=('game_info', 1))
+    fresh.send_raw.assert_called_once_with(full, key=('game_info', 1))
+    assert 1 in fresh.games_known
+    known.send_raw.assert_called_once_with(QDataStreamProtocol.encode_message(
+        {'command': 'game_info', 'uid': 1, 'delta': True, 'num_players': 2}))
+
+
+def test_broadcast_game_info_skips_empty_delta(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    known = delta_protocol(known=[1])
+    ctx.connections['known'] = known
+
+    ctx.broadcast_game_info({'command': 'game_info', 'uid': 1}, {})
+
+    assert known.send_raw.mock_calls == []
+
+
+def test_broadcast_game_info_defers_snapshot_when_congested(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    slow = delta_protocol(known=[1])
+    slow.get_write_buffer_size.return_value = config.WRITE_BUFFER_HIGH_WATER + 1
+    ctx.connections['slow'] = slow
+    message = {'command': 'game_info', 'uid': 1, 'num_players': 2}
+
+    ctx.broadcast_game_info(message, {'num_players': 2})
+
+    slow.defer_raw.assert_called_once_with(QDataStreamProtocol.encode_message(message), key=('game_info', 1))
+
+
+def test_broadcast_game_info_only_to_recipients(loop):
+    ctx = ServerContext(lambda: None, loop, name='TestServer')
+    friend, stranger = delta_protocol(), delta_protocol()
+    ctx.connections.update(friend=friend, stranger=stranger)
+
+    ctx.broadcast_game_info({'command': 'game_info', 'uid': 1}, recipients=['friend', 'gone'])
+
+    assert friend.send_raw.called
+    assert stranger.send_raw.mock_calls == []
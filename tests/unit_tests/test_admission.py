@@ -0,0 +1,86 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from server.admission import AdmissionController
+
+
+@pytest.fixture
+def admission(loop):
+    return AdmissionController(loop, min_limit=1, max_limit=2, latency_target=1, notice_interval=0.01)
+
+
+@asyncio.coroutine
+def test_logins_beyond_limit_queue_in_order(loop, admission):
+    admitted = []
+    releases = [asyncio.Future(), asyncio.Future(), asyncio.Future(), asyncio.Future()]
+
+    @asyncio.coroutine
+    def log_in(i):
+        with (yield from admission.admit()):
+            admitted.append(i)
+            yield from releases[i]
+
+    tasks = [asyncio.async(log_in(i)) for i in range(4)]
+    yield from asyncio.sleep(0)
+    assert admitted == [0, 1]
+    assert len(admission) == 2
+
+    releases[1].set_result(None)
+    yield from asyncio.sleep(0)
+    yield from asyncio.sleep(0)
+    assert admitted == [0, 1, 2]
+
+    for release in releases:
+        if not release.done():
+            release.set_result(None)
+    yield from asyncio.gather(*tasks)
+    assert admitted == [0, 1, 2, 3]
+    assert admission.active == 0
+
+
+@asyncio.coroutine
+def test_queued_logins_are_told_their_position(loop, admission):
+    release = asyncio.Future()
+    notify = mock.Mock()
+
+    @asyncio.coroutine
+    def hold():
+        with (yield from admission.admit()):
+            yield from release
+
+    holders = [asyncio.async(hold()), asyncio.async(hold())]
+    yield from asyncio.sleep(0)
+    first = asyncio.async(admission.admit(mock.Mock()))
+    second = asyncio.async(admission.admit(notify))
+    yield from asyncio.sleep(0)
+    notify.assert_called_once_with(2)
+
+    first.cancel()
+    yield from asyncio.sleep(0.05)
+    notify.assert_called_with(1)
+
+    release.set_result(None)
+    yield from asyncio.gather(*holders)
+    with (yield from second):
+        pass
+
+
+def test_limit_shrinks_when_logins_are_slow(admission):
+    admission.active = 2
+    admission._release(5)
+
+    assert admission.limit == 1.5
+    assert int(admission.limit) == 1
+
+    admission._release(5)
+    assert admission.limit == 1.5
+
+
+def test_limit_grows_when_logins_are_fast(admission):
+    admission.limit = 1.0
+    admission.active = 1
+    admission._release(0.1)
+
+    assert admission.limit == 2.0
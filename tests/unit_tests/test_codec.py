@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+from server.protocol import codec
+
+
+def test_dumps_roundtrip():
+    message = {'command': 'game_info', 'uid': 1, 'title': 'Ünïcödé', 'teams': {'1': ['Dostya']}}
+
+    assert json.loads(codec.dumps(message)) == message
+    assert codec.loads(codec.dumps_bytes(message)) == message
+
+
+def test_dumps_stringifies_keys_like_stdlib():
+    message = {'teams': {1: ['Dostya'], None: ['Rhiza']}}
+
+    assert json.loads(codec.dumps(message)) == json.loads(json.dumps(message))
+
+
+def test_loads_memoryview():
+    assert codec.loads(memoryview(b'{"command": "ping"}')) == {'command': 'ping'}
+
+
+def test_loads_falls_back_to_stdlib():
+    assert codec.loads('[NaN]')[0] != codec.loads('[NaN]')[0]
+    assert codec.loads('"\\ud800"') == '\ud800'
+
+
+def test_dumps_falls_back_to_stdlib():
+    assert json.loads(codec.dumps('\ud800')) == '\ud800'
+    assert json.loads(codec.dumps(2 ** 70)) == 2 ** 70
+
+
+def test_loads_raises_value_error():
+    with pytest.raises(ValueError):
+        codec.loads('Goodbye')
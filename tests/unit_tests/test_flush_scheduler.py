@@ -0,0 +1,100 @@
+from unittest import mock
+
+import pytest
+
+from server import stats
+from server.flush_scheduler import FlushScheduler
+
+
+@pytest.fixture
+def loop():
+    loop = mock.Mock()
+    loop.time.return_value = 0
+    return loop
+
+
+def make_scheduler(loop, pending=0, congestion=0.0, flushed=None):
+    flush = mock.Mock(return_value=pending if flushed is None else flushed)
+    return FlushScheduler(loop, 'test', flush,
+                          pending=lambda: pending,
+                          congestion=lambda: congestion,
+                          min_interval=0.25, max_interval=5,
+                          lag_budget=0.1, congestion_budget=0.1, batch_budget=100)
+
+
+def next_interval(loop):
+    (interval, _), _ = loop.call_later.call_args
+    return interval
+
+
+def test_idle_server_flushes_fast(loop):
+    scheduler = make_scheduler(loop, pending=1)
+    scheduler.start()
+    loop.call_later.assert_called_once_with(0.25, scheduler.run)
+
+    scheduler.run()
+
+    scheduler._flush.assert_called_once_with()
+    assert next_interval(loop) == pytest.approx(0.25 + 4.75 * 0.01)
+
+
+def test_nothing_pending_skips_flush(loop):
+    scheduler = make_scheduler(loop)
+    scheduler.start()
+    scheduler.run()
+
+    assert scheduler._flush.mock_calls == []
+    assert next_interval(loop) == 0.25
+
+
+@pytest.mark.parametrize('lag,congestion,pending', [
+    (0.1, 0.0, 0),
+    (0.0, 0.5, 0),
+    (0.0, 0.0, 1000),
+])
+def test_load_backs_off_to_max_interval(loop, lag, congestion, pending):
+    scheduler = make_scheduler(loop, pending=pending, congestion=congestion)
+    scheduler.start()
+    loop.time.return_value = 0.25 + lag
+    scheduler.run()
+
+    assert next_interval(loop) == pytest.approx(5)
+
+
+def test_load_decays(loop):
+    scheduler = make_scheduler(loop)
+    scheduler.load = 1.0
+    scheduler.start()
+    scheduler.run()
+
+    assert scheduler.load == 0.5
+    assert next_interval(loop) == pytest.approx(0.25 + 4.75 * 0.5)
+
+
+def test_failed_flush_is_rescheduled(loop):
+    scheduler = make_scheduler(loop, pending=1)
+    scheduler._flush.side_effect = ValueError
+    scheduler.start()
+    scheduler.run()
+
+    assert loop.call_later.call_count == 2
+
+
+def test_records_stats(loop):
+    stats.flushes.clear()
+    stats.flush_sizes.clear()
+    scheduler = make_scheduler(loop, pending=3, flushed=2)
+    scheduler.start()
+    scheduler.run()
+
+    assert stats.flushes['test duration'].count == 1
+    assert stats.flushes['test interval'].count == 1
+    assert stats.flush_sizes['test'].total == 2
+
+
+def test_stop(loop):
+    scheduler = make_scheduler(loop)
+    scheduler.start()
+    scheduler.stop()
+
+    loop.call_later.return_value.cancel.assert_called_once_with()
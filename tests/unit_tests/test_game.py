@@ -246,6 +246,34 @@ def test_to_dict(game, create_player):
     }
     assert data == expected
 
+
+def test_to_dict_cached_until_version_bump(game, players):
+    data = game.to_dict()
+    assert game.to_dict() is data
+
+    game.set_player_option(players.hosting.id, 'Team', 1)
+    assert game.to_dict() is not data
+
+    data = game.to_dict()
+    game.name = 'Renamed'
+    game.bump_version()
+    assert game.to_dict()['title'] == 'Renamed'
+
+
+def test_to_dict_follows_assigned_attributes(game, players):
+    game.to_dict()
+
+    game.name = 'Renamed'
+    game.host = players.hosting
+    game.max_players = 4
+    game.state = GameState.LOBBY
+
+    data = game.to_dict()
+    assert data['title'] == 'Renamed'
+    assert data['host'] == players.hosting.login
+    assert data['max_players'] == 4
+    assert data['state'] == 'open'
+
 # Eeeeeeeewwwww
 def test_equality(game):
     assert game == game
@@ -6,7 +6,8 @@ import json
 from unittest import mock
 import pytest
 
-from server import proxy_map
+from server import proxy_map, stats
+from server.liveness import LivenessWheel
 from server.connectivity import Connectivity, ConnectivityState
 from server.games import Game
 from server.players import PlayerState
@@ -42,33 +43,43 @@ def test_on_connection_made_no_game(game_connection, players):
 
     game_connection.abort.assert_any_call()
 
-@asyncio.coroutine
 def test_ping_miss(game_connection):
+    liveness = LivenessWheel(mock.Mock(), idle=20, timeout=20)
+    liveness.loop.time.return_value = 0
     game_connection.abort = mock.Mock()
-    game_connection.last_pong = 0
+    game_connection.protocol = mock.Mock()
+    liveness.add(game_connection)
 
-    asyncio.async(game_connection.ping())
-    yield from asyncio.sleep(0.1)
+    for now in range(1, 41):
+        liveness.loop.time.return_value = now
+        liveness.advance()
 
     game_connection.abort.assert_any_call()
+    assert game_connection not in liveness
+
 
 @asyncio.coroutine
 def test_ping_hit(game_connection):
+    liveness = LivenessWheel(mock.Mock(), idle=20, timeout=20)
+    liveness.loop.time.return_value = 0
+    game_connection.liveness = liveness
     game_connection.abort = mock.Mock()
     protocol = mock.Mock()
     game_connection.protocol = protocol
-
-    asyncio.async(game_connection.ping())
-    yield from asyncio.sleep(0.1)
-
-    protocol.send_message.assert_any_call({
-        'key': 'ping',
-        'commands': []
-    })
-    for i in range(1, 3):
-        game_connection.handle_action('pong', [])
-        game_connection.ping()
+    liveness.add(game_connection)
+
+    for now in range(1, 101):
+        liveness.loop.time.return_value = now
+        liveness.advance()
+        if protocol.send_message.called:
+            protocol.send_message.assert_called_once_with({
+                'key': 'ping',
+                'commands': []
+            })
+            protocol.send_message.reset_mock()
+            yield from game_connection.handle_action('pong', [])
     assert game_connection.abort.mock_calls == []
+    assert game_connection in liveness
 
 
 def test_abort(game_connection, game, players, connected_game_socket):
@@ -222,6 +233,23 @@ def test_handle_action_GameResult_calls_add_result(game, loop, game_connection):
     game.add_result.assert_called_once_with(game_connection.player, 0, 'score', -5)
 
 
+def test_handle_action_records_timing(game, loop, game_connection):
+    stats.game_actions.clear()
+
+    loop.run_until_complete(game_connection.handle_action('GameOption', ['Slots', 8]))
+
+    assert stats.game_actions['GameOption'].count == 1
+
+
+def test_handle_action_unknown_ignored(loop, game_connection):
+    game_connection.abort = mock.Mock()
+
+    loop.run_until_complete(game_connection.handle_action('NoSuchAction', []))
+
+    assert game_connection.abort.mock_calls == []
+    assert 'NoSuchAction' not in stats.game_actions
+
+
 def test_on_connection_lost_proxy_cleanup(game_connection, players):
     game_connection.game = mock.Mock()
     game_connection.game.proxy = mock.Mock()
@@ -1,6 +1,12 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
 import server
 from server.game_service import GameService
-from server.games.game import VisibilityState
+from server.games import GameFilter
+from server.games.game import GameState, VisibilityState
 from server.players import PlayerState
 
 def test_initialization(loop, players, db_pool):
@@ -8,6 +14,25 @@ def test_initialization(loop, players, db_pool):
     assert len(service.dirty_games) == 0
 
 
+@asyncio.coroutine
+def test_ladder_leaderboard_refreshed_periodically(loop, players, db_pool):
+    service = GameService(players)
+    refreshes = []
+
+    @asyncio.coroutine
+    def refresh():
+        refreshes.append(loop.time())
+
+    service.ladder_leaderboard.refresh = refresh
+    service.leaderboard_refresh_interval = 0.01
+    service.schedule_leaderboard_refresh()
+
+    yield from asyncio.sleep(0.1)
+    service._leaderboard_refresh.cancel()
+
+    assert len(refreshes) >= 2
+
+
 def test_create_game(loop, players, db_pool):
     players.hosting.state = PlayerState.IDLE
     service = GameService(players)
@@ -29,3 +54,75 @@ def test_all_games(loop, players, db_pool):
                                mapname='SCMP_007',
                                password=None)
     assert game in service.pending_games
+
+
+def test_snapshot_game_info_changes(loop, players, db_pool):
+    service = GameService(players)
+    game = service.create_game(visibility=VisibilityState.PUBLIC,
+                               game_mode='faf',
+                               host=players.hosting,
+                               name='Test',
+                               mapname='SCMP_007',
+                               password=None)
+
+    message, changes = service.snapshot_game_info(game)
+    assert changes is None
+    assert service.game_info(game) is message
+
+    game.name = 'Renamed'
+    service.mark_dirty(game)
+    message, changes = service.snapshot_game_info(game)
+    assert changes == {'title': 'Renamed'}
+
+    service.remove_game(game)
+    _, changes = service.snapshot_game_info(game)
+    assert changes is None
+
+
+def test_snapshot_game_info_unchanged_game(loop, players, db_pool):
+    service = GameService(players)
+    game = service.create_game(visibility=VisibilityState.PUBLIC,
+                               game_mode='faf',
+                               host=players.hosting,
+                               name='Test',
+                               mapname='SCMP_007',
+                               password=None)
+    message, _ = service.snapshot_game_info(game)
+    service.encoded_game_info(game)['proto'] = b'encoded'
+
+    assert service.snapshot_game_info(game) == (message, {})
+    assert service.encoded_game_info(game) == {'proto': b'encoded'}
+
+
+def test_game_subscribers(loop, players, db_pool):
+    service = GameService(players)
+    game = service.create_game(visibility=VisibilityState.PUBLIC,
+                               game_mode='faf',
+                               host=players.hosting,
+                               name='Test',
+                               mapname='SCMP_007',
+                               password=None)
+    game.state = GameState.LOBBY
+    legacy, faf, coop, gone = (mock.Mock() for _ in range(4))
+    for conn in (legacy, faf, coop, gone):
+        conn.protocol.games_known = set()
+    gone.protocol.games_known.add(game.id)
+    service.subscribe(faf, GameFilter.from_message({'featured_mod': 'faf', 'state': 'open'}))
+    service.subscribe(coop, GameFilter.from_message({'featured_mod': 'coop'}))
+    service.subscribe(gone, GameFilter.from_message({'state': 'closed'}))
+
+    recipients, leaving = service.game_subscribers(game, [legacy, faf, coop, gone])
+
+    assert recipients == [legacy, faf, gone]
+    assert leaving == [gone]
+    assert service.matching_games(GameFilter.from_message({'featured_mod': 'faf'})) == [game]
+    assert service.matching_games(GameFilter.from_message({'featured_mod': 'coop'})) == []
+
+    service.unsubscribe(coop)
+    recipients, _ = service.game_subscribers(game, [coop])
+    assert recipients == [coop]
+
+
+def test_game_filter_rejects_bad_state():
+    with pytest.raises(ValueError):
+        GameFilter.from_message({'state': 'bogus'})
@@ -0,0 +1,61 @@
+from unittest import mock
+
+import pytest
+
+from server.geoip_service import GeoIpService
+
+
+@pytest.fixture
+def geoip():
+    return GeoIpService('GeoIP.dat', cache_size=2, prefix=24)
+
+
+def test_country_code(geoip):
+    assert geoip.country_code('8.8.8.8') == 'US'
+    assert geoip.country_code('81.1.2.3') == 'FR'
+
+
+def test_unknown_addresses(geoip):
+    assert geoip.country_code('127.0.0.1') is None
+    assert geoip.country_code('::1') is None
+    assert geoip.country_code('garbage') is None
+    assert geoip.country_code(None) is None
+
+
+def test_lookups_are_cached_by_prefix(geoip):
+    geoip._db = mock.Mock()
+    geoip._db.country_code_by_addr.return_value = 'DK'
+
+    assert geoip.country_code('10.0.0.1') == 'DK'
+    assert geoip.country_code('10.0.0.200') == 'DK'
+
+    geoip._db.country_code_by_addr.assert_called_once_with('10.0.0.1')
+    assert (geoip.hits, geoip.misses) == (1, 1)
+
+
+def test_least_recently_used_prefix_is_evicted(geoip):
+    geoip._db = mock.Mock()
+    geoip._db.country_code_by_addr.return_value = 'DK'
+
+    geoip.country_code('10.0.1.1')
+    geoip.country_code('10.0.2.1')
+    geoip.country_code('10.0.1.2')
+    geoip.country_code('10.0.3.1')
+    assert len(geoip) == 2
+
+    geoip.country_code('10.0.1.3')
+    geoip.country_code('10.0.2.2')
+    assert geoip._db.country_code_by_addr.call_count == 4
+
+
+def test_country_codes(geoip):
+    geoip._db = mock.Mock()
+    geoip._db.country_code_by_addr.side_effect = lambda ip: 'US' if ip.startswith('8.') else 'FR'
+
+    assert geoip.country_codes(['8.8.8.8', '8.8.8.4', '81.1.2.3', '::1']) == {
+        '8.8.8.8': 'US',
+        '8.8.8.4': 'US',
+        '81.1.2.3': 'FR',
+        '::1': None
+    }
+    assert geoip._db.country_code_by_addr.call_count == 2
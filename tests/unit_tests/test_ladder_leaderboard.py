@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from server.games import LadderLeaderboard
+
+
+@pytest.fixture
+def leaderboard():
+    leaderboard = LadderLeaderboard()
+    leaderboard._divisions = {
+        1: [(10, 'Bronze'), (30, 'Silver')],
+        2: [(50, 'Gold')]
+    }
+    scores = {1: 29, 2: 25, 3: 20, 4: 9, 5: 8, 6: 7, 7: 5, 8: 40}
+    for player_id, score in scores.items():
+        leaderboard.update(player_id, 1, score)
+    return leaderboard
+
+
+def test_division(leaderboard):
+    assert leaderboard.division(1) == (1, 'Silver', 30)
+    assert leaderboard.division(4) == (1, 'Bronze', 10)
+    assert leaderboard.division(8) is None
+    assert leaderboard.division(42) is None
+
+
+def test_division_place(leaderboard):
+    assert [leaderboard.division_place(player_id) for player_id in range(1, 8)] == [1, 2, 3, 1, 2, 3, None]
+
+
+def test_league_place(leaderboard):
+    assert [leaderboard.league_place(player_id) for player_id in (8, 1, 2, 3)] == [1, 2, 3, None]
+
+
+def test_small_divisions_have_no_places(leaderboard):
+    leaderboard.update(9, 2, 30)
+    leaderboard.update(10, 2, 20)
+
+    assert leaderboard.division_place(9) is None
+    assert leaderboard.league_place(9) is None
+
+
+def test_update_moves_player(leaderboard):
+    leaderboard.update(7, 1, 28)
+
+    assert leaderboard.division(7) == (1, 'Silver', 30)
+    assert leaderboard.league_place(7) == 3
+    assert leaderboard.league_place(2) is None
+    # Bronze is down to three players
+    assert leaderboard.division_place(4) is None
+
+    leaderboard.update(7, 2, 0)
+    assert leaderboard.division(7) == (2, 'Gold', 50)
+    assert leaderboard.league_place(2) == 3
+
+
+def test_zero_score_has_no_place(leaderboard):
+    for player_id in range(11, 15):
+        leaderboard.update(player_id, 2, 0)
+
+    assert leaderboard.league_place(11) is None
+
+
+@asyncio.coroutine
+def test_refresh(mock_db_pool):
+    leaderboard = LadderLeaderboard()
+
+    yield from leaderboard.refresh()
+
+    assert len(leaderboard) == 3
+    assert leaderboard.division(1) == (1, 'L1D2', 30)
+    assert leaderboard.division(2) == (1, 'L1D1', 10)
+    assert leaderboard.division(3) == (2, 'L2D1', 15)
@@ -1,3 +1,4 @@
+import asyncio
 from unittest import mock
 import pytest
 
@@ -21,3 +22,21 @@ def test_results_ranked_by_victory(laddergame, players):
     assert laddergame.get_army_result(0) == 1
     assert laddergame.get_army_result(1) == 0
 
+
+
+@asyncio.coroutine
+def test_game_end_with_unranked_player(laddergame, players, create_player, mock_db_pool):
+    unranked = create_player(login='Brackman', id=4)
+    players.hosting.league = 2
+    unranked.league = None
+    leaderboard = laddergame.game_service.ladder_leaderboard
+    leaderboard.division.return_value = None
+    laddergame.state = GameState.LOBBY
+    add_connected_players(laddergame, [players.hosting, unranked])
+    laddergame.add_result(players.hosting, 0, 'victory', 1)
+    laddergame.add_result(unranked, 1, 'defeat', 0)
+
+    yield from laddergame._on_game_end()
+
+    # Only the ranked player has a score in the season to update
+    leaderboard.update.assert_called_once_with(1, 1, mock.ANY)
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import struct
+from asyncio import StreamReader
+from unittest import mock
+
+import pytest
+
+from server import stats
+from server.liveness import LivenessWheel
+from server.protocol import QDataStreamProtocol
+from server.protocol.protocol import UPLOAD_CHUNK_SIZE
+
+
+@pytest.fixture
+def wheel():
+    wheel = LivenessWheel(mock.Mock(), idle=10, timeout=5, tick=1, slots=8)
+    wheel.loop.time.return_value = 0
+    return wheel
+
+
+def run_until(wheel, until):
+    while wheel.loop.time.return_value < until:
+        wheel.loop.time.return_value += 1
+        wheel.advance()
+
+
+def test_idle_connection_is_pinged(wheel):
+    connection = mock.Mock()
+    wheel.add(connection)
+
+    run_until(wheel, 9)
+    assert connection.send_ping.mock_calls == []
+    run_until(wheel, 10)
+    connection.send_ping.assert_called_once_with()
+
+
+def test_active_connection_is_not_pinged(wheel):
+    connection = mock.Mock()
+    wheel.add(connection)
+
+    for until in range(5, 50, 5):
+        run_until(wheel, until)
+        wheel.seen(connection)
+
+    assert connection.send_ping.mock_calls == []
+
+
+def test_silent_connection_is_reaped(wheel):
+    connection = mock.Mock()
+    wheel.add(connection)
+
+    run_until(wheel, 14)
+    assert connection.abort.mock_calls == []
+    run_until(wheel, 15)
+    connection.abort.assert_called_once_with()
+    assert connection not in wheel
+
+
+def test_pong_records_round_trip(wheel):
+    stats.round_trips.clear()
+    connection = mock.Mock()
+    wheel.add(connection)
+
+    run_until(wheel, 12)
+    wheel.pong(connection)
+    run_until(wheel, 26)
+
+    assert stats.round_trips['Mock'].count == 1
+    assert stats.round_trips['Mock'].max == 2
+    assert connection.abort.mock_calls == []
+    assert connection.send_ping.call_count == 2
+
+
+def test_remove(wheel):
+    connection = mock.Mock()
+    wheel.add(connection)
+    wheel.remove(connection)
+    wheel.remove(connection)
+
+    run_until(wheel, 30)
+    assert len(wheel) == 0
+    assert connection.send_ping.mock_calls == []
+
+
+@asyncio.coroutine
+def test_slow_upload_is_not_reaped(loop, wheel):
+    connection = mock.Mock()
+    wheel.add(connection)
+    protocol = QDataStreamProtocol(StreamReader(loop=loop), mock.Mock(), loop=loop)
+    protocol.on_data = lambda: wheel.seen(connection)
+    # One chunk a second, taking twice as long as idle and timeout together
+    chunks = 30
+    size = chunks * UPLOAD_CHUNK_SIZE
+    packet = QDataStreamProtocol.pack_block(b''.join([QDataStreamProtocol.pack_qstring(part)
+                                                      for part in ['UPLOAD_MAP', 'Dostya', '42',
+                                                                   'scmp_001.zip', '{}']] +
+                                                     [struct.pack('!i', size), bytes(size)]))
+    payload_start = len(packet) - size
+
+    protocol.reader.feed_data(packet[:payload_start])
+    read = asyncio.async(protocol.read_message())
+    for i in range(chunks):
+        run_until(wheel, wheel.loop.time.return_value + 1)
+        start = payload_start + i * UPLOAD_CHUNK_SIZE
+        protocol.reader.feed_data(packet[start:start + UPLOAD_CHUNK_SIZE])
+        yield from asyncio.sleep(0)
+    message = yield from read
+    os.remove(message['upload'].path)
+
+    assert message['upload'].size == size
+    assert connection.abort.mock_calls == []
+    assert connection.send_ping.mock_calls == []
@@ -1,12 +1,19 @@
+import asyncio
+
+import pymysql
 import pytest
 from unittest import mock
-from server import ServerContext, QDataStreamProtocol, GameState, VisibilityState
+from server import ServerContext, GameState, VisibilityState
+from server.protocol import QDataStreamProtocol
 
 from server.game_service import GameService
 from server.games import Game
-from server.lobbyconnection import LobbyConnection
+from server import stats
+from server.admission import AdmissionController
+from server.lobbyconnection import LobbyConnection, login_stage, negotiate_protocol_version
 from server.player_service import PlayerService
 from server.players import Player
+from server.session_service import SessionService
 
 
 @pytest.fixture()
@@ -56,12 +63,11 @@ def mock_protocol():
     return mock.create_autospec(QDataStreamProtocol(mock.Mock(), mock.Mock()))
 
 @pytest.fixture
-def lobbyconnection(loop, mock_context, mock_protocol, mock_games, mock_players, mock_player, db):
+def lobbyconnection(loop, mock_context, mock_protocol, mock_games, mock_players, mock_player):
     lc = LobbyConnection(loop,
                          context=mock_context,
                          games=mock_games,
-                         players=mock_players,
-                         db=db)
+                         players=mock_players)
     lc.player = mock_player
     lc.protocol = mock_protocol
     return lc
@@ -137,62 +143,98 @@ def test_ask_session(lobbyconnection):
     assert response['command'] == 'session'
 
 # Avatar
+@asyncio.coroutine
+def selected_avatar(db_pool, user_id):
+    with (yield from db_pool) as conn:
+        cursor = yield from conn.cursor()
+        yield from cursor.execute("SELECT idAvatar FROM avatars WHERE idUser = %s AND selected = 1", user_id)
+        if cursor.rowcount == 0:
+            return None
+        (avatar_id, ) = yield from cursor.fetchone()
+        return avatar_id
+
+@asyncio.coroutine
 def test_avatar_upload_user(lobbyconnection):
     lobbyconnection.sendJSON = mock.Mock()
     lobbyconnection.player = mock.Mock()
     lobbyconnection.player.admin.return_value = False
     with pytest.raises(KeyError):
-        lobbyconnection.command_avatar({'action': 'upload_avatar',
-                                         'name': '', 'file': '', 'description': ''})
-
-def test_avatar_list_avatar(mocker, lobbyconnection):
-    mock_query = mocker.patch('server.lobbyconnection.QSqlQuery')
+        yield from lobbyconnection.command_avatar({'action': 'upload_avatar',
+                                                   'name': '', 'file': '', 'description': ''})
 
+@asyncio.coroutine
+def test_avatar_list_avatar(lobbyconnection):
     lobbyconnection.sendJSON = mock.Mock()
-    mock_query.return_value.size.return_value = 1
-    mock_query.return_value.next.side_effect = [True, True, False]
-    lobbyconnection.command_avatar({'action': 'list_avatar'})
+    lobbyconnection.player.id = 2
+    yield from lobbyconnection.command_avatar({'action': 'list_avatar'})
     (response, ), _ = lobbyconnection.sendJSON.call_args
     assert response['command'] == 'avatar'
     assert len(response['avatarlist']) == 2
 
 # TODO: @sheeo return JSON message on empty avatar list?
-def test_avatar_list_avatar_empty(mocker, lobbyconnection):
-    mock_query = mocker.patch('server.lobbyconnection.QSqlQuery')
-
+@asyncio.coroutine
+def test_avatar_list_avatar_empty(lobbyconnection):
     lobbyconnection.sendJSON = mock.Mock()
-    mock_query.return_value.size.return_value = 0
-    lobbyconnection.command_avatar({'action': 'list_avatar'})
+    lobbyconnection.player.id = 3
+    yield from lobbyconnection.command_avatar({'action': 'list_avatar'})
     assert lobbyconnection.sendJSON.mock_calls == []
 
-def test_avatar_select(mocker, lobbyconnection):
-    mock_query = mocker.patch('server.lobbyconnection.QSqlQuery')
-
+@asyncio.coroutine
+def test_avatar_select(lobbyconnection, mock_db_pool):
     lobbyconnection.sendJSON = mock.Mock()
-    lobbyconnection.command_avatar({'action': 'select', 'avatar': ''})
-    assert mock_query.return_value.exec_.call_count == 2
+    lobbyconnection.player.id = 2
+    yield from lobbyconnection.command_avatar({'action': 'select',
+                                               'avatar': 'http://content.faforever.com/faf/avatars/qai2.png'})
+    assert (yield from selected_avatar(mock_db_pool, 2)) == 1
 
-def test_avatar_select_remove(mocker, lobbyconnection):
-    mock_query = mocker.patch('server.lobbyconnection.QSqlQuery')
+    yield from lobbyconnection.command_avatar({'action': 'select',
+                                               'avatar': 'http://content.faforever.com/faf/avatars/UEF.png'})
+    assert (yield from selected_avatar(mock_db_pool, 2)) == 2
 
+@asyncio.coroutine
+def test_avatar_select_remove(lobbyconnection, mock_db_pool):
     lobbyconnection.sendJSON = mock.Mock()
-    lobbyconnection.command_avatar({'action': 'select', 'avatar': None})
-    assert mock_query.return_value.exec_.call_count == 1
+    lobbyconnection.player.id = 2
+    yield from lobbyconnection.command_avatar({'action': 'select', 'avatar': None})
+    assert (yield from selected_avatar(mock_db_pool, 2)) is None
+
+    yield from lobbyconnection.command_avatar({'action': 'select',
+                                               'avatar': 'http://content.faforever.com/faf/avatars/UEF.png'})
 
-def test_avatar_select_no_avatar(mocker, lobbyconnection):
-    mocker.patch('server.lobbyconnection.QSqlQuery')
+@asyncio.coroutine
+def test_avatar_select_no_avatar(lobbyconnection):
     with pytest.raises(KeyError):
-        lobbyconnection.command_avatar({'action': 'select'})
+        yield from lobbyconnection.command_avatar({'action': 'select'})
+
+@pytest.mark.parametrize('requested, negotiated', [
+    (None, 1), (1, 1), (2, 2), ('2', 2), (99, 2), (0, 1), (-3, 1), ('two', 1), ([2], 1)
+])
+def test_negotiate_protocol_version(requested, negotiated):
+    message = {'command': 'hello'}
+    if requested is not None:
+        message['protocol_version'] = requested
+
+    assert negotiate_protocol_version(message) == negotiated
+
 
 def test_send_game_list(mocker, lobbyconnection):
-    protocol = mocker.patch.object(lobbyconnection, 'protocol')
+    protocol = lobbyconnection.protocol = QDataStreamProtocol(mock.Mock(), mock.Mock())
+    send_raw = mocker.patch.object(protocol, 'send_raw')
     games = mocker.patch.object(lobbyconnection, 'game_service')
-    game1, game2 = mock.create_autospec(Game(42, mock.Mock())), mock.create_autospec(Game(22, mock.Mock()))
+    game1, game2 = mock.Mock(id=42), mock.Mock(id=22)
     games.live_games = [game1, game2]
+    # game1 has been broadcast already, game2 not yet
+    encoded = {game1: {QDataStreamProtocol: b'game1'}, game2: {}}
+    games.encoded_game_info.side_effect = encoded.get
+    games.game_info.return_value = {'command': 'game_info', 'uid': 22}
 
     lobbyconnection.send_game_list()
 
-    protocol.send_messages.assert_any_call([game1.to_dict(), game2.to_dict()])
+    game2_encoded = QDataStreamProtocol.encode_message({'command': 'game_info', 'uid': 22})
+    assert send_raw.call_args_list == [mock.call(b'game1', key=('game_info', 42)),
+                                       mock.call(game2_encoded, key=('game_info', 22))]
+    assert encoded[game2] == {QDataStreamProtocol: game2_encoded}
+    assert protocol.games_known == {42, 22}
 
 def test_send_mod_list(mocker, lobbyconnection, mock_games):
     protocol = mocker.patch.object(lobbyconnection, 'protocol')
@@ -201,6 +243,7 @@ def test_send_mod_list(mocker, lobbyconnection, mock_games):
 
     protocol.send_messages.assert_called_with(mock_games.all_game_modes())
 
+@asyncio.coroutine
 def test_command_admin_closelobby(mocker, lobbyconnection):
     mocker.patch.object(lobbyconnection, 'protocol')
     mocker.patch.object(lobbyconnection, '_logger')
@@ -211,7 +254,7 @@ def test_command_admin_closelobby(mocker, lobbyconnection):
     tuna.id = 55
     lobbyconnection.player_service = {1: player, 55: tuna}
 
-    lobbyconnection.command_admin({
+    yield from lobbyconnection.command_admin({
         'command': 'admin',
         'action': 'closelobby',
         'user_id': 55
@@ -225,6 +268,7 @@ def test_command_admin_closelobby(mocker, lobbyconnection):
               .format(rule_link=config.RULE_LINK))
     ))
 
+@asyncio.coroutine
 def test_command_admin_closeFA(mocker, lobbyconnection):
     mocker.patch.object(lobbyconnection, 'protocol')
     mocker.patch.object(lobbyconnection, '_logger')
@@ -236,7 +280,7 @@ def test_command_admin_closeFA(mocker, lobbyconnection):
     tuna.id = 55
     lobbyconnection.player_service = {42: player, 55: tuna}
 
-    lobbyconnection.command_admin({
+    yield from lobbyconnection.command_admin({
         'command': 'admin',
         'action': 'closeFA',
         'user_id': 55
@@ -250,3 +294,286 @@ def test_command_admin_closeFA(mocker, lobbyconnection):
               .format(rule_link=config.RULE_LINK))
     ))
 
+
+
+def test_command_handlers_table():
+    handlers = LobbyConnection.command_handlers()
+
+    assert handlers is LobbyConnection.command_handlers()
+    assert not handlers['hello'].requires_auth
+    assert handlers['hello'].is_coroutine
+    assert handlers['game_host'].requires_auth
+    assert not handlers['game_host'].is_coroutine
+
+
+@asyncio.coroutine
+def test_unauthenticated_command_not_dispatched(mocker, lobbyconnection):
+    lobbyconnection.abort = mock.Mock()
+    host = mocker.patch.object(LobbyConnection, 'command_game_host')
+    LobbyConnection._command_handlers = None
+
+    try:
+        yield from lobbyconnection.on_message_received({'command': 'game_host'})
+    finally:
+        LobbyConnection._command_handlers = None
+
+    lobbyconnection.abort.assert_any_call(mock.ANY)
+    assert not host.called
+
+
+@asyncio.coroutine
+def test_command_latency_recorded(lobbyconnection):
+    stats.lobby_commands.clear()
+
+    yield from lobbyconnection.on_message_received({'command': 'ping'})
+
+    assert stats.lobby_commands['ping'].count == 1
+
+
+@asyncio.coroutine
+def test_fetch_social(lobbyconnection, mock_db_pool):
+    friends, foes = yield from lobbyconnection.fetch_social(Player(login='Dummy', id=42))
+
+    assert friends == [56]
+    assert foes == [57]
+
+
+@asyncio.coroutine
+def test_social_add_and_remove(lobbyconnection, mock_db_pool):
+    player = lobbyconnection.player = Player(login='Dummy', id=42)
+
+    yield from lobbyconnection.command_social_add({'command': 'social_add', 'friend': 58})
+    assert player.friends == {58}
+    assert (yield from lobbyconnection.fetch_social(player)) == ([56, 58], [57])
+
+    # Turning a friend into a foe
+    yield from lobbyconnection.command_social_add({'command': 'social_add', 'foe': 58})
+    assert player.friends == set()
+    assert player.foes == {58}
+    assert (yield from lobbyconnection.fetch_social(player)) == ([56], [57, 58])
+
+    yield from lobbyconnection.command_social_remove({'command': 'social_remove', 'foe': 58})
+    assert player.foes == set()
+    assert (yield from lobbyconnection.fetch_social(player)) == ([56], [57])
+
+
+@asyncio.coroutine
+def test_social_lists_unchanged_when_write_fails(lobbyconnection, mocker):
+    @asyncio.coroutine
+    def execute(*args):
+        raise pymysql.OperationalError(2013, "Lost connection to MySQL server during query")
+
+    conn = mock.MagicMock()
+    conn.__enter__.return_value = conn
+    conn.cursor = asyncio.coroutine(lambda: mock.Mock(execute=execute))
+    pool = asyncio.Future()
+    pool.set_result(conn)
+    mocker.patch('server.db.db_pool', pool)
+    player = lobbyconnection.player = Player(login='Dummy', id=42)
+    player.friends = {56}
+    player.foes = {57}
+
+    with pytest.raises(pymysql.OperationalError):
+        yield from lobbyconnection.command_social_add({'command': 'social_add', 'friend': 57})
+    with pytest.raises(pymysql.OperationalError):
+        yield from lobbyconnection.command_social_remove({'command': 'social_remove', 'friend': 56})
+
+    assert player.friends == {56}
+    assert player.foes == {57}
+
+
+@asyncio.coroutine
+def test_fetch_avatar(lobbyconnection, mock_db_pool):
+    assert (yield from lobbyconnection.fetch_avatar(Player(login='Dostya', id=2))) == {
+        'url': 'http://content.faforever.com/faf/avatars/UEF.png',
+        'tooltip': 'UEF'
+    }
+    assert (yield from lobbyconnection.fetch_avatar(Player(login='Rhiza', id=3))) is None
+
+
+@asyncio.coroutine
+def test_login_stage_recorded():
+    stats.login_stages.clear()
+
+    @asyncio.coroutine
+    def stage():
+        return 42
+
+    assert (yield from login_stage('test', stage())) == 42
+    assert stats.login_stages['test'].count == 1
+
+
+@asyncio.coroutine
+def test_rejected_uniqueid_leaves_connection_unauthenticated(lobbyconnection, mock_db_pool, mock_players):
+    @asyncio.coroutine
+    def decode(encoded):
+        return 'another session', 'some hash', ()
+
+    mock_players.client_version_info = (0, None)
+    mock_players.is_uniqueid_exempt.return_value = False
+    lobbyconnection.uniqueid = mock.Mock(decode=decode)
+    lobbyconnection.player = None
+
+    yield from lobbyconnection.log_in({'command': 'hello', 'version': 0, 'login': 'test',
+                                       'password': 'test_password', 'unique_id': 'some_id'})
+
+    assert not lobbyconnection.authenticated
+    assert lobbyconnection.player is None
+    assert not mock_players.addUser.called
+
+
+@asyncio.coroutine
+def test_login_ip_written_without_write_behind_queue(lobbyconnection, mock_db_pool):
+    @asyncio.coroutine
+    def decode(encoded):
+        return str(lobbyconnection.session), 'some hash', ('some value',) * 9
+
+    lobbyconnection.uniqueid = mock.Mock(decode=decode)
+    lobbyconnection.ip = '10.0.2.1'
+    assert lobbyconnection.writes is None
+
+    with (yield from mock_db_pool) as conn:
+        cursor = yield from conn.cursor()
+        assert (yield from lobbyconnection.validate_unique_id(cursor, 1, None, 'some_id'))
+        yield from cursor.execute("SELECT ip FROM login WHERE id = 1")
+        assert (yield from cursor.fetchone()) == ('10.0.2.1',)
+
+
+def test_dropped_session_is_resumed(loop, lobbyconnection, mock_context, mock_games, mock_players, mock_protocol):
+    sessions = SessionService(loop, grace=30)
+    player = Player(login='Dummy', id=42)
+    lobbyconnection.sessions = sessions
+    lobbyconnection.presence = mock.Mock()
+    lobbyconnection.player = player
+    lobbyconnection._authenticated = True
+    token = lobbyconnection.resume_token = sessions.issue(player)
+
+    lobbyconnection.on_connection_lost()
+
+    mock_players.suspend_player.assert_called_once_with(player)
+    assert not mock_players.remove_player.called
+    assert not lobbyconnection.presence.player_offline.called
+
+    reconnected = LobbyConnection(loop, context=mock_context, games=mock_games, players=mock_players,
+                                  sessions=sessions)
+    reconnected.protocol = mock_protocol
+    reconnected.send_welcome = mock.Mock()
+
+    assert reconnected.resume_session({'command': 'hello', 'login': 'Dummy', 'resume_token': token})
+    assert reconnected.player is player
+    assert reconnected.authenticated
+    assert player.lobby_connection is reconnected
+    mock_players.resume_player.assert_called_once_with(player)
+    assert reconnected.send_welcome.called
+    assert len(sessions) == 0
+
+
+def test_aborted_session_is_not_resumable(loop, lobbyconnection, mock_players):
+    sessions = SessionService(loop, grace=30)
+    player = Player(login='Dummy', id=42)
+    lobbyconnection.sessions = sessions
+    lobbyconnection.player = player
+    mock_players.players = {42: player}
+    token = lobbyconnection.resume_token = sessions.issue(player)
+    lobbyconnection._authenticated = False
+
+    lobbyconnection.on_connection_lost()
+
+    mock_players.remove_player.assert_called_once_with(player)
+    assert sessions.resume(token, 'Dummy') is None
+
+
+def test_stale_connection_lost_after_new_login(loop, lobbyconnection, mock_context, mock_games, mock_players,
+                                               mock_protocol):
+    sessions = SessionService(loop, grace=30)
+    old_player = Player(login='Dummy', id=42)
+    lobbyconnection.sessions = sessions
+    lobbyconnection.presence = mock.Mock()
+    lobbyconnection.player = old_player
+    lobbyconnection._authenticated = True
+    lobbyconnection.resume_token = sessions.issue(old_player)
+
+    # The client logs in again before the server notices the old connection is gone
+    new_player = Player(login='Dummy', id=42)
+    mock_players.players = {42: new_player}
+    new_token = sessions.issue(new_player)
+
+    lobbyconnection.on_connection_lost()
+
+    assert not mock_players.suspend_player.called
+    assert not mock_players.remove_player.called
+    assert not lobbyconnection.presence.player_offline.called
+
+    # The new login can still pick its session back up
+    assert sessions.suspend(new_token, new_player, None, mock.Mock())
+    assert sessions.resume(new_token, 'Dummy') == (new_player, None)
+
+
+@pytest.fixture
+def busy_admission(loop):
+    """
+    Admission with its only slot taken until the returned future is done
+    """
+    admission = AdmissionController(loop, min_limit=1, max_limit=1, latency_target=1, notice_interval=10)
+    release = asyncio.Future()
+
+    @asyncio.coroutine
+    def hold():
+        with (yield from admission.admit()):
+            yield from release
+
+    asyncio.async(hold())
+    return admission, release
+
+
+@asyncio.coroutine
+def test_queued_login_keeps_reading_messages(lobbyconnection, busy_admission):
+    admission, release = busy_admission
+    logged_in = []
+
+    @asyncio.coroutine
+    def log_in(message):
+        logged_in.append(message)
+
+    yield from asyncio.sleep(0)
+    lobbyconnection.admission = admission
+    lobbyconnection.liveness = mock.Mock()
+    lobbyconnection.log_in = log_in
+
+    yield from lobbyconnection.on_message_received({'command': 'hello'})
+    yield from asyncio.sleep(0)
+    assert len(admission) == 1
+
+    yield from lobbyconnection.on_message_received({'command': 'pong'})
+    lobbyconnection.liveness.pong.assert_called_once_with(lobbyconnection)
+
+    release.set_result(None)
+    yield from asyncio.sleep(0.01)
+    assert logged_in == [{'command': 'hello'}]
+
+
+@asyncio.coroutine
+def test_dropped_connection_leaves_login_queue(lobbyconnection, busy_admission, mock_players):
+    admission, release = busy_admission
+    logged_in = []
+
+    @asyncio.coroutine
+    def log_in(message):
+        logged_in.append(message)
+
+    yield from asyncio.sleep(0)
+    lobbyconnection.admission = admission
+    lobbyconnection.log_in = log_in
+    lobbyconnection.player = None
+
+    yield from lobbyconnection.on_message_received({'command': 'hello'})
+    yield from asyncio.sleep(0)
+    lobbyconnection.on_connection_lost()
+    yield from asyncio.sleep(0)
+    assert len(admission) == 0
+
+    release.set_result(None)
+    yield from asyncio.sleep(0.01)
+    assert logged_in == []
+    assert admission.active == 0
+    assert not mock_players.remove_player.called
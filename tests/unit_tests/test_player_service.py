@@ -1,9 +1,69 @@
+import asyncio
+
 import pytest
 
 from unittest import mock
 
 from server.player_service import PlayerService
+from server.players import Player
+from server.protocol import QDataStreamProtocol
 
 @pytest.fixture
 def player_service(mock_db_pool):
     return mock.create_autospec(PlayerService(mock_db_pool))
+
+
+def online_player(service, player_id):
+    lobby = mock.Mock()
+    player = Player(login='Player{}'.format(player_id), id=player_id, lobbyThread=lobby)
+    service.addUser(player)
+    return player, lobby
+
+
+def test_game_audience(mock_db_pool):
+    service = PlayerService(mock_db_pool)
+    host, host_lobby = online_player(service, 1)
+    friend, friend_lobby = online_player(service, 2)
+    foe, foe_lobby = online_player(service, 3)
+    host.friends = {2, 42}
+    host.foes = {3}
+
+    assert sorted(service.game_audience(host, friends_only=True), key=id) == sorted([host_lobby, friend_lobby], key=id)
+    assert foe_lobby not in service.game_audience(host)
+    assert friend_lobby in service.game_audience(host)
+
+    service.remove_player(friend)
+    assert friend_lobby not in service.game_audience(host, friends_only=True)
+
+
+def test_encoded_online_players(mock_db_pool):
+    service = PlayerService(mock_db_pool)
+    first, _ = online_player(service, 1)
+    second, _ = online_player(service, 2)
+
+    encoded = service.encoded_online_players(QDataStreamProtocol)
+    assert QDataStreamProtocol.decode_message(encoded[4:]) == {
+        'command': 'player_info',
+        'players': [first.to_dict(), second.to_dict()]
+    }
+    assert service.encoded_online_players(QDataStreamProtocol) is encoded
+
+    second.global_rating = (2000, 50)
+    service.player_info_changed(second)
+    service.remove_player(first)
+    assert QDataStreamProtocol.decode_message(service.encoded_online_players(QDataStreamProtocol)[4:]) == {
+        'command': 'player_info',
+        'players': [second.to_dict()]
+    }
+
+
+@asyncio.coroutine
+def test_fetch_player_data(mock_db_pool):
+    service = PlayerService(mock_db_pool)
+    player = Player(login='test', id=1)
+
+    yield from service.fetch_player_data(player)
+
+    assert player.global_rating == (2000, 125)
+    assert player.ladder_rating == (2000, 125)
+    assert player.numGames == 5
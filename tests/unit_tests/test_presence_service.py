@@ -0,0 +1,75 @@
+from unittest import mock
+
+import pytest
+
+from server.players import Player
+from server.presence_service import PresenceService
+
+
+@pytest.fixture
+def context():
+    return mock.Mock()
+
+
+@pytest.fixture
+def presence(context):
+    return PresenceService(context, mock.Mock(), interval=1)
+
+
+def sent_message(context):
+    (message, _), _ = context.broadcast.call_args
+    return message
+
+
+def test_logins_are_batched(presence, context):
+    players = [Player(login='Player{}'.format(i), id=i) for i in range(3)]
+    for player in players:
+        presence.player_online(player)
+
+    presence.loop.call_later.assert_called_once_with(1, presence.flush)
+    presence.flush()
+
+    context.broadcast.assert_called_once_with(mock.ANY, mock.ANY)
+    assert sent_message(context) == {
+        'command': 'player_info',
+        'players': [player.to_dict() for player in players]
+    }
+
+
+def test_logouts_are_broadcast(presence, context):
+    player = Player(login='Dostya', id=1)
+    presence.player_online(player)
+    presence.flush()
+
+    presence.player_offline(player)
+    presence.flush()
+
+    assert sent_message(context) == {'command': 'player_info', 'players': [], 'offline': ['Dostya']}
+
+
+def test_login_and_logout_in_one_batch_cancel_out(presence, context):
+    player = Player(login='Dostya', id=1)
+    presence.player_online(player)
+    presence.player_offline(player)
+
+    presence.flush()
+
+    assert context.broadcast.mock_calls == []
+
+
+def test_logout_is_broadcast_to_those_listing_the_player(presence, context):
+    player = Player(login='Dostya', id=1)
+    presence.player_online(player)
+    # Somebody logging in now gets the list of everybody online, Dostya included
+    presence.online_players_sent()
+    presence.player_offline(player)
+
+    presence.flush()
+
+    assert sent_message(context) == {'command': 'player_info', 'players': [], 'offline': ['Dostya']}
+
+    presence.player_online(player)
+    presence.player_offline(player)
+    presence.flush()
+
+    assert context.broadcast.call_count == 1
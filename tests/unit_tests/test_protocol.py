@@ -1,10 +1,12 @@
 from asyncio import StreamReader
 
 import asyncio
+import os
+import struct
 from PySide.QtCore import QByteArray, QDataStream, QIODevice
 from unittest import mock
 import pytest
-from server.protocol import QDataStreamProtocol
+from server.protocol import QDataStreamProtocol, SimpleJsonProtocol, codec, conflation_key
 
 
 def preparePacket(action, *args, **kwargs):
@@ -76,3 +78,148 @@ def test_QDataStreamProtocol_send_equality_reference():
 def test_QDataStreamProtocol_send_equality_reference_legacy():
     args = ['{some_json: true}', 'login', '123']
     assert QDataStreamProtocol.pack_message(*args) == preparePacket('{some_json: true}', 'login', '123')
+
+
+def test_QDataStreamProtocol_read_qstring_memoryview():
+    data = b'junk' + QDataStreamProtocol.pack_qstring('Hello') + QDataStreamProtocol.pack_qstring('World')
+    view = memoryview(data)
+
+    pos, first = QDataStreamProtocol.read_qstring(view, 4)
+    pos, second = QDataStreamProtocol.read_qstring(view, pos)
+
+    assert (first, second) == ('Hello', 'World')
+    assert pos == len(data)
+
+
+def test_QDataStreamProtocol_read_qstring_malformed():
+    data = QDataStreamProtocol.pack_qstring('Hello')[:-1]
+
+    with pytest.raises(ValueError):
+        QDataStreamProtocol.read_qstring(memoryview(data))
+
+
+def test_QDataStreamProtocol_decode_message_ping():
+    assert QDataStreamProtocol.decode_message(QDataStreamProtocol.pack_qstring('PING')) == {'command': 'ping'}
+
+
+def test_QDataStreamProtocol_pack_messages_concatenates_blocks():
+    messages = [{'command': 'mod_info', 'name': 'faf'}, {'command': 'tutorials_info'}]
+
+    buffer = QDataStreamProtocol.pack_messages(messages)
+
+    assert bytes(buffer) == b''.join(QDataStreamProtocol.pack_message(codec.dumps(msg)) for msg in messages)
+
+
+def test_QDataStreamProtocol_send_messages_single_write(protocol, writer):
+    protocol.send_messages([{'command': 'mod_info'}, {'command': 'game_info'}])
+    protocol.send_message({'command': 'notice'})
+    protocol.flush()
+
+    assert writer.writelines.call_count == 1
+    assert writer.write.call_count == 0
+
+
+@asyncio.coroutine
+def test_Protocol_flushes_on_next_iteration(protocol, writer):
+    protocol.send_message({'command': 'notice'})
+    assert writer.writelines.call_count == 0
+
+    yield from asyncio.sleep(0)
+
+    (chunks, ), _ = writer.writelines.call_args
+    assert b''.join(chunks) == QDataStreamProtocol.encode_message({'command': 'notice'})
+
+
+def test_Protocol_conflates_superseded_updates(protocol, writer):
+    protocol.send_message({'command': 'game_info', 'uid': 1, 'num_players': 1})
+    protocol.send_message({'command': 'player_info', 'players': [{'login': 'Dostya', 'country': 'DK'}]})
+    protocol.send_raw(b'raw', key=('game_info', 2))
+    protocol.send_message({'command': 'game_info', 'uid': 1, 'num_players': 2})
+    protocol.send_raw(b'newer raw', key=('game_info', 2))
+    protocol.send_message({'command': 'player_info', 'players': [{'login': 'Dostya', 'country': 'SE'}]})
+    protocol.flush()
+
+    (chunks, ), _ = writer.writelines.call_args
+    assert b''.join(chunks) == b''.join([
+        QDataStreamProtocol.encode_message({'command': 'game_info', 'uid': 1, 'num_players': 2}),
+        b'newer raw',
+        QDataStreamProtocol.encode_message({'command': 'player_info',
+                                            'players': [{'login': 'Dostya', 'country': 'SE'}]})
+    ])
+    assert protocol.messages_conflated == 3
+
+
+def test_QDataStreamProtocol_keepalives_are_bare_qstrings():
+    assert bytes(QDataStreamProtocol.encode_message({'command': 'ping'})) == QDataStreamProtocol.pack_message('PING')
+    assert bytes(QDataStreamProtocol.encode_message({'command': 'pong'})) == QDataStreamProtocol.pack_message('PONG')
+
+
+@asyncio.coroutine
+def test_SimpleJsonProtocol_roundtrip(reader, writer):
+    protocol = SimpleJsonProtocol(reader, writer)
+    message = {'command': 'game_info', 'uid': 1, 'title': 'Test game', 'teams': {'1': ['Dostya']}}
+    reader.feed_data(bytes(SimpleJsonProtocol.encode_messages([message, {'command': 'ping'}])))
+    reader.feed_eof()
+
+    assert (yield from protocol.read_message()) == message
+    assert (yield from protocol.read_message()) == {'command': 'ping'}
+
+
+def test_SimpleJsonProtocol_smaller_than_legacy():
+    message = {'command': 'game_info', 'uid': 1, 'title': 'Test game', 'state': 'open'}
+
+    assert len(SimpleJsonProtocol.encode_message(message)) < len(QDataStreamProtocol.encode_message(message)) / 2
+
+
+def upload_packet(action, payload):
+    return QDataStreamProtocol.pack_block(b''.join([QDataStreamProtocol.pack_qstring(action),
+                                                    QDataStreamProtocol.pack_qstring('Dostya'),
+                                                    QDataStreamProtocol.pack_qstring('42'),
+                                                    QDataStreamProtocol.pack_qstring('scmp_001.zip'),
+                                                    QDataStreamProtocol.pack_qstring('{"name": "Seton"}'),
+                                                    struct.pack('!i', len(payload)),
+                                                    payload]))
+
+
+@asyncio.coroutine
+def test_QDataStreamProtocol_streams_upload_to_file(protocol, reader):
+    payload = bytes(range(256)) * 1024
+    reader.feed_data(upload_packet('UPLOAD_MAP', payload))
+
+    message = yield from protocol.read_message()
+
+    upload = message['upload']
+    try:
+        assert message['command'] == 'upload_map'
+        assert message['name'] == 'scmp_001.zip'
+        assert message['info'] == {'name': 'Seton'}
+        assert upload.size == len(payload)
+        with open(upload.path, 'rb') as f:
+            assert f.read() == payload
+    finally:
+        os.remove(upload.path)
+
+
+@asyncio.coroutine
+def test_QDataStreamProtocol_rejects_oversized_upload(protocol, reader):
+    reader.feed_data(upload_packet('UPLOAD_MOD', b'\0' * 1024))
+    reader.feed_data(QDataStreamProtocol.pack_block(QDataStreamProtocol.pack_qstring('PING')))
+
+    with mock.patch('config.MAX_UPLOAD_SIZE', 512):
+        message = yield from protocol.read_message()
+
+    assert message['upload'] is None
+    assert 'error' in message
+    # The oversized payload is never read, so the connection can't go on
+    with pytest.raises(ConnectionAbortedError):
+        yield from protocol.read_message()
+
+
+def test_QDataStreamProtocol_decode_message_rejects_upload():
+    with pytest.raises(ValueError):
+        QDataStreamProtocol.decode_message(upload_packet('UPLOAD_MAP', b'')[4:])
+
+
+def test_conflation_key_game_info_delta():
+    assert conflation_key({'command': 'game_info', 'uid': 1}) == ('game_info', 1)
+    assert conflation_key({'command': 'game_info', 'uid': 1, 'delta': True}) is None
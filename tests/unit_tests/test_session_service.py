@@ -0,0 +1,82 @@
+from unittest import mock
+
+import pytest
+
+from server.players import Player
+from server.session_service import SessionService
+
+
+@pytest.fixture
+def sessions():
+    return SessionService(mock.Mock(), grace=30)
+
+
+@pytest.fixture
+def player():
+    return Player(login='Dummy', id=42)
+
+
+def test_resume(sessions, player):
+    token = sessions.issue(player)
+    on_expire = mock.Mock()
+
+    assert sessions.suspend(token, player, 'state', on_expire)
+    assert len(sessions) == 1
+
+    assert sessions.resume(token, 'Dummy') == (player, 'state')
+    sessions.loop.call_later.return_value.cancel.assert_called_once_with()
+    assert not on_expire.called
+    assert len(sessions) == 0
+
+
+def test_token_resumes_once(sessions, player):
+    token = sessions.issue(player)
+    sessions.suspend(token, player, None, mock.Mock())
+
+    assert sessions.resume(token, 'Dummy') is not None
+    assert sessions.resume(token, 'Dummy') is None
+
+
+def test_resume_other_login(sessions, player):
+    token = sessions.issue(player)
+    sessions.suspend(token, player, None, mock.Mock())
+
+    assert sessions.resume(token, 'Rhiza') is None
+    assert sessions.resume('garbage', 'Dummy') is None
+    assert len(sessions) == 1
+
+
+def test_expired_session_ends(sessions, player):
+    token = sessions.issue(player)
+    on_expire = mock.Mock()
+    sessions.suspend(token, player, None, on_expire)
+
+    sessions.loop.call_later.assert_called_once_with(30, mock.ANY, token, on_expire)
+    _, expire, *args = sessions.loop.call_later.call_args[0]
+    expire(*args)
+
+    on_expire.assert_called_once_with(player)
+    assert sessions.resume(token, 'Dummy') is None
+
+
+def test_new_login_replaces_suspended_session(sessions, player):
+    token = sessions.issue(player)
+    on_expire = mock.Mock()
+    sessions.suspend(token, player, None, on_expire)
+
+    new_token = sessions.issue(player)
+
+    assert new_token != token
+    assert len(sessions) == 0
+    assert sessions.resume(token, 'Dummy') is None
+    assert not sessions.suspend(token, player, None, on_expire)
+    assert not on_expire.called
+
+
+def test_revoke_stale_token(sessions, player):
+    token = sessions.issue(player)
+    new_token = sessions.issue(player)
+
+    sessions.revoke(player, token)
+
+    assert sessions.suspend(new_token, player, None, mock.Mock())
@@ -0,0 +1,60 @@
+import asyncio
+import hashlib
+
+import pytest
+import rsa
+
+from server.uniqueid import decode_unique_id, UniqueIdDecoder, HARDWARE_FIELDS
+from tests.utils import encode_unique_id
+
+
+@pytest.fixture(scope='module')
+def keys():
+    # The uniqueid format leaves room for an AES key encrypted with a 240 bit RSA key
+    return rsa.newkeys(240)
+
+
+@pytest.fixture
+def machine():
+    return {field: '{}-value'.format(field) for field in HARDWARE_FIELDS}
+
+
+def test_decode_unique_id(keys, machine):
+    public_key, private_key = keys
+
+    session, uid_hash, hardware_info = decode_unique_id(encode_unique_id(42, machine, public_key), private_key)
+
+    assert session == '42'
+    assert hardware_info == tuple(machine[field] for field in HARDWARE_FIELDS)
+    assert uid_hash == hashlib.md5(''.join(hardware_info).encode()).hexdigest()
+
+
+def test_decode_unique_id_missing_fields(keys):
+    public_key, private_key = keys
+
+    _, _, hardware_info = decode_unique_id(encode_unique_id(42, {'UUID': 'abc'}, public_key), private_key)
+
+    assert hardware_info == ('abc', ) + ('0', ) * (len(HARDWARE_FIELDS) - 1)
+
+
+def test_decode_unique_id_virtual_machine(keys, machine):
+    public_key, private_key = keys
+    machine['Manufacturer'] = 'innotek GmbH'
+
+    assert decode_unique_id(encode_unique_id(42, machine, public_key), private_key) == ('42', "VM", None)
+
+
+def test_decode_unique_id_garbage(keys):
+    with pytest.raises(Exception):
+        decode_unique_id('Z2FyYmFnZQ==', keys[1])
+
+
+@asyncio.coroutine
+def test_decoder_in_worker_process(loop, keys, machine):
+    public_key, private_key = keys
+    encoded = encode_unique_id(42, machine, public_key)
+    decoder = UniqueIdDecoder(loop, workers=1, private_key=private_key)
+    try:
+        assert (yield from decoder.decode(encoded)) == decode_unique_id(encoded, private_key)
+    finally:
+        decoder.close()
@@ -0,0 +1,86 @@
+import asyncio
+from unittest import mock
+
+import pytest
+
+from server.write_behind import WriteBehindQueue
+
+UPDATE_IP = "UPDATE login SET ip = %s WHERE id = %s"
+
+
+@pytest.fixture
+def writes(loop):
+    return WriteBehindQueue(loop, interval=1, batch_size=2, max_attempts=3)
+
+
+@asyncio.coroutine
+def login_ips(db_pool):
+    with (yield from db_pool) as conn:
+        cursor = yield from conn.cursor()
+        yield from cursor.execute("SELECT id, ip FROM login WHERE id IN (1, 2, 3)")
+        return dict((yield from cursor.fetchall()))
+
+
+def test_repeats_coalesce(writes):
+    writes.put(UPDATE_IP, 1, ('10.0.0.1', 1))
+    writes.put(UPDATE_IP, 2, ('10.0.0.2', 2))
+    writes.put(UPDATE_IP, 1, ('10.0.0.3', 1))
+
+    assert len(writes) == 2
+    assert list(writes._queued.values()) == [(('10.0.0.3', 1), 0), (('10.0.0.2', 2), 0)]
+
+
+@asyncio.coroutine
+def test_write_batch(writes, mock_db_pool):
+    writes.put(UPDATE_IP, 1, ('10.0.0.1', 1))
+    writes.put(UPDATE_IP, 2, ('10.0.0.2', 2))
+    writes.put(UPDATE_IP, 3, ('10.0.0.3', 3))
+
+    assert (yield from writes.write_batch(writes.batch_size)) == 2
+    assert len(writes) == 1
+
+    ips = yield from login_ips(mock_db_pool)
+    assert (ips[1], ips[2]) == ('10.0.0.1', '10.0.0.2')
+
+
+@asyncio.coroutine
+def test_flush(writes, mock_db_pool):
+    for player_id in (1, 2, 3):
+        writes.put(UPDATE_IP, player_id, ('10.0.1.{}'.format(player_id), player_id))
+
+    yield from writes.flush()
+
+    assert len(writes) == 0
+    assert (yield from login_ips(mock_db_pool)) == {1: '10.0.1.1', 2: '10.0.1.2', 3: '10.0.1.3'}
+
+
+@asyncio.coroutine
+def test_broken_statement_given_up(writes, mock_db_pool):
+    writes.put("UPDATE no_such_table SET ip = %s WHERE id = %s", 1, ('10.0.0.1', 1))
+    writes.put(UPDATE_IP, 2, ('10.0.2.2', 2))
+
+    assert (yield from writes.write_batch()) == 1
+    assert len(writes) == 0
+
+
+def test_failed_writes_retried(writes):
+    writes._retry(UPDATE_IP, [(1, ('10.0.0.1', 1), 0), (2, ('10.0.0.2', 2), 2)], Exception())
+
+    # The second one ran out of attempts
+    assert list(writes._queued.items()) == [((UPDATE_IP, 1), (('10.0.0.1', 1), 1))]
+
+
+def test_failed_write_superseded(writes):
+    writes.put(UPDATE_IP, 1, ('10.0.0.2', 1))
+
+    writes._retry(UPDATE_IP, [(1, ('10.0.0.1', 1), 0)], Exception())
+
+    assert list(writes._queued.values()) == [(('10.0.0.2', 1), 0)]
+
+
+def test_run_schedules_next(writes):
+    writes.loop = mock.Mock()
+
+    writes.run()
+
+    writes.loop.call_later.assert_called_once_with(1, writes.run)
@@ -8,3 +8,35 @@ def wait_signal(signal, timeout=0.5):
             future.set_result(True)
     signal.connect(fire)
     yield from asyncio.wait_for(future, timeout)
+
+
+def benchmark(fn, number=1000, repeat=3):
+    """
+    Time fn, returning the best per-call duration in seconds over `repeat` runs
+    """
+    import timeit
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def report(name, seconds):
+    print("{:<50} {:>12.2f} us".format(name, seconds * 1e6))
+
+
+def encode_unique_id(session, machine, public_key):
+    """
+    Build a uniqueid the way the client does, for server.uniqueid.decode_unique_id
+    """
+    import base64
+    import json
+    import os
+    import rsa
+    from Crypto.Cipher import AES
+
+    plain = json.dumps(dict(session=session, machine=machine)).encode()
+    trailing = AES.block_size - len(plain) % AES.block_size
+    plain += b' ' * trailing
+    key, iv = os.urandom(16), os.urandom(16)
+    encrypted = AES.new(key, AES.MODE_CBC, iv).encrypt(plain)
+    message = (bytes([trailing]) + base64.b64encode(iv) + base64.b64encode(encrypted) +
+               base64.b64encode(rsa.encrypt(key, public_key)))
+    return base64.b64encode(message).decode()